@@ -27,11 +27,30 @@ endif
 " Execute the main body of taskwiki source
 execute 'py3file ' . s:knowledge_plugin_path . '/knowledge/main.py'
 
+" Collects the changes of the tracked buffers, see knowledge/tracking.py
+function! KnowledgeTrackChanges(bufnr, start, end, added, changes)
+  call add(getbufvar(a:bufnr, 'knowledge_changes', []), [a:start - 1, a:end - 1, a:added])
+endfunction
+
+" Track the modified lines, so that only the affected notes are synced
+py3 track_changes()
+
 augroup knowledge
     autocmd!
     " Create new notes in Anki when saved
     execute "autocmd BufWrite *.".expand('%:e')." KnowledgeBufferSave"
 
+    " Wait for the background syncs to place the identifiers before exiting
+    autocmd VimLeavePre * py3 finish_background_sync()
+
+    " Release the SRS collection kept open between the syncs
+    autocmd VimLeavePre * py3 close_idle_proxy()
+
+    " Sync the notes left over by the time-budgeted sync
+    if exists('g:knowledge_sync_budget_ms')
+        execute "autocmd CursorHold *.".expand('%:e')." py3 resume_notes()"
+    endif
+
     " Autoclose when opening
     if exists('g:knowledge_autoclose_questions')
         execute "autocmd BufWinEnter,SessionLoadPost *.".expand('%:e')." KnowledgeCloseQuestions"
@@ -39,20 +58,51 @@ augroup knowledge
 augroup END
 
 " Global update commands
-command! KnowledgeBufferSave :py3 create_notes()
+command! -range KnowledgeBufferSave :py3 create_notes(lines=(<line1> - 1, <line2>) if <range> else None)
+command! KnowledgeSubtreeSave :py3 create_notes(subtree=True)
 command! KnowledgeCloseQuestions :py3 close_questions()
 command! KnowledgePasteImage :py3 paste_image()
 command! KnowledgeCite :py3 add_citation()
 command! KnowledgeOccludeImage :py3 occlude_image()
 command! KnowledgeNoteInfo :py3 note_info()
 command! KnowledgeDiag :py3 diagnose()
+command! -bang KnowledgeReconcile :py3 reconcile(rebuild="<bang>" == "!")
+command! KnowledgeBufferStatus :py3 buffer_status()
+command! -nargs=+ -complete=file KnowledgeExport :py3 export_notes(<f-args>)
 command! KnowledgeExportPDF :py3 convert_to_pdf()
 command! KnowledgeExportPDFPlain :py3 convert_to_pdf(interactive=False)
 command! KnowledgeExportPDFInteractive :py3 convert_to_pdf(interactive=True)
 
+" Applies the results of the background syncs, called from a timer
+function! KnowledgeSyncPoll(timer)
+  py3 poll_background_sync()
+endfunction
+
+" Synchronizes the buffers saved since the last flush, called from a timer
+function! KnowledgeSyncFlush(timer)
+  py3 flush_scheduled_syncs()
+endfunction
+
+" Closes the SRS proxy once it was not used for a while, called from a timer
+function! KnowledgeProxyIdle(timer)
+  py3 close_idle_proxy()
+endfunction
+
+" Signs of the review status, see :KnowledgeBufferStatus
+if exists('*sign_placelist')
+  call sign_define([
+    \ {'name': 'KnowledgeLeech', 'text': '!!', 'texthl': 'ErrorMsg'},
+    \ {'name': 'KnowledgeDue', 'text': '>>', 'texthl': 'WarningMsg'},
+    \ {'name': 'KnowledgeNew', 'text': '++', 'texthl': 'Identifier'},
+    \ {'name': 'KnowledgeScheduled', 'text': '--', 'texthl': 'Comment'},
+    \ {'name': 'KnowledgeMissing', 'text': '??', 'texthl': 'ErrorMsg'},
+    \ ])
+endif
+
 " Leader-related mappings.
 nmap <silent><buffer> <Leader>kp :KnowledgePasteImage<CR>
 nmap <silent><buffer> <Leader>kc :KnowledgeCite<CR>
 nmap <silent><buffer> <Leader>ko :KnowledgeOccludeImage<CR>
 nmap <silent><buffer> <Leader>ki :KnowledgeNoteInfo<CR>
+nmap <silent><buffer> <Leader>ks :KnowledgeBufferStatus<CR>
 nmap <silent><buffer> <Leader>ke :KnowledgeExportPDF<CR>
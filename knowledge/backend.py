@@ -3,20 +3,74 @@ Provides long term storage backend implementations.
 """
 
 import basehash
+import collections
+import hashlib
+import json
+import sqlite3
+import time
 import uuid
 
 from pony import orm
 from knowledge import config, errors, constants
 
+# Columns added to the Mapping table after its initial release
+MIGRATED_COLUMNS = {
+    'fingerprint': 'TEXT',
+}
+
+def migrate(path):
+    """
+    Adds any columns missing in an existing database, so that the entities
+    can be mapped onto it.
+    """
+
+    connection = sqlite3.connect(path)
+
+    try:
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(Mapping)')]
+
+        # Nothing to migrate if the table does not exist yet
+        for column, column_type in MIGRATED_COLUMNS.items():
+            if columns and column not in columns:
+                connection.execute(f'ALTER TABLE Mapping ADD COLUMN {column} {column_type}')
+
+        # Checkpoints are transient, a table of the outdated layout is
+        # simply created again
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(Checkpoint)')]
+        if columns and 'path' not in columns:
+            connection.execute('DROP TABLE Checkpoint')
+
+        connection.commit()
+    finally:
+        connection.close()
+
+migrate(config.DB_FILE)
 db = orm.Database('sqlite', config.DB_FILE, create_db=True)
 translator = basehash.base(constants.ALPHABET)
 
 class Mapping(db.Entity):
     knowledge_id = orm.PrimaryKey(str)
     fact_id = orm.Required(str)
+    fingerprint = orm.Optional(str, nullable=True)
+
+# Notes created by a checkpointed sync, whose identifiers might not have been
+# placed into the wiki file yet if the sync was interrupted
+class Checkpoint(db.Entity):
+    knowledge_id = orm.PrimaryKey(str)
+    fingerprint = orm.Required(str, index=True)
+    path = orm.Optional(str)
+    created = orm.Required(float)
 
 db.generate_mapping(create_tables=True)
 
+def fingerprint(fields, deck, model, tags):
+    """
+    Computes a fingerprint of the data pushed to the SRS for a note.
+    """
+
+    data = json.dumps([fields, deck, model, sorted(tags or [])], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
 @orm.db_session
 def get(knowledge_id):
     mapping = Mapping.get(knowledge_id=knowledge_id)
@@ -27,11 +81,153 @@ def get(knowledge_id):
 
     return mapping.fact_id
 
-def put(fact_id):
-    knowledge_id = translator.encode(uuid.uuid4().int >> 64).zfill(11)
-    return assign(fact_id, knowledge_id)
+def transaction():
+    """
+    Groups all the operations performed within it into a single transaction.
+    """
+
+    return orm.db_session
+
+def generate_id():
+    return translator.encode(uuid.uuid4().int >> 64).zfill(constants.IDENTIFIER_LENGTH)
 
 @orm.db_session
-def assign(fact_id, knowledge_id):
-    Mapping(knowledge_id=knowledge_id, fact_id=fact_id)
+def assign(fact_id, knowledge_id, fingerprint=None):
+    Mapping(knowledge_id=knowledge_id, fact_id=fact_id, fingerprint=fingerprint)
     return knowledge_id
+
+# Number of identifiers looked up by a single query, kept well below the
+# limit of the SQLite host parameters
+LOOKUP_CHUNK_SIZE = 500
+
+@orm.db_session
+def get_many(knowledge_ids):
+    """
+    Returns a dict mapping the given knowledge identifiers found in the
+    database to their (fact_id, fingerprint) pairs.
+    """
+
+    knowledge_ids = list(set(knowledge_ids))
+    result = dict()
+
+    for index in range(0, len(knowledge_ids), LOOKUP_CHUNK_SIZE):
+        chunk = knowledge_ids[index:index+LOOKUP_CHUNK_SIZE]
+        mappings = Mapping.select(lambda m: m.knowledge_id in chunk)
+        result.update({
+            mapping.knowledge_id: (mapping.fact_id, mapping.fingerprint)
+            for mapping in mappings
+        })
+
+    return result
+
+@orm.db_session
+def get_all():
+    """
+    Returns a dict mapping all the stored knowledge identifiers to their
+    fact ids.
+    """
+
+    return dict(orm.select((m.knowledge_id, m.fact_id) for m in Mapping)[:])
+
+@orm.db_session
+def assign_many(entries):
+    """
+    Stores the given (fact_id, knowledge_id, fingerprint) triples in a single
+    transaction. Returns the list of the knowledge identifiers.
+    """
+
+    for fact_id, knowledge_id, fingerprint in entries:
+        Mapping(knowledge_id=knowledge_id, fact_id=fact_id, fingerprint=fingerprint)
+
+    return [knowledge_id for fact_id, knowledge_id, fingerprint in entries]
+
+# Number of seconds after which the checkpoints of a file that was not
+# synchronized again are forgotten
+CHECKPOINT_TTL = 7 * 86400
+
+@orm.db_session
+def record_checkpoints(fingerprints, path):
+    """
+    Remembers the given knowledge identifiers together with the fingerprints
+    of their notes in the given file, until the identifiers are known to be
+    placed, see resume_checkpoints.
+    """
+
+    created = time.time()
+
+    for knowledge_id, fingerprint in fingerprints.items():
+        Checkpoint(knowledge_id=knowledge_id, fingerprint=fingerprint,
+                   path=path or '', created=created)
+
+@orm.db_session
+def resume_checkpoints(fingerprints, path):
+    """
+    Returns a dict mapping the given fingerprints to the lists of the
+    knowledge identifiers of the checkpointed notes of the given file with
+    that fingerprint, at most one per occurrence of the fingerprint. The
+    returned checkpoints are forgotten, so that each identifier is placed
+    only once, as are the expired ones.
+    """
+
+    path = path or ''
+    wanted = collections.Counter(fingerprints)
+    fingerprints = list(wanted)
+    result = dict()
+
+    expired = time.time() - CHECKPOINT_TTL
+    Checkpoint.select(lambda c: c.created < expired).delete(bulk=True)
+
+    for index in range(0, len(fingerprints), LOOKUP_CHUNK_SIZE):
+        chunk = fingerprints[index:index+LOOKUP_CHUNK_SIZE]
+        for checkpoint in Checkpoint.select(lambda c: c.path == path and c.fingerprint in chunk)[:]:
+            resumed = result.setdefault(checkpoint.fingerprint, [])
+            if len(resumed) < wanted[checkpoint.fingerprint]:
+                resumed.append(checkpoint.knowledge_id)
+                checkpoint.delete()
+
+    return result
+
+@orm.db_session
+def clear_checkpoints(path):
+    """
+    Forgets the checkpoints of the given file, once all its identifiers are
+    placed.
+    """
+
+    path = path or ''
+    Checkpoint.select(lambda c: c.path == path).delete(bulk=True)
+
+@orm.db_session
+def set_fingerprints(fingerprints):
+    """
+    Updates the fingerprints of the given knowledge identifiers in a single
+    transaction.
+    """
+
+    for knowledge_id, fingerprint in fingerprints.items():
+        mapping = Mapping.get(knowledge_id=knowledge_id)
+
+        # If mapping not found in the local database, raise an exception
+        if mapping is None:
+            raise errors.MappingNotFoundException(knowledge_id)
+
+        mapping.fingerprint = fingerprint
+
+@orm.db_session
+def set_fact_ids(fact_ids):
+    """
+    Points the given knowledge identifiers to the new fact ids in a single
+    transaction. The mappings of the identifiers mapped to None are removed.
+    """
+
+    for knowledge_id, fact_id in fact_ids.items():
+        mapping = Mapping.get(knowledge_id=knowledge_id)
+
+        # If mapping not found in the local database, raise an exception
+        if mapping is None:
+            raise errors.MappingNotFoundException(knowledge_id)
+
+        if fact_id is None:
+            mapping.delete()
+        else:
+            mapping.fact_id = fact_id
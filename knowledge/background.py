@@ -0,0 +1,153 @@
+"""
+Runs the synchronization of the buffers in the background, so that the
+editor is not blocked while the SRS is being updated.
+"""
+
+import difflib
+import threading
+
+import knowledge as k
+import knowledge.regexp
+
+# Unapplied synchronization jobs, keyed by buffer number
+JOBS = dict()
+
+# Identifier of the vim timer polling for the finished jobs, if running
+TIMER = None
+
+# Numbers of the buffers saved since the last flush of the scheduled syncs,
+# and the identifier of the vim timer postponing the flush
+SCHEDULED = set()
+DEBOUNCE_TIMER = None
+
+# The SRS databases do not support concurrent writers, hence the jobs
+# are executed one at a time
+LOCK = threading.Lock()
+
+
+class SyncJob(object):
+    """
+    Synchronizes a snapshot of the buffer lines in a worker thread.
+
+    The target is called with the list of snapshot lines and is expected to
+    return the list of the lines modified by the synchronization, together
+    with any additional data that should be passed back to the editor.
+    """
+
+    def __init__(self, buffer_number, lines, target):
+        self.buffer_number = buffer_number
+        self.snapshot = list(lines)
+        self.target = target
+
+        self.lines = None
+        self.result = None
+        self.error = None
+
+        # Set if the buffer was saved again while the job was running
+        self.outdated = False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        JOBS[self.buffer_number] = self
+        self.thread.start()
+
+    def run(self):
+        try:
+            with LOCK:
+                self.lines, self.result = self.target(list(self.snapshot))
+        except Exception as e:
+            self.error = e
+
+    @property
+    def finished(self):
+        return not self.thread.is_alive()
+
+    def reconcile(self, current):
+        """
+        Transfers the modifications performed by the synchronization onto the
+        current lines of the buffer, which might have been edited since the
+        snapshot was taken.
+
+        Returns a dict mapping the numbers of the current lines to their new
+        content, and a list of the snapshot line numbers whose modification
+        could not be transferred.
+        """
+
+        changed = [
+            number
+            for number, (old, new) in enumerate(zip(self.snapshot, self.lines))
+            if old != new
+        ]
+
+        if not changed:
+            return dict(), []
+
+        # Locate the snapshot lines in the current buffer. Lines that were
+        # edited in place are matched by their position in the edited region.
+        positions = dict()
+        matcher = difflib.SequenceMatcher(None, self.snapshot, current, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal' or (tag == 'replace' and i2 - i1 == j2 - j1):
+                for offset in range(i2 - i1):
+                    positions[i1 + offset] = j1 + offset
+
+        updates = dict()
+        conflicts = []
+
+        for number in changed:
+            position = positions.get(number)
+            line = None
+
+            if position is not None:
+                line = transfer(self.snapshot[number], self.lines[number], current[position])
+
+            if line is None:
+                conflicts.append(number)
+            elif line != current[position]:
+                updates[position] = line
+
+        return updates, conflicts
+
+
+def transfer(old, new, target):
+    """
+    Applies the modification of the old line into the new one onto the target
+    line. Only the placement of identifiers can be transferred onto a line that
+    differs from the old one. Returns None if that is not possible.
+    """
+
+    if target == old:
+        return new
+
+    def identifiers(line):
+        return set(m.group('identifier') for m in k.regexp.IDENTIFIER_MARK.finditer(line))
+
+    added = identifiers(new) - identifiers(old)
+    removed = identifiers(old) - identifiers(new)
+
+    # The modification is not just a placement of the identifier
+    if not added and not removed:
+        return None
+
+    for identifier in removed:
+        target = target.replace(' @' + identifier, '')
+
+    for identifier in sorted(added):
+        if identifier not in target:
+            target = '{0} @{1}'.format(target.rstrip(), identifier)
+
+    return target
+
+
+def finished_jobs():
+    """
+    Removes the finished jobs from the registry and returns them.
+    """
+
+    finished = [job for job in JOBS.values() if job.finished]
+
+    for job in finished:
+        del JOBS[job.buffer_number]
+
+    return finished
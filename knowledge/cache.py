@@ -0,0 +1,85 @@
+"""
+Provides caches that speed up repeated synchronization of a buffer.
+"""
+
+import hashlib
+
+# Blocks synchronized by the last successful sync, keyed by buffer number.
+# Kept here, since main.py is executed again for every buffer
+BLOCK_CACHES = dict()
+
+# Number of notes left unsynchronized due to the time budget, keyed by
+# buffer number
+PENDING_NOTES = dict()
+
+
+class BlockCache(object):
+    """
+    Remembers the note blocks that were synchronized by the last sync.
+
+    A block is identified by the digest of the lines that were read to parse
+    the note, combined with the header context (heading, tags, deck and model)
+    it was parsed in. A block with a known digest did not change since it was
+    synchronized, hence it does not need to be parsed, rendered or sent to the
+    SRS again.
+    """
+
+    def __init__(self):
+        # Maps block digests to the number of lines processed by the block
+        self.blocks = dict()
+
+        # Maps the content of the line that triggered a block to the set of
+        # (offset, size) spans of blocks triggered by such lines
+        self.spans = dict()
+
+    @staticmethod
+    def digest(lines, offset, context):
+        hasher = hashlib.sha1(repr((offset, context)).encode('utf-8'))
+
+        for line in lines:
+            hasher.update(line.encode('utf-8'))
+            hasher.update(b'\n')
+
+        return hasher.hexdigest()
+
+    def lookup(self, buffer_proxy, number, context):
+        """
+        Returns the (offset, size, processed) triple describing an unchanged
+        block triggered on the given line, or None if there is no such block.
+        """
+
+        for offset, size in self.spans.get(buffer_proxy[number], ()):
+            start = number - offset
+            if start < 0 or start + size > len(buffer_proxy):
+                continue
+
+            digest = self.digest(buffer_proxy[start:start+size], offset, context)
+            processed = self.blocks.get(digest)
+
+            if processed is not None:
+                return offset, size, processed
+
+    def record(self, buffer_proxy, number, offset, size, processed, context):
+        """
+        Marks the block triggered on the given line as synchronized.
+        """
+
+        start = number - offset
+        digest = self.digest(buffer_proxy[start:start+size], offset, context)
+
+        self.blocks[digest] = processed
+        self.spans.setdefault(buffer_proxy[number], set()).add((offset, size))
+
+    def merge(self, other):
+        """
+        Adds the blocks remembered by the other cache.
+        """
+
+        for digest, processed in other.blocks.items():
+            self.blocks.setdefault(digest, processed)
+
+        for line, spans in other.spans.items():
+            self.spans.setdefault(line, set()).update(spans)
+
+    def __len__(self):
+        return len(self.blocks)
@@ -2,6 +2,7 @@
 This module collects all the config variables sourced from vim.
 """
 
+import json
 import os
 import sys
 
@@ -28,6 +29,8 @@ class Configuration:
 
         self.SRS_PROVIDER = self._get_config_var('knowledge_srs_provider', None)
         self.SRS_DB = self._get_config_var('knowledge_srs_db', None)
+        self.ANKICONNECT_URL = self._get_config_var('knowledge_ankiconnect_url', 'http://127.0.0.1:8765')
+        self.ANKICONNECT_KEY = self._get_config_var('knowledge_ankiconnect_key', None)
         self.DB_FILE = self._get_config_var(
             'knowledge_db_file',
             os.path.expanduser("~/.knowledge.db")
@@ -35,7 +38,7 @@ class Configuration:
 
         self.DATA_FOLDER = self._get_config_var(
             'knowledge_data_folder',
-            os.path.join(self.wiki_root, '.data')
+            os.path.join(self.wiki_root or os.getcwd(), '.data')
         )
 
         self.QUESTION_OMITTED_PREFIXES = self._get_config_var(
@@ -48,15 +51,51 @@ class Configuration:
             ('Q:', 'How:', 'Explain:', 'Define:', 'List:', 'Prove:', 'Derive:')
         )
 
+        self.MARKUP_SYNTAX = self._get_config_var('knowledge_syntax', 'default')
+
         self.GLUED_LATEX_COMMANDS = self._get_config_var('knowledge_glued_latex_commands', [])
         self.PDF_UNDERLINE_CLOZE = self._get_config_var('knowledge_pdf_underline_cloze', 1)
 
+        # Synchronization tuning
+        self.INCREMENTAL_SYNC = self._get_config_var('knowledge_incremental_sync', 0)
+        self.ASYNC_SYNC = self._get_config_var('knowledge_async_sync', 0)
+        self.ASYNC_POLL_INTERVAL = self._get_config_var('knowledge_async_poll_interval', 200)
+        self.SYNC_BUDGET_MS = self._get_config_var('knowledge_sync_budget_ms', 0)
+        self.TRACK_CHANGES = self._get_config_var('knowledge_track_changes', 0)
+        self.SYNC_DEBOUNCE_MS = self._get_config_var('knowledge_sync_debounce_ms', 0)
+        self.PROXY_IDLE_MS = self._get_config_var('knowledge_proxy_idle_ms', 0)
+        self.CHECKPOINT_NOTES = self._get_config_var('knowledge_checkpoint_notes', 0)
+        self.CHECKPOINT_MS = self._get_config_var('knowledge_checkpoint_ms', 0)
+
+        # Shared SRS daemon
+        self.SRS_DAEMON = self._get_config_var('knowledge_srs_daemon', 0)
+        self.DAEMON_PYTHON = self._get_config_var('knowledge_daemon_python', 'python3')
+        self.DAEMON_IDLE_MS = self._get_config_var('knowledge_daemon_idle_ms', 10000)
+
+        # Review status overlay
+        self.LEECH_LAPSES = self._get_config_var('knowledge_leech_lapses', 8)
+
+        # Offline journal of the changes made while the SRS is unavailable
+        self.OFFLINE_JOURNAL = self._get_config_var('knowledge_offline_journal', 0)
+        self.JOURNAL_FILE = self._get_config_var(
+            'knowledge_journal_file',
+            os.path.splitext(self.DB_FILE)[0] + '.journal'
+        )
+
     @staticmethod
     def _get_config_var(key, default):
         if 'vim' in sys.modules:
             return vimutils.decode_bytes(vim.vars.get(key, default))
-        else:
-            return os.environ.get(key.upper(), default)
+
+        value = os.environ.get(key.upper())
+        if value is None:
+            return default
+
+        # Numbers and lists are passed as JSON, anything else as plain string
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
 
     @property
     def wiki_root(self):
@@ -6,3 +6,6 @@ import pathlib
 
 
 ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# Length of the knowledge identifiers
+IDENTIFIER_LENGTH = 11
@@ -0,0 +1,235 @@
+"""
+A daemon owning the proxy of the SRS collection, shared by all the editor
+instances working with the same collection, so that they do not compete for
+the database lock. The daemon serves the requests one at a time, hence the
+writes are serialized, and commits the changes before acknowledging the
+commit request. It exits after being idle for g:knowledge_daemon_idle_ms,
+releasing the collection.
+
+The messages are single lines of JSON. A request names the proxy method and
+its arguments, a response carries either the result, or the name and the
+message of the raised exception.
+
+The daemon is started by DaemonProxy, which passes the configuration through
+the environment:
+
+    python3 -m knowledge.daemon <socket path>
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import time
+
+from knowledge import config, errors
+
+# Proxy methods available to the clients
+METHODS = (
+    'add_notes',
+    'update_notes',
+    'embed_identifiers',
+    'prepare_decks',
+    'add_media_file',
+    'get_identifiers',
+    'note_info',
+    'commit',
+)
+
+# Configuration passed to the daemon started by the editor
+FORWARDED_CONFIG = (
+    'SRS_PROVIDER',
+    'SRS_DB',
+    'ANKICONNECT_URL',
+    'ANKICONNECT_KEY',
+    'DATA_FOLDER',
+    'GLUED_LATEX_COMMANDS',
+    'DAEMON_IDLE_MS',
+)
+
+# Number of seconds between the checks whether the daemon is idle
+IDLE_CHECK_INTERVAL = 0.5
+
+# Number of seconds to wait for the started daemon to accept the connections
+START_TIMEOUT = 10
+
+
+def socket_path():
+    """
+    Returns the path of the socket of the daemon serving the configured
+    collection.
+    """
+
+    collection = f'{config.SRS_PROVIDER}:{config.SRS_DB}'
+    digest = hashlib.sha1(collection.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f'knowledge-{os.getuid()}-{digest}.sock')
+
+
+def encode(message):
+    def default(value):
+        if isinstance(value, datetime.datetime):
+            return {'$datetime': value.timestamp()}
+        elif isinstance(value, (set, frozenset)):
+            return sorted(value)
+
+        raise TypeError(f"Object of type {type(value).__name__} cannot be sent")
+
+    return (json.dumps(message, default=default, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def decode(line):
+    def object_hook(value):
+        if '$datetime' in value:
+            return datetime.datetime.fromtimestamp(value['$datetime'])
+
+        return value
+
+    return json.loads(line.decode('utf-8'), object_hook=object_hook)
+
+
+def running(path):
+    """
+    Determines whether a daemon accepts the connections on the given socket.
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+
+    return True
+
+
+def start(path):
+    """
+    Starts the daemon listening on the given socket and waits until it
+    accepts the connections.
+    """
+
+    environment = dict(os.environ)
+    environment.update({
+        f'KNOWLEDGE_{key}': json.dumps(getattr(config, key))
+        for key in FORWARDED_CONFIG
+    })
+
+    # Make the knowledge package importable
+    plugin_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [plugin_root, environment.get('PYTHONPATH')])
+    )
+
+    try:
+        subprocess.Popen(
+            [config.DAEMON_PYTHON, '-m', 'knowledge.daemon', path],
+            env=environment,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        raise errors.KnowledgeException(f"The knowledge daemon could not be started: {e}")
+
+    deadline = time.monotonic() + START_TIMEOUT
+    while not running(path):
+        if time.monotonic() > deadline:
+            raise errors.KnowledgeException(
+                "The knowledge daemon did not start, make sure "
+                f"'{config.DAEMON_PYTHON}' can import the SRS libraries."
+            )
+
+        time.sleep(0.05)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            response = self.server.dispatch(decode(line))
+            self.wfile.write(encode(response))
+            self.wfile.flush()
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """
+    Serves the requests using the given proxy, one connection at a time.
+    """
+
+    def __init__(self, path, proxy):
+        super().__init__(path, RequestHandler)
+        self.proxy = proxy
+        self.last_request = time.monotonic()
+
+    def dispatch(self, request):
+        self.last_request = time.monotonic()
+        method = request.get('method')
+
+        if method not in METHODS:
+            return {'error': 'KnowledgeException', 'message': f"Unknown method '{method}'"}
+
+        args = request.get('args', [])
+
+        # Sets are sent as lists, the proxies expect the tags as sets
+        if method in ('add_notes', 'update_notes'):
+            for note in args[0]:
+                note['tags'] = set(note.get('tags') or [])
+
+        self.proxy.base_dir = request.get('base_dir')
+
+        try:
+            return {'result': getattr(self.proxy, method)(*args)}
+        except errors.PartialAddException as e:
+            return {'error': type(e).__name__, 'message': str(e), 'identifiers': e.identifiers}
+        except errors.KnowledgeException as e:
+            return {'error': type(e).__name__, 'message': str(e)}
+        except Exception as e:
+            return {'error': 'KnowledgeException', 'message': f'{type(e).__name__}: {e}'}
+
+
+def serve(path):
+    """
+    Serves the requests on the given socket, until the daemon is idle.
+    """
+
+    # Imported here, so that the editor does not import the SRS libraries
+    from knowledge.proxy import get_proxy
+
+    # Another daemon already serves the collection, otherwise remove the
+    # socket left over by a daemon that did not exit cleanly
+    if os.path.exists(path):
+        if running(path):
+            return
+
+        os.unlink(path)
+
+    # The socket is accessible only by the user
+    os.umask(0o077)
+
+    proxy = get_proxy()
+    server = DaemonServer(path, proxy)
+    server.timeout = IDLE_CHECK_INTERVAL
+
+    try:
+        while True:
+            server.handle_request()
+            idle = time.monotonic() - server.last_request
+
+            if idle * 1000 >= config.DAEMON_IDLE_MS:
+                break
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+        proxy.cleanup()
+
+
+if __name__ == '__main__':
+    # The daemon owns the collection, it must not forward to itself
+    config.SRS_DAEMON = 0
+    serve(sys.argv[1])
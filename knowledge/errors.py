@@ -16,6 +16,17 @@ class FactNotFoundException(KnowledgeException):
 class MappingNotFoundException(KnowledgeException):
     pass
 
+class SRSUnavailableException(KnowledgeException):
+    pass
+
+class PartialAddException(KnowledgeException):
+    # Carries the identifiers of the notes added before the failure, None
+    # standing for the notes that were not added
+
+    def __init__(self, message, identifiers):
+        super().__init__(message)
+        self.identifiers = identifiers
+
 
 # Handle error without traceback, if they're descendants of VimPrettyException
 def pretty_exception_handler(original_function):
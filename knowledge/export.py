@@ -0,0 +1,517 @@
+"""
+Bulk export of the notes into a file imported by Anki at once, which is much
+faster than creating the notes one by one for the first import of a large
+wiki. The exporters act as the SRS proxies, so that the wiki files are
+parsed and the fields rendered exactly as by the regular sync.
+
+Only the notes not yet present in the SRS are exported. The notes exported
+into an .apkg package get their note ids assigned upfront, hence their
+mappings are recorded as if they were added to the SRS directly, using the
+note types of the collection where available. Anki assigns the note ids of
+the notes imported from a TSV file itself, so these are exported with their
+knowledge identifiers as the guids and mapped to placeholder fact ids, which
+are linked to the imported notes by the reconciliation.
+"""
+
+import csv
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+from knowledge.errors import KnowledgeException
+from knowledge.proxy import AnkiProxy, SRSProxy, cloze_ords
+
+# Prefix of the fact ids of the notes exported into a TSV file, until they
+# are imported into the SRS
+PLACEHOLDER_PREFIX = 'export:'
+
+
+def placeholder(knowledge_id):
+    return PLACEHOLDER_PREFIX + knowledge_id
+
+
+def is_placeholder(fact_id):
+    return str(fact_id).startswith(PLACEHOLDER_PREFIX)
+
+
+def get_exporter(path, note_types=None):
+    """
+    Returns the exporter writing into the given file, by its extension. The
+    note types of the collection, keyed by name, are reused by the .apkg
+    packages.
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == '.apkg':
+        return ApkgExporter(path, note_types)
+    elif extension in ('.tsv', '.txt'):
+        return TsvExporter(path)
+    else:
+        raise KnowledgeException(
+            f"Unsupported export format '{extension}', use .apkg or .tsv"
+        )
+
+
+def strip_html(field):
+    return re.sub(r'<[^>]*>', '', field).strip()
+
+
+class Exporter(SRSProxy):
+    """
+    Collects the notes added during the sync into a file. The notes already
+    present in the SRS are left out.
+    """
+
+    DEFAULT_DECK = AnkiProxy.DEFAULT_DECK
+    DEFAULT_MODEL = AnkiProxy.DEFAULT_MODEL
+    CLOSE_MODEL = AnkiProxy.CLOSE_MODEL
+    SYMBOL_EQ_OPEN = AnkiProxy.SYMBOL_EQ_OPEN
+    SYMBOL_EQ_CLOSE = AnkiProxy.SYMBOL_EQ_CLOSE
+    SYMBOL_B_OPEN = AnkiProxy.SYMBOL_B_OPEN
+    SYMBOL_B_CLOSE = AnkiProxy.SYMBOL_B_CLOSE
+    SYMBOL_I_OPEN = AnkiProxy.SYMBOL_I_OPEN
+    SYMBOL_I_CLOSE = AnkiProxy.SYMBOL_I_CLOSE
+    SYMBOL_IMG_OPEN = AnkiProxy.SYMBOL_IMG_OPEN
+    SYMBOL_IMG_CLOSE = AnkiProxy.SYMBOL_IMG_CLOSE
+    SYMBOL_CLOZE_OPEN = AnkiProxy.SYMBOL_CLOZE_OPEN
+    SYMBOL_CLOZE_CLOSE = AnkiProxy.SYMBOL_CLOZE_CLOSE
+    SYMBOL_NEWLINE = AnkiProxy.SYMBOL_NEWLINE
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+
+        # Knowledge identifiers of the exported notes
+        self.exported = set()
+
+        # Media files to be exported, keyed by their absolute paths
+        self.media = dict()
+
+    def add_media_file(self, filename):
+        filename_abs = self.absolute_path(filename)
+
+        if filename_abs not in self.media:
+            self.media[filename_abs] = os.path.basename(filename_abs)
+
+        return self.media[filename_abs]
+
+    def add_note(self, deck, model, fields, tags=None):
+        return self.add_notes([dict(deck=deck, model=model, fields=fields, tags=tags)])[0]
+
+    def update_note(self, identifier, fields, deck=None, model=None, tags=None):
+        # The note is present in the SRS already
+        pass
+
+    def update_notes(self, notes):
+        # The notes are present in the SRS already
+        pass
+
+    def defer_fingerprints(self, fingerprints):
+        # The changes of the notes present in the SRS are not exported, hence
+        # they must not be considered pushed
+        super().defer_fingerprints({
+            knowledge_id: fingerprint
+            for knowledge_id, fingerprint in fingerprints.items()
+            if knowledge_id in self.exported
+        })
+
+    def get_identifiers(self):
+        return set()
+
+    def note_info(self, identifier):
+        raise KnowledgeException("Note info is not available while exporting")
+
+    def commit(self):
+        pass
+
+    def finish(self):
+        """
+        Completes the exported file.
+        """
+
+    def cleanup(self):
+        pass
+
+
+class TsvExporter(Exporter):
+    """
+    Streams the notes into a tab separated file using the headers of the
+    Anki text importer. The media files are copied into the directory
+    next to the file, to be copied into the collection.media directory.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.file.write(
+            '#separator:tab\n'
+            '#html:true\n'
+            '#notetype column:1\n'
+            '#deck column:2\n'
+            '#tags column:3\n'
+            '#guid column:4\n'
+        )
+        self.writer = csv.writer(self.file, delimiter='\t', lineterminator='\n')
+
+    def add_notes(self, notes):
+        for data in notes:
+            fields = self.process_all(data['fields'])
+            self.writer.writerow([
+                data['model'],
+                data['deck'].replace('.', '::'),
+                ' '.join(sorted(data.get('tags') or set())),
+                data.get('knowledge_id') or '',
+            ] + [
+                (value or '').replace('\t', ' ').replace('\n', self.SYMBOL_NEWLINE)
+                for value in fields.values()
+            ])
+            self.exported.add(data.get('knowledge_id'))
+            self.count += 1
+
+        # Anki assigns the ids on import, the notes are linked afterwards
+        return [
+            placeholder(data['knowledge_id']) if data.get('knowledge_id') else None
+            for data in notes
+        ]
+
+    def finish(self):
+        self.file.flush()
+
+        if self.media:
+            media_dir = os.path.splitext(self.path)[0] + '.media'
+            os.makedirs(media_dir, exist_ok=True)
+
+            for filename_abs, name in self.media.items():
+                shutil.copyfile(filename_abs, os.path.join(media_dir, name))
+
+    def cleanup(self):
+        self.file.close()
+
+
+class ApkgExporter(Exporter):
+    """
+    Streams the notes into a collection in the legacy format (schema 11),
+    packaged together with the media files at the end. The note ids are
+    assigned by the exporter, and the knowledge identifiers are used as the
+    guids of the notes.
+
+    The note types of the collection are exported with their ids and
+    modification times, so that Anki maps the imported notes to them. Only
+    the note types missing in the collection are generated.
+    """
+
+    # Keys of the exported note types missing in the newer collections
+    MODEL_DEFAULTS = {
+        'usn': -1,
+        'sortf': 0,
+        'did': 1,
+        'tags': [],
+        'vers': [],
+        'req': [[0, 'any', [0]]],
+        'css': '.card { font-family: arial; font-size: 20px; text-align: center; }',
+        'latexPre': '\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n'
+                    '\\usepackage{amssymb,amsmath}\n\\pagestyle{empty}\n'
+                    '\\setlength{\\parindent}{0in}\n\\begin{document}\n',
+        'latexPost': '\\end{document}',
+    }
+    FIELD_DEFAULTS = {'sticky': False, 'rtl': False, 'font': 'Arial', 'size': 20, 'media': []}
+    TEMPLATE_DEFAULTS = {'did': None, 'bqfmt': '', 'bafmt': ''}
+
+    SCHEMA = """
+        CREATE TABLE col (
+            id integer primary key, crt integer not null, mod integer not null,
+            scm integer not null, ver integer not null, dty integer not null,
+            usn integer not null, ls integer not null, conf text not null,
+            models text not null, decks text not null, dconf text not null,
+            tags text not null
+        );
+        CREATE TABLE notes (
+            id integer primary key, guid text not null, mid integer not null,
+            mod integer not null, usn integer not null, tags text not null,
+            flds text not null, sfld integer not null, csum integer not null,
+            flags integer not null, data text not null
+        );
+        CREATE TABLE cards (
+            id integer primary key, nid integer not null, did integer not null,
+            ord integer not null, mod integer not null, usn integer not null,
+            type integer not null, queue integer not null, due integer not null,
+            ivl integer not null, factor integer not null, reps integer not null,
+            lapses integer not null, left integer not null, odue integer not null,
+            odid integer not null, flags integer not null, data text not null
+        );
+        CREATE TABLE revlog (
+            id integer primary key, cid integer not null, usn integer not null,
+            ease integer not null, ivl integer not null, lastIvl integer not null,
+            factor integer not null, time integer not null, type integer not null
+        );
+        CREATE TABLE graves (usn integer not null, oid integer not null, type integer not null);
+        CREATE INDEX ix_notes_usn on notes (usn);
+        CREATE INDEX ix_cards_usn on cards (usn);
+        CREATE INDEX ix_revlog_usn on revlog (usn);
+        CREATE INDEX ix_cards_nid on cards (nid);
+        CREATE INDEX ix_cards_sched on cards (did, queue, due);
+        CREATE INDEX ix_revlog_cid on revlog (cid);
+        CREATE INDEX ix_notes_csum on notes (csum);
+    """
+
+    def __init__(self, path, note_types=None):
+        super().__init__(path)
+
+        # Note types of the collection, in the legacy format keyed by name
+        self.note_types = note_types or dict()
+
+        self.directory = tempfile.mkdtemp(prefix='knowledge-export-')
+        self.db = sqlite3.connect(os.path.join(self.directory, 'collection.anki2'))
+        self.db.executescript(self.SCHEMA)
+
+        # Ids are based on the current time, as in Anki
+        self.now = int(time.time())
+        self.next_id = self.now * 1000
+
+        # Models and decks used by the notes, keyed by name
+        self.models = dict()
+        self.decks = dict()
+
+    @staticmethod
+    def stable_id(name):
+        """
+        Derives the id of a model or deck from its name, so that the
+        repeated exports use the same ids.
+        """
+
+        return int(hashlib.sha1(name.encode('utf-8')).hexdigest()[:10], 16) + 1
+
+    def _model(self, name, fields):
+        """
+        Returns the model of the given name. The models generated for the
+        note types missing in the collection are extended by the given
+        fields.
+        """
+
+        if name not in self.models:
+            note_type = self.note_types.get(name)
+
+            if note_type is not None:
+                self.models[name] = {
+                    'id': note_type['id'],
+                    'name': name,
+                    'type': note_type.get('type', 0),
+                    'fields': [
+                        field['name']
+                        for field in sorted(note_type['flds'], key=lambda field: field['ord'])
+                    ],
+                    'templates': len(note_type['tmpls']),
+                    'note_type': note_type,
+                }
+            else:
+                self.models[name] = {
+                    'id': self.stable_id(f'model:{name}'),
+                    'name': name,
+                    'type': 1 if name == self.CLOSE_MODEL else 0,
+                    'fields': [],
+                    'templates': 1,
+                }
+
+        model = self.models[name]
+
+        for field in fields:
+            if field in model['fields']:
+                continue
+
+            if 'note_type' in model:
+                raise KnowledgeException(f"Field {field} not found in the model {name}")
+
+            model['fields'].append(field)
+
+        return model
+
+    def _deck(self, name):
+        name = name.replace('.', '::')
+
+        if name not in self.decks:
+            self.decks[name] = 1 if name == 'Default' else self.stable_id(f'deck:{name}')
+
+        return self.decks[name]
+
+    def _id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def add_notes(self, notes):
+        identifiers = []
+        cards = []
+        rows = []
+
+        for data in notes:
+            fields = self.process_all(data['fields'])
+            model = self._model(data['model'], fields)
+            deck_id = self._deck(data['deck'])
+            identifier = self._id()
+
+            values = [fields.get(field) or '' for field in model['fields']]
+            tags = ' '.join(sorted(data.get('tags') or set()))
+            sort_field = strip_html(values[0])
+            checksum = int(hashlib.sha1(sort_field.encode('utf-8')).hexdigest()[:8], 16)
+
+            rows.append((
+                identifier, data.get('knowledge_id') or str(identifier), model['id'],
+                self.now, -1, f' {tags} ' if tags else '', '\x1f'.join(values),
+                sort_field, checksum, 0, ''
+            ))
+
+            # The conditional templates are not evaluated, the standard
+            # notes get a card of every template
+            ords = cloze_ords(fields) if model['type'] == 1 else range(model['templates'])
+            cards.extend(
+                (self._id(), identifier, deck_id, ord, self.now, -1, 0, 0, self.count + 1,
+                 0, 0, 0, 0, 0, 0, 0, 0, '')
+                for ord in sorted(ords)
+            )
+
+            identifiers.append(str(identifier))
+            self.exported.add(data.get('knowledge_id'))
+            self.count += 1
+
+        self.db.executemany("INSERT INTO notes VALUES (?,?,?,?,?,?,?,?,?,?,?)", rows)
+        self.db.executemany("INSERT INTO cards VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", cards)
+
+        return identifiers
+
+    def _generated_note_type(self, model):
+        """
+        Returns the note type for the model missing in the collection.
+        """
+
+        if model['type'] == 1:
+            templates = [('Cloze', '{{cloze:%s}}' % model['fields'][0],
+                          '{{cloze:%s}}' % model['fields'][0])]
+        else:
+            front = '{{%s}}' % model['fields'][0]
+            back = '{{FrontSide}}<hr id=answer>' + '<br>'.join(
+                '{{%s}}' % field for field in model['fields'][1:]
+            )
+            templates = [('Card 1', front, back)]
+
+        return {
+            'id': model['id'],
+            'name': model['name'],
+            'type': model['type'],
+            'mod': self.now,
+            'flds': [
+                {'name': field, 'ord': ord}
+                for ord, field in enumerate(model['fields'])
+            ],
+            'tmpls': [
+                {'name': name, 'ord': ord, 'qfmt': qfmt, 'afmt': afmt}
+                for ord, (name, qfmt, afmt) in enumerate(templates)
+            ],
+        }
+
+    def _models_json(self):
+        models = dict()
+
+        for model in self.models.values():
+            note_type = model.get('note_type') or self._generated_note_type(model)
+
+            models[str(model['id'])] = {
+                **self.MODEL_DEFAULTS,
+                **note_type,
+                'flds': [dict(self.FIELD_DEFAULTS, **field) for field in note_type['flds']],
+                'tmpls': [dict(self.TEMPLATE_DEFAULTS, **template) for template in note_type['tmpls']],
+            }
+
+        return models
+
+    def _decks_json(self):
+        self.decks.setdefault('Default', 1)
+
+        return {
+            str(deck_id): {
+                'id': deck_id,
+                'name': name,
+                'mod': self.now,
+                'usn': -1,
+                'desc': '',
+                'dyn': 0,
+                'conf': 1,
+                'collapsed': False,
+                'browserCollapsed': False,
+                'extendNew': 0,
+                'extendRev': 0,
+                'newToday': [0, 0],
+                'revToday': [0, 0],
+                'lrnToday': [0, 0],
+                'timeToday': [0, 0],
+            }
+            for name, deck_id in self.decks.items()
+        }
+
+    def _dconf_json(self):
+        return {'1': {
+            'id': 1,
+            'name': 'Default',
+            'mod': 0,
+            'usn': 0,
+            'dyn': False,
+            'autoplay': True,
+            'timer': 0,
+            'maxTaken': 60,
+            'replayq': True,
+            'new': {'bury': False, 'delays': [1, 10], 'initialFactor': 2500,
+                    'ints': [1, 4, 0], 'order': 1, 'perDay': 20},
+            'rev': {'bury': False, 'ease4': 1.3, 'ivlFct': 1, 'maxIvl': 36500,
+                    'perDay': 200, 'hardFactor': 1.2},
+            'lapse': {'delays': [10], 'leechAction': 1, 'leechFails': 8,
+                      'minInt': 1, 'mult': 0},
+        }}
+
+    def finish(self):
+        # Notes added before their model gained more fields lack the values
+        for model in self.models.values():
+            separators = len(model['fields']) - 1
+            self.db.execute(
+                "UPDATE notes SET flds = flds || substr(?, 1, ? - "
+                "(length(flds) - length(replace(flds, char(31), '')))) WHERE mid=?",
+                ('\x1f' * separators, separators, model['id'])
+            )
+
+        conf = {
+            'activeDecks': [1], 'curDeck': 1, 'newSpread': 0, 'collapseTime': 1200,
+            'timeLim': 0, 'estTimes': True, 'dueCounts': True, 'curModel': None,
+            'nextPos': self.count + 1, 'sortType': 'noteFld', 'sortBackwards': False,
+            'addToCur': True,
+        }
+
+        self.db.execute(
+            "INSERT INTO col VALUES (1, ?, ?, ?, 11, 0, 0, 0, ?, ?, ?, ?, '{}')",
+            (self.now, self.now * 1000, self.now * 1000, json.dumps(conf),
+             json.dumps(self._models_json()), json.dumps(self._decks_json()),
+             json.dumps(self._dconf_json()))
+        )
+        self.db.commit()
+        self.db.close()
+
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED) as package:
+            package.write(os.path.join(self.directory, 'collection.anki2'), 'collection.anki2')
+
+            media = dict()
+            for index, (filename_abs, name) in enumerate(self.media.items()):
+                package.write(filename_abs, str(index))
+                media[str(index)] = name
+
+            package.writestr('media', json.dumps(media))
+
+    def cleanup(self):
+        try:
+            self.db.close()
+        except sqlite3.ProgrammingError:
+            pass
+
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,343 @@
+"""
+Keeps the changes made while the SRS is not available (e.g. its collection
+is locked by the running application) in a local journal, so that the saves
+are not lost. The changes are appended to the journal, which is replayed in
+a single batch the next time the SRS is opened, and then removed or rewritten
+with the changes left to be replayed.
+
+The journal is shared by all the editor instances. Appending and replaying
+hold an exclusive lock of the <journal>.lock file, so that the changes
+appended by another editor during a replay are not lost.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+
+from knowledge import backend, config
+from knowledge.errors import KnowledgeException, PartialAddException, SRSUnavailableException
+from knowledge.proxy import DaemonProxy, SRSProxy
+
+# Prefix of the fact ids standing in for the journaled new notes
+PLACEHOLDER_PREFIX = 'journal:'
+
+
+@contextlib.contextmanager
+def locked(path):
+    """
+    Holds the exclusive lock of the given journal. The lock is kept in a
+    separate file, since the journal itself is replaced by the replay.
+    """
+
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def placeholder(knowledge_id):
+    return PLACEHOLDER_PREFIX + knowledge_id
+
+
+def is_placeholder(fact_id):
+    return str(fact_id).startswith(PLACEHOLDER_PREFIX)
+
+
+class JournalProxy(SRSProxy):
+    """
+    Appends the added and updated notes to the journal instead of sending
+    them to the SRS. The new notes get placeholder fact ids, so that their
+    identifiers can be placed into the buffer and their subsequent updates
+    recognized.
+    """
+
+    def __init__(self, path=None):
+        provider = DaemonProxy.PROVIDERS.get(config.SRS_PROVIDER)
+
+        if provider is None:
+            raise KnowledgeException(
+                "Variable knowledge_srs_provider has to have "
+                "one of the following values: Anki, AnkiConnect, Mnemosyne, SQLite"
+            )
+
+        # The notes are created with the defaults of the actual provider
+        self.DEFAULT_DECK = provider.DEFAULT_DECK
+        self.DEFAULT_MODEL = provider.DEFAULT_MODEL
+        self.CLOSE_MODEL = provider.CLOSE_MODEL
+
+        self.path = os.path.expanduser(path or config.JOURNAL_FILE)
+        self.entries = []
+        self.count = 0
+
+    def _record(self, operation, key, data):
+        self.entries.append({
+            'operation': operation,
+            'key': key,
+            'fields': data['fields'],
+            'deck': data.get('deck'),
+            'model': data.get('model'),
+            'tags': sorted(data.get('tags') or []),
+            'base_dir': self.relative_base_dir(),
+        })
+
+    def add_notes(self, notes):
+        for data in notes:
+            self._record('add', data['knowledge_id'], data)
+
+        return [placeholder(data['knowledge_id']) for data in notes]
+
+    def update_notes(self, notes):
+        for data in notes:
+            self._record('update', data['identifier'], data)
+
+    def embed_identifiers(self, identifiers):
+        raise SRSUnavailableException(
+            "The SRS is not available, the identifiers can be embedded once it is"
+        )
+
+    def prepare_decks(self, decks):
+        # Created when the journal is replayed
+        pass
+
+    def commit(self):
+        """
+        Appends the recorded changes to the journal.
+        """
+
+        if not self.entries:
+            return
+
+        with locked(self.path):
+            _append(self.path, self.entries)
+
+        self.count += len(self.entries)
+        self.entries = []
+
+    def cleanup(self):
+        # Changes that were not committed are discarded, as with the SRS
+        self.entries = []
+
+
+def load(path=None):
+    """
+    Returns the journaled changes with the superseded ones collapsed, in the
+    order of their first appearance. The updates of a journaled new note are
+    folded into the note itself.
+    """
+
+    path = os.path.expanduser(path or config.JOURNAL_FILE)
+    collapsed = dict()
+
+    if not os.path.exists(path):
+        return []
+
+    with open(path, encoding='utf-8') as journal:
+        for line in journal:
+            # A partially written last line is left over by an interrupted write
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+
+            # The update of a journaled new note carries all its data, and
+            # can be added in case the note itself is not in the journal
+            if entry['key'].startswith(PLACEHOLDER_PREFIX):
+                entry['operation'] = 'add'
+                entry['key'] = entry['key'][len(PLACEHOLDER_PREFIX):]
+
+            key = entry['key']
+            if entry['operation'] == 'add':
+                key = placeholder(key)
+
+            collapsed[key] = entry
+
+    return list(collapsed.values())
+
+
+def replay(proxy, path=None):
+    """
+    Submits the journaled changes to the given proxy in a single batch per
+    base directory and commits them at once. The placeholder mappings are
+    then pointed to the obtained fact ids and the journal removed.
+
+    The changes rejected by the SRS (e.g. the updates of the notes deleted
+    meanwhile) are moved into the <journal>.failed file, and the journaled
+    new notes among them are added again by the next sync. If the replay
+    is interrupted, the changes submitted so far are committed as well, and
+    only the rest is kept in the journal.
+    """
+
+    path = os.path.expanduser(path or config.JOURNAL_FILE)
+
+    # Quick check without waiting for the editors appending to the journal
+    if not os.path.exists(path):
+        return 0
+
+    with locked(path):
+        return _replay(proxy, path)
+
+
+def _replay(proxy, path):
+    entries = load(path)
+
+    if not entries:
+        return 0
+
+    batches = dict()
+    for entry in entries:
+        batches.setdefault(entry['base_dir'], []).append(entry)
+
+    fact_ids = dict()
+    done = []
+    failed = []
+    base_dir = proxy.base_dir
+
+    try:
+        for batch_dir, batch in batches.items():
+            proxy.base_dir = batch_dir
+
+            proxy.prepare_decks(set(
+                entry['deck']
+                for entry in batch
+                if entry['deck'] is not None
+            ))
+
+            updated = [entry for entry in batch if entry['operation'] == 'update']
+            _update(proxy, updated, done, failed)
+
+            added = [entry for entry in batch if entry['operation'] == 'add']
+            _add(proxy, added, fact_ids, done, failed)
+    finally:
+        proxy.base_dir = base_dir
+
+        # Most of the SRS keep the submitted changes even if not committed,
+        # hence they must not stay in the journal
+        if done or failed:
+            proxy.commit()
+
+            # Mappings might have been removed meanwhile, e.g. by a rollback
+            existing = backend.get_many(fact_ids)
+            backend.set_fact_ids({
+                knowledge_id: fact_id
+                for knowledge_id, fact_id in fact_ids.items()
+                if knowledge_id in existing
+            })
+
+            _append(path + '.failed', [
+                dict(entry, error=error)
+                for entry, error in failed
+            ])
+
+            handled = set(id(entry) for entry in done)
+            handled.update(id(entry) for entry, error in failed)
+            _rewrite(path, [entry for entry in entries if id(entry) not in handled])
+
+    return len(done)
+
+
+def _note(entry):
+    return dict(
+        fields=entry['fields'],
+        deck=entry['deck'],
+        model=entry['model'],
+        tags=set(entry['tags']),
+    )
+
+
+def _update(proxy, entries, done, failed):
+    """
+    Submits the given updates. If the SRS rejects them, they are submitted
+    one by one, so that only the rejected ones are recorded as failed.
+    """
+
+    if not entries:
+        return
+
+    try:
+        proxy.update_notes([
+            dict(_note(entry), identifier=entry['key'])
+            for entry in entries
+        ])
+    except SRSUnavailableException:
+        raise
+    except KnowledgeException as e:
+        if len(entries) == 1:
+            failed.append((entries[0], str(e)))
+            return
+
+        # Applying an update again does not change anything
+        for entry in entries:
+            _update(proxy, [entry], done, failed)
+
+        return
+
+    done.extend(entries)
+
+
+def _add(proxy, entries, fact_ids, done, failed):
+    """
+    Submits the given new notes, recording their fact ids. The notes not
+    added due to a failure are submitted one by one, so that only the
+    rejected ones are recorded as failed, and their mappings removed.
+    """
+
+    if not entries:
+        return
+
+    error = None
+
+    try:
+        obtained_ids = proxy.add_notes([
+            dict(_note(entry), knowledge_id=entry['key'])
+            for entry in entries
+        ])
+    except PartialAddException as e:
+        obtained_ids, error = e.identifiers, e
+    except SRSUnavailableException:
+        raise
+    except KnowledgeException as e:
+        obtained_ids, error = [None] * len(entries), e
+
+    remaining = []
+    for entry, obtained_id in zip(entries, obtained_ids):
+        if obtained_id or error is None:
+            # Notes that could not be added are added again by the next sync
+            fact_ids[entry['key']] = obtained_id or None
+            done.append(entry)
+        else:
+            remaining.append(entry)
+
+    if len(entries) == 1 and remaining:
+        fact_ids[entries[0]['key']] = None
+        failed.append((entries[0], str(error)))
+        return
+
+    for entry in remaining:
+        _add(proxy, [entry], fact_ids, done, failed)
+
+
+def _append(path, entries):
+    if entries:
+        with open(path, 'a', encoding='utf-8') as journal:
+            journal.writelines(json.dumps(entry) + '\n' for entry in entries)
+
+
+def _rewrite(path, entries):
+    """
+    Replaces the journal by the given entries, or removes it if there are
+    none left.
+    """
+
+    if not entries:
+        os.remove(path)
+        return
+
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as journal:
+        journal.writelines(json.dumps(entry) + '\n' for entry in entries)
+
+    os.replace(temporary, path)
@@ -1,4 +1,5 @@
 from __future__ import print_function
+import collections
 import contextlib
 import datetime
 import functools
@@ -10,6 +11,7 @@ import re
 import shlex
 import sys
 import tempfile
+import time
 import uuid
 import vim
 from pathlib import Path
@@ -24,28 +26,43 @@ sys.path.insert(0, KNOWLEDGE_BASE_DIR)
 import knowledge as k
 # TODO: Make these imports lazy
 import knowledge.regexp
+import knowledge.background
 import knowledge.backend
+import knowledge.cache
 import knowledge.conversion
-
-from knowledge.proxy import AnkiProxy, MnemosyneProxy
+import knowledge.export
+import knowledge.journal
+import knowledge.session
+import knowledge.tokenizer
+import knowledge.tracking
+
+import knowledge.proxy
+import knowledge.queries
 from knowledge.wikinote import WikiNote, Header
 
 
 def get_proxy():
-    if k.config.SRS_PROVIDER == 'Anki':
-        return AnkiProxy(k.config.SRS_DB)
-    elif k.config.SRS_PROVIDER == 'Mnemosyne':
-        return MnemosyneProxy(os.path.dirname(k.config.SRS_DB))
-    elif k.config.SRS_PROVIDER is None:
-        raise k.errors.KnowledgeException(
-            "Variable knowledge_srs_provider has to have "
-            "one of the following values: Anki, Mnemosyne"
-        )
-    else:
-        raise k.errors.KnowledgeException(
-            "SRS provider '{0}' is not supported."
-            .format(config.SRS_PROVIDER)
-        )
+    """
+    Opens the proxy of the configured SRS provider. With the offline journal
+    enabled, the changes are journaled while the SRS is unavailable, and the
+    journal is replayed once it is available again.
+    """
+
+    if not k.config.OFFLINE_JOURNAL:
+        return k.proxy.get_proxy()
+
+    try:
+        proxy = k.proxy.get_proxy()
+    except k.errors.SRSUnavailableException:
+        return k.journal.JournalProxy()
+
+    try:
+        k.journal.replay(proxy)
+    except BaseException:
+        proxy.cleanup()
+        raise
+
+    return proxy
 
 
 class HeaderStack(object):
@@ -106,23 +123,100 @@ class HeaderStack(object):
             model = self.headers[key].data.get('model')
             if model is not None: return model
 
+    @property
+    def context(self):
+        """
+        A hashable summary of the metadata inherited by the notes.
+        """
+
+        return (self.heading, tuple(sorted(self.tags)), self.deck, self.model)
+
 class BufferProxy(object):
 
-    def __init__(self, buffer_object):
+    def __init__(self, buffer_object, path=None):
         self.object = buffer_object
 
+        # File the lines belong to, vim buffers know their own
+        self.path = getattr(buffer_object, 'name', None) or path
+
     def obtain(self):
         self.data = [line for line in self.object[:]]
+        self._boundaries = None
+
+        # Numbers of the modified lines, None if the number of lines changed
+        self.modified = set()
 
     def push(self):
-        self.object[:] = self.data
+        if self.modified is None:
+            self.object[:] = self.data
+        else:
+            # Write out only the ranges of the modified lines
+            for start, end in self.modified_ranges():
+                self.object[start:end] = self.data[start:end]
+
+        self.modified = set()
+
+    def modified_ranges(self):
+        """
+        Returns the list of (start, end) ranges covering the modified lines,
+        with the adjacent lines coalesced into a single range.
+        """
+
+        ranges = []
+
+        for number in sorted(self.modified):
+            if ranges and ranges[-1][1] == number:
+                ranges[-1][1] = number + 1
+            else:
+                ranges.append([number, number + 1])
+
+        return [tuple(pair) for pair in ranges]
+
+    @property
+    def boundaries(self):
+        """
+        Paragraph and list item boundaries, computed once per obtained buffer.
+        """
+
+        if self._boundaries is None:
+            self._boundaries = k.tokenizer.BoundaryIndex(self.data)
+
+        return self._boundaries
 
     def __getitem__(self, index):
         return self.data[index]
 
     def __setitem__(self, index, lines):
+        # Rebuild the index only if the modification affects the boundaries
+        if not k.tokenizer.BoundaryIndex.preserved(self.data[index], lines):
+            self._boundaries = None
+
+        self.track(index, lines)
         self.data[index] = lines
 
+    def track(self, index, lines):
+        """
+        Records the numbers of the lines modified by the given assignment.
+        """
+
+        if self.modified is None:
+            return
+
+        if isinstance(index, slice):
+            numbers = range(*index.indices(len(self.data)))
+
+            if len(numbers) != len(lines):
+                self.modified = None
+                return
+
+            self.modified.update(
+                number
+                for number, line in zip(numbers, lines)
+                if self.data[number] != line
+            )
+        elif self.data[index] != lines:
+            self.modified.add(index % len(self.data))
+
     def __iter__(self):
         for line in self.data:
             yield line
@@ -132,54 +226,765 @@ class BufferProxy(object):
 
 
 @contextlib.contextmanager
-def autodeleted_proxy():
-    proxy = get_proxy()
+def autodeleted_proxy(reuse=True):
+    """
+    Provides a proxy to the SRS, which is cleaned up once it is no longer
+    needed. With an idle timeout configured, the proxy is instead kept open
+    for the subsequent uses, unless reuse is disabled (e.g. in the worker
+    threads).
+    """
+
+    if not (reuse and k.config.PROXY_IDLE_MS):
+        proxy = get_proxy()
+        try:
+            yield proxy
+        finally:
+            proxy.cleanup()
+
+        # The worker threads must not interact with vim
+        if reuse:
+            report_journaled(proxy)
+
+        del proxy
+        return
+
+    proxy = k.session.acquire(get_proxy)
     try:
         yield proxy
+    except BaseException:
+        # Do not reuse the proxy after a failed operation. Closing it does
+        # not discard the changes, Anki and Mnemosyne save them on cleanup
+        k.session.close()
+        raise
+
+    # Try to reach the SRS again on the next use
+    if isinstance(proxy, k.journal.JournalProxy):
+        k.session.close()
+        report_journaled(proxy)
+    else:
+        k.session.release(k.config.PROXY_IDLE_MS)
+
+
+def commit_changes(srs_proxy):
+    """
+    Commits the changes sent to the SRS, and only then stores the
+    fingerprints of the notes, so that the notes are pushed again if the
+    commit fails.
+    """
+
+    srs_proxy.commit()
+    k.backend.set_fingerprints(srs_proxy.take_fingerprints())
+
+
+def report_journaled(proxy):
+    """
+    Lets the user know that the changes were journaled instead of being sent
+    to the SRS.
+    """
+
+    if isinstance(proxy, k.journal.JournalProxy) and proxy.count:
+        print(
+            f"The SRS is not available, {proxy.count} changes were journaled "
+            "and will be sent to it on the next save"
+        )
+
+
+@contextlib.contextmanager
+def readonly_collection():
+    """
+    Provides the read-only access to the SRS collection, for the lookups
+    that do not need to open the full proxy.
+    """
+
+    queries = k.queries.get_queries()
+    try:
+        yield queries
     finally:
-        proxy.cleanup()
-        del proxy
+        queries.cleanup()
+
+
+def header_subtree(buffer_proxy, number):
+    """
+    Returns the [start, end) range of the lines under the header the given
+    line belongs to, including its subheaders. The lines above the first
+    header belong to the whole buffer.
+    """
+
+    start, level = 0, 0
+
+    for candidate in range(number, -1, -1):
+        kind, match = k.tokenizer.classify(buffer_proxy[candidate])
+        if kind == k.tokenizer.HEADER:
+            start, level = candidate, len(match.group('header_start'))
+            break
+
+    for candidate in range(start + 1, len(buffer_proxy)):
+        kind, match = k.tokenizer.classify(buffer_proxy[candidate])
+        if kind == k.tokenizer.HEADER and len(match.group('header_start')) <= level:
+            return start, candidate
+
+    return start, len(buffer_proxy)
+
+
+def sync_buffer(buffer_proxy, srs_proxy, cache=None, budget=None, cursor=0, tracker=None, lines=None):
+    """
+    Creates or updates the notes in the given obtained buffer proxy. The
+    changes need to be committed by the caller. Returns the cache of the
+    synchronized blocks, the number of the notes that were left
+    unsynchronized and the (line, text) pairs of the header lines.
+
+    The blocks found in the given cache did not change since the last sync
+    and are skipped altogether, as well as the notes the given change
+    tracker knows to be unmodified.
+
+    All the notes are parsed first and then submitted to the SRS in a single
+    batch. If a time budget (in seconds) is given, the notes are instead saved
+    one by one in the order of their distance from the cursor line, until the
+    budget runs out. With checkpoints configured, the notes saved so far are
+    committed at every checkpoint, see Checkpoints.
+
+    If a [start, end) range of lines is given, only the notes in the lists
+    overlapping the range are synchronized. The headers above the range are
+    still pushed to provide the metadata, but the notes in between are not
+    parsed, hence the headers are assumed not to be consumed by those notes.
+    """
+
+    deadline = time.monotonic() + budget if budget else None
+    synced = k.cache.BlockCache()
+    stack = HeaderStack()
+    deferred = []
+
+    start, end = 0, len(buffer_proxy)
+
+    if lines is not None and len(buffer_proxy) > 0:
+        # Notes do not span over the list boundaries, extend the range to
+        # the whole lists so that no note is cut in half
+        boundaries = buffer_proxy.boundaries
+        first = min(max(lines[0], 0), len(buffer_proxy) - 1)
+        last = min(max(lines[1], first + 1), len(buffer_proxy)) - 1
+        start = min(boundaries.list_start[first], first)
+        end = max(boundaries.list_end[last], last) + 1
+
+        for number in range(start):
+            kind, match = k.tokenizer.classify(buffer_proxy[number])
+            if kind == k.tokenizer.HEADER:
+                stack.push(Header.from_match(match))
+
+    # Headers pushed so far, to be remembered by the tracker
+    headers = []
+
+    # Lists untouched since the last sync can be skipped, unless headers
+    # were modified, affecting the metadata of the notes
+    tracked = tracker is not None and tracker.usable(buffer_proxy)
+    pushed = set(tracker.headers) if tracked else set()
+
+    def save(entries):
+        blocks = []
+        for note, line_number, processed, context in entries:
+            offset, size = note.block(line_number)
+            start = line_number - offset
+            blocks.append((start, buffer_proxy[start:start+size]))
+
+        WikiNote.save_all([entry[0] for entry in entries])
+
+        # Blocks that had their identifier placed are parsed again
+        # next time, since the identifier is a part of the block
+        for (note, line_number, processed, context), (start, lines) in zip(entries, blocks):
+            if buffer_proxy[start:start+len(lines)] == lines:
+                offset = line_number - start
+                synced.record(buffer_proxy, line_number, offset, len(lines), processed, context)
+
+    # Process each block, skipping over the lines
+    # that were consumed by the preceding note
+    next_line = start
+    for block in k.tokenizer.tokenize(buffer_proxy, start, end):
+        line_number = block.line
+        if line_number < next_line or block.kind == k.tokenizer.PLAIN:
+            continue
+
+        if block.kind == k.tokenizer.HEADER:
+            header = (line_number, buffer_proxy[line_number])
+
+            # Headers in the untouched lists might be consumed by the skipped
+            # notes, push them only if they were pushed by the last sync
+            if tracked and header not in pushed:
+                continue
+
+            headers.append(header)
+            stack.push(Header.from_match(block.match))
+            next_line = line_number + 1
+            continue
+
+        # Skip over the notes in the lists untouched since the last sync
+        if tracked and tracker.clean(buffer_proxy, line_number):
+            continue
+
+        # Skip over the blocks that were not modified since the last sync
+        if cache is not None:
+            span = cache.lookup(buffer_proxy, line_number, stack.context)
+            if span is not None:
+                offset, size, processed = span
+                synced.record(buffer_proxy, line_number, offset, size, processed, stack.context)
+                next_line = line_number + processed
+                continue
+
+        note, processed = WikiNote.from_block(
+            buffer_proxy,
+            block,
+            srs_proxy,
+            heading=stack.heading,
+            tags=stack.tags,
+            deck=stack.deck,
+            model=stack.model,
+        )
+
+        deferred.append((note, line_number, processed, stack.context))
+        next_line = line_number + processed
+
+    pending = 0
+    checkpoints = Checkpoints(srs_proxy, k.config.CHECKPOINT_NOTES, k.config.CHECKPOINT_MS)
+
+    if deadline is None:
+        # Submit all the notes to the SRS at once, or in chunks between the
+        # checkpoints
+        size = checkpoints.size or len(deferred) or 1
+        batches = [deferred[index:index+size] for index in range(0, len(deferred), size)]
+    else:
+        # Save the notes closest to the cursor first, at least one per sync
+        deferred.sort(key=lambda entry: abs(entry[1] - cursor))
+        batches = [[entry] for entry in deferred]
+
+    batches = collections.deque(batches)
+    saved = 0
+
+    while batches and not pending:
+        with checkpoints.window():
+            while batches:
+                if saved > 0 and deadline is not None and time.monotonic() > deadline:
+                    pending = len(batches)
+                    break
+
+                batch = batches.popleft()
+                save(batch)
+                saved += len(batch)
+
+                if checkpoints.reached(len(batch)):
+                    break
+
+    return synced, pending, headers
+
+
+class Checkpoints(object):
+    """
+    Commits the SRS together with the mapping store every given number of
+    notes or milliseconds during a sync, so that an interrupted sync keeps
+    the notes saved before the last checkpoint. Such notes are recognized
+    by their fingerprints on the next sync, which only places their
+    identifiers. Checkpointing is disabled unless either limit is given.
+    """
+
+    # Notes submitted to the SRS at once when checkpointing by time only
+    CHUNK_SIZE = 50
+
+    def __init__(self, srs_proxy, notes=0, interval_ms=0):
+        self.srs_proxy = srs_proxy
+        self.notes = notes
+        self.interval = interval_ms / 1000
+        self.enabled = bool(notes or interval_ms)
+        self.size = (notes or self.CHUNK_SIZE) if self.enabled else None
+
+    @contextlib.contextmanager
+    def window(self):
+        """
+        Groups the notes saved until the next checkpoint into a single
+        transaction of the mapping store, which is committed after the SRS,
+        so that no mapping refers to an uncommitted note.
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        self.saved = 0
+        self.started = time.monotonic()
+        failure = None
+
+        with k.backend.transaction():
+            try:
+                yield
+            except k.errors.PartialAddException as e:
+                # The SRS keeps the notes added before the failure, keep
+                # their mappings as well
+                failure = e
+
+            commit_changes(self.srs_proxy)
+
+        if failure is not None:
+            raise failure
+
+    def reached(self, count):
+        """
+        Records the given number of saved notes, returns whether the
+        checkpoint was reached.
+        """
+
+        if not self.enabled:
+            return False
+
+        self.saved += count
+
+        return bool(
+            self.notes and self.saved >= self.notes or
+            self.interval and time.monotonic() - self.started >= self.interval
+        )
+
+
+class BufferSync(object):
+    """
+    Synchronization of a single vim buffer, keeping track of the state
+    preserved between the syncs of the buffer: the incremental cache, the
+    change tracker and the notes left over by the time budget.
+
+    The sync can be limited to a [start, end) range of lines, or to the
+    header subtree the cursor is located in. Such a partial sync leaves the
+    state of the rest of the buffer as it was.
+    """
+
+    def __init__(self, buffer, lines=None, subtree=False):
+        self.buffer = buffer
+        self.number = buffer.number
+        self.lines = lines
+        self.subtree = subtree
+        self.partial = lines is not None or subtree
+
+        self.budget = None
+        if k.config.SYNC_BUDGET_MS and not self.partial:
+            self.budget = k.config.SYNC_BUDGET_MS / 1000
+
+        self.incremental = k.config.INCREMENTAL_SYNC or k.config.SYNC_BUDGET_MS
+        self.cache = k.cache.BLOCK_CACHES.get(self.number) if self.incremental else None
+
+        self.tracker = None
+        if k.config.TRACK_CHANGES and not self.partial:
+            self.tracker = k.tracking.TRACKERS.get(self.number)
+
+    def sync(self, srs_proxy, cursor=0):
+        """
+        Creates or updates the notes of the buffer, without committing them.
+        """
+
+        if self.tracker is not None:
+            self.tracker.update()
+
+        self.buffer_proxy = BufferProxy(self.buffer)
+        self.buffer_proxy.obtain()
+
+        if self.subtree and len(self.buffer_proxy) > 0:
+            self.lines = header_subtree(self.buffer_proxy, cursor)
+
+        self.synced, self.pending, self.headers = sync_buffer(
+            self.buffer_proxy,
+            srs_proxy,
+            self.cache,
+            budget=self.budget,
+            cursor=cursor,
+            tracker=self.tracker,
+            lines=self.lines,
+        )
+
+    def finish(self):
+        """
+        Displays the changes in the buffer, once the notes are committed.
+        """
+
+        self.buffer_proxy.push()
+
+        # Notes left over by the budget are not tracked, sync the whole buffer
+        if self.tracker is not None:
+            if self.pending:
+                self.tracker.invalidate()
+            else:
+                self.tracker.reset(self.headers)
+
+        if self.incremental:
+            # Keep the blocks skipped thanks to the tracker or outside of
+            # the synchronized range
+            if (self.tracker is not None or self.partial) and self.cache is not None:
+                self.synced.merge(self.cache)
+
+            k.cache.BLOCK_CACHES[self.number] = self.synced
+
+        # The leftover notes of the budget might lie outside of the range
+        if self.partial:
+            return
+
+        if self.pending:
+            k.cache.PENDING_NOTES[self.number] = self.pending
+        else:
+            k.cache.PENDING_NOTES.pop(self.number, None)
+            forget_checkpoints(self.buffer_proxy.path)
+
+
+def forget_checkpoints(path):
+    """
+    Forgets the checkpoints of the given file, once all its notes are saved
+    and their identifiers placed.
+    """
+
+    if k.config.CHECKPOINT_NOTES or k.config.CHECKPOINT_MS:
+        k.backend.clear_checkpoints(path)
 
 
 @k.errors.pretty_exception_handler
-def create_notes():
+def create_notes(lines=None, subtree=False):
     """
     Loops over current buffer and adds any new notes to Anki.
+
+    The sync can be limited to the given [start, end) range of lines, or to
+    the notes under the header the cursor is located in (including its
+    subheaders). Such syncs are always performed immediately.
+
+    In the incremental mode, the blocks that did not change since the last
+    successful sync of the buffer are skipped altogether. In the asynchronous
+    mode, the sync is performed in the background, if the SRS allows it.
+
+    With a time budget set, the notes that could not be synchronized within
+    the budget are left for the next sync, which skips the already
+    synchronized blocks as in the incremental mode.
+
+    With a debounce delay set, the sync is postponed until no other buffer
+    was saved for the given delay, and all the saved buffers are then
+    synchronized together.
     """
 
-    with autodeleted_proxy() as srs_proxy:
-        buffer_proxy = BufferProxy(vim.current.buffer)
-        buffer_proxy.obtain()
-        stack = HeaderStack()
-
-        # Process each line, skipping over the lines
-        # that can be ignored
-        line_number = 0
-        while line_number < len(buffer_proxy):
-            note, processed = WikiNote.from_line(
-                buffer_proxy,
-                line_number,
-                srs_proxy,
-                heading=stack.heading,
-                tags=stack.tags,
-                deck=stack.deck,
-                model=stack.model,
-            )
+    partial = lines is not None or subtree
 
-            if note is None:
-                header, processed = Header.from_line(buffer_proxy, line_number)
-                if header is not None:
-                    stack.push(header)
-            else:
-                note.save()
+    if k.config.SYNC_DEBOUNCE_MS and not partial:
+        schedule_sync()
+        return
 
-            line_number += processed
+    if k.config.ASYNC_SYNC and not partial and background_sync_supported():
+        start_background_sync()
+        return
+
+    buffer_sync = BufferSync(vim.current.buffer, lines=lines, subtree=subtree)
+
+    with autodeleted_proxy() as srs_proxy:
+        buffer_sync.sync(srs_proxy, cursor=k.vimutils.get_current_line_number())
 
         # Make sure changes are saved in the db
-        srs_proxy.commit()
+        commit_changes(srs_proxy)
 
         # Display the changes in the buffer
-        buffer_proxy.push()
+        buffer_sync.finish()
+
+
+def schedule_sync():
+    """
+    Schedules the sync of the current buffer, postponing the scheduled syncs
+    of the other buffers, so that they can be synchronized together.
+    """
+
+    k.background.SCHEDULED.add(vim.current.buffer.number)
+    start_debounce_timer()
+
+
+def start_debounce_timer():
+    """
+    (Re)starts the timer flushing the scheduled syncs.
+    """
+
+    if k.background.DEBOUNCE_TIMER is not None:
+        vim.command(f'call timer_stop({k.background.DEBOUNCE_TIMER})')
+
+    k.background.DEBOUNCE_TIMER = vim.eval(
+        f"timer_start({k.config.SYNC_DEBOUNCE_MS}, 'KnowledgeSyncFlush')"
+    )
+
+
+def buffer_base_dir(number):
+    """
+    Returns the directory of the file loaded in the given buffer.
+    """
+
+    return os.path.dirname(vim.eval(f'fnamemodify(bufname({number}), ":p")'))
+
+
+@k.errors.pretty_exception_handler
+def flush_scheduled_syncs(write=False):
+    """
+    Synchronizes all the scheduled buffers using a single SRS session and
+    a single commit. Saves the buffers that have no other unsaved changes,
+    or all of them if write is set.
+
+    If a buffer fails to sync, the buffers synced before it are committed
+    and saved nevertheless, the ones after it stay scheduled.
+    """
+
+    numbers = sorted(k.background.SCHEDULED)
+    k.background.DEBOUNCE_TIMER = None
+
+    buffer_syncs = []
+    for number in numbers:
+        try:
+            buffer_syncs.append(BufferSync(vim.buffers[number]))
+        except KeyError:
+            k.background.SCHEDULED.discard(number)
+
+    if not buffer_syncs:
+        return
+
+    modified = {
+        buffer_sync.number: vim.eval(f'getbufvar({buffer_sync.number}, "&modified")') == '1'
+        for buffer_sync in buffer_syncs
+    }
+
+    synced = []
+    finished = []
+
+    try:
+        with autodeleted_proxy() as srs_proxy:
+            failure = None
+
+            for buffer_sync in buffer_syncs:
+                cursor = 0
+                if buffer_sync.number == vim.current.buffer.number:
+                    cursor = k.vimutils.get_current_line_number()
+
+                srs_proxy.base_dir = buffer_base_dir(buffer_sync.number)
+
+                try:
+                    buffer_sync.sync(srs_proxy, cursor=cursor)
+                except BaseException as e:
+                    failure = buffer_sync, e
+                    break
+                finally:
+                    srs_proxy.base_dir = None
+
+                synced.append(buffer_sync)
+
+            # Make sure changes are saved in the db, including the ones of
+            # the buffers synced before a failure, which the SRS keeps anyway
+            if synced:
+                commit_changes(srs_proxy)
+                k.background.SCHEDULED.difference_update(
+                    buffer_sync.number for buffer_sync in synced
+                )
+
+            for buffer_sync in synced:
+                buffer_sync.finish()
+                finished.append(buffer_sync)
+
+            if failure is not None:
+                # The failing buffer is synced again once it is saved, the
+                # rest of the batch stays scheduled
+                buffer_sync, error = failure
+                k.background.SCHEDULED.discard(buffer_sync.number)
+                if k.background.SCHEDULED:
+                    start_debounce_timer()
+
+                raise error
+    finally:
+        for buffer_sync in finished:
+            if write or not modified[buffer_sync.number]:
+                save_buffer(buffer_sync.number, force=write)
+
+
+def save_buffer(number, force=False):
+    """
+    Writes the given buffer without triggering another sync. Buffers not
+    displayed in any window are written only if force is set.
+    """
+
+    if vim.eval(f'getbufvar({number}, "&modified")') != '1':
+        return
+
+    window = vim.eval(f'bufwinid({number})')
+
+    if window != '-1':
+        vim.command(f"call win_execute({window}, 'silent noautocmd update')")
+    elif force:
+        vim.command(f'silent noautocmd {number}bufdo update')
+
+
+@k.errors.pretty_exception_handler
+def resume_notes():
+    """
+    Synchronizes the notes left over by the time-budgeted sync of the
+    current buffer, if any.
+    """
+
+    if not k.cache.PENDING_NOTES.get(vim.current.buffer.number):
+        return
+
+    modified = vim.eval('&modified') == '1'
+
+    create_notes()
+
+    # Save the placed identifiers, unless there are other unsaved changes
+    if not modified and vim.eval('&modified') == '1':
+        vim.command('silent noautocmd update')
+
+
+def track_changes():
+    """
+    Starts tracking the modified lines of the current buffer, if enabled.
+    """
+
+    if k.config.TRACK_CHANGES:
+        k.tracking.attach(vim.current.buffer.number)
+
+
+def close_idle_proxy():
+    """
+    Closes the SRS proxy kept open between the syncs, so that the SRS
+    application can access the collection again.
+    """
+
+    k.session.close()
+
+
+def background_sync_supported():
+    """
+    Determines whether the SRS can be updated from a worker thread. Anki
+    changes the working directory of the process, which would change the
+    one of vim while the user keeps editing, hence it is used from the main
+    thread, unless it is opened by the daemon in its own process.
+    """
+
+    if k.config.SRS_DAEMON:
+        return True
+
+    provider = k.proxy.DaemonProxy.PROVIDERS.get(k.config.SRS_PROVIDER)
+    return provider is not None and not provider.CHANGES_CWD
+
+
+def start_background_sync(buffer_number=None):
+    """
+    Synchronizes a snapshot of the given buffer (defaults to the current one)
+    in a worker thread. The identifiers of the new notes are placed into the
+    buffer by poll_background_sync, once the sync is finished.
+    """
+
+    buffer = vim.buffers[buffer_number] if buffer_number else vim.current.buffer
+
+    # Only one sync per buffer can run at a time, sync again once it finishes
+    job = k.background.JOBS.get(buffer.number)
+    if job is not None:
+        job.outdated = True
+        return
+
+    cache = k.cache.BLOCK_CACHES.get(buffer.number) if k.config.INCREMENTAL_SYNC else None
+    base_dir = buffer_base_dir(buffer.number)
+    path = buffer.name
+
+    # The worker opens its own proxy, the SRS might not allow two of them
+    k.session.close()
+
+    # Executed in the worker thread, hence must not interact with vim
+    def target(lines):
+        with autodeleted_proxy(reuse=False) as srs_proxy:
+            srs_proxy.base_dir = base_dir
+            buffer_proxy = BufferProxy(lines, path=path)
+            buffer_proxy.obtain()
+
+            synced, pending, headers = sync_buffer(buffer_proxy, srs_proxy, cache)
+            commit_changes(srs_proxy)
+            buffer_proxy.push()
+
+        return lines, synced
+
+    k.background.SyncJob(buffer.number, buffer[:], target).start()
+
+    if k.background.TIMER is None:
+        k.background.TIMER = vim.eval(
+            f"timer_start({k.config.ASYNC_POLL_INTERVAL}, "
+            "'KnowledgeSyncPoll', {'repeat': -1})"
+        )
+
+
+def poll_background_sync():
+    """
+    Applies the results of the finished background syncs to their buffers.
+    """
+
+    jobs = k.background.finished_jobs()
+
+    if not k.background.JOBS and k.background.TIMER is not None:
+        vim.command(f'call timer_stop({k.background.TIMER})')
+        k.background.TIMER = None
+
+    for job in jobs:
+        apply_background_sync(job)
+
+
+def finish_background_sync():
+    """
+    Waits for all the background syncs to finish and applies their results,
+    saving the affected buffers. Used when vim is about to exit.
+    """
+
+    if k.background.SCHEDULED:
+        flush_scheduled_syncs(write=True)
+
+    while k.background.JOBS:
+        for job in list(k.background.JOBS.values()):
+            job.thread.join()
+
+        for job in k.background.finished_jobs():
+            apply_background_sync(job, write=True)
+
+
+@k.errors.pretty_exception_handler
+def apply_background_sync(job, write=False):
+    """
+    Places the identifiers obtained by the given finished job into its buffer,
+    taking the edits performed during the sync into account.
+
+    The buffer is saved if it was not modified meanwhile and it is the current
+    buffer, or if write is set.
+    """
+
+    try:
+        buffer = vim.buffers[job.buffer_number]
+    except KeyError:
+        return
+
+    if job.error is not None:
+        k.cache.BLOCK_CACHES.pop(buffer.number, None)
+        raise job.error
+
+    modified = vim.eval(f'getbufvar({buffer.number}, "&modified")') == '1'
+    updates, conflicts = job.reconcile(buffer[:])
+
+    # Modify only the affected lines to preserve the cursor and the marks
+    for number, line in updates.items():
+        buffer[number] = line
+
+    # Blocks with unplaced identifiers need to be parsed again
+    if k.config.INCREMENTAL_SYNC and not conflicts:
+        k.cache.BLOCK_CACHES[buffer.number] = job.result
+    else:
+        k.cache.BLOCK_CACHES.pop(buffer.number, None)
+
+    # The unplaced identifiers are placed by the next sync
+    if not conflicts:
+        forget_checkpoints(buffer.name)
+
+    # Save the placed identifiers, unless there are other unsaved changes
+    if write or not modified:
+        save_buffer(buffer.number, force=write)
+
+    if job.outdated:
+        start_background_sync(buffer.number)
+
+    if conflicts:
+        raise k.errors.KnowledgeException(
+            "Identifiers of the notes on the following lines (as numbered when "
+            "saved) could not be placed, since the lines were modified during "
+            "the sync: {0}"
+            .format(', '.join(str(number + 1) for number in conflicts))
+        )
 
 
 @k.errors.pretty_exception_handler
@@ -187,18 +992,29 @@ def note_info():
     buffer_proxy = BufferProxy(vim.current.buffer)
     buffer_proxy.obtain()
 
-    with autodeleted_proxy() as srs_proxy:
+    with readonly_collection() as srs_queries:
         note, processed = WikiNote.from_line(
             buffer_proxy,
             k.vimutils.get_current_line_number(),
-            srs_proxy,
+            srs_queries,
             heading=None,
             tags=None,
             deck=None,
             model=None,
         )
 
-        data = srs_proxy.note_info(note.proxy_id)
+        if k.journal.is_placeholder(note.proxy_id):
+            raise k.errors.KnowledgeException(
+                "The note is journaled and was not sent to the SRS yet"
+            )
+
+        if k.export.is_placeholder(note.proxy_id):
+            raise k.errors.KnowledgeException(
+                "The note is exported and was not linked to the imported note yet, "
+                "use KnowledgeReconcile once it is imported"
+            )
+
+        data = srs_queries.note_info(note.proxy_id)
 
     content = f"""
     Added:        {data['added'].strftime('%Y-%m-%d')}
@@ -221,6 +1037,93 @@ def note_info():
     print(content)
 
 
+@k.errors.pretty_exception_handler
+def buffer_status():
+    """
+    Marks every note in the current buffer with a sign reflecting its review
+    status (leech, due, new or scheduled), and lists the due dates, ease and
+    lapses of the notes in the location list. All the notes are looked up
+    at once.
+    """
+
+    if vim.eval("exists('*sign_placelist')") != '1':
+        raise k.errors.KnowledgeException("KnowledgeBufferStatus requires Vim 8.2 or newer")
+
+    buffer = vim.current.buffer
+
+    # Lines carrying the identifier of a note
+    marks = dict()
+    for number, line in enumerate(buffer):
+        match = k.regexp.IDENTIFIER_MARK.search(line)
+        if match is not None:
+            marks[number] = match.group('identifier')
+
+    mappings = k.backend.get_many(marks.values())
+
+    with readonly_collection() as srs_queries:
+        # The journaled and exported notes are not linked to the SRS yet
+        statuses = srs_queries.notes_status(
+            fact_id
+            for fact_id, fingerprint in mappings.values()
+            if not k.journal.is_placeholder(fact_id)
+            and not k.export.is_placeholder(fact_id)
+        )
+
+    now = datetime.datetime.now()
+    signs = []
+    items = []
+    counts = collections.Counter()
+
+    for number, identifier in sorted(marks.items()):
+        fact_id, fingerprint = mappings.get(identifier, (None, None))
+        status = statuses.get(str(fact_id))
+
+        if status is None:
+            sign = 'KnowledgeMissing'
+            text = 'Not found in the SRS'
+            if k.journal.is_placeholder(fact_id):
+                text = 'Journaled, not sent to the SRS yet'
+            elif k.export.is_placeholder(fact_id):
+                text = 'Exported, not linked to the imported note yet'
+        else:
+            if status['lapses'] >= k.config.LEECH_LAPSES:
+                sign = 'KnowledgeLeech'
+            elif status['reviews'] == 0:
+                sign = 'KnowledgeNew'
+            elif status['due'] is not None and status['due'] <= now:
+                sign = 'KnowledgeDue'
+            else:
+                sign = 'KnowledgeScheduled'
+
+            due = status['due'].strftime('%Y-%m-%d') if status['due'] else 'N/A'
+            ease = f"{status['ease']:g}%" if status['ease'] else 'N/A'
+            text = f"Due: {due}, Ease: {ease}, Lapses: {status['lapses']}, Reviews: {status['reviews']}"
+
+        counts[sign] += 1
+        signs.append({
+            'buffer': buffer.number,
+            'group': 'knowledge',
+            'lnum': number + 1,
+            'name': sign,
+        })
+        items.append({
+            'bufnr': buffer.number,
+            'lnum': number + 1,
+            'text': f"{sign[len('Knowledge'):]}: {text}",
+        })
+
+    # Render everything in a single batch of calls
+    vim.Function('sign_unplace')('knowledge', {'buffer': buffer.number})
+    vim.Function('sign_placelist')(signs)
+    vim.Function('setloclist')(0, [], ' ', {'title': 'Knowledge status', 'items': items})
+
+    print(
+        f"{len(marks)} notes: {counts['KnowledgeDue']} due, "
+        f"{counts['KnowledgeLeech']} leeches, {counts['KnowledgeNew']} new, "
+        f"{counts['KnowledgeMissing']} missing"
+    )
+
+
 @k.errors.pretty_exception_handler
 def diagnose():
     """
@@ -233,14 +1136,189 @@ def diagnose():
         for identifier in k.utils.get_text_identifiers()
     ])
 
-    with autodeleted_proxy() as srs_proxy:
-        note_ids_in_srs = srs_proxy.get_identifiers()
+    with readonly_collection() as srs_queries:
+        note_ids_in_srs = srs_queries.get_identifiers()
 
     print(f"IDs detected in repo: {len(note_ids_in_repo)}")
     print(f"IDs detected in srs: {len(note_ids_in_srs)}")
     print(f"IDs redundant: {note_ids_in_srs - note_ids_in_repo}")
 
 
+@k.errors.pretty_exception_handler
+def reconcile(rebuild=False):
+    """
+    Verifies the stored mappings against the knowledge identifiers embedded
+    in the SRS notes, which are obtained using a single query. With rebuild
+    set, the missing mappings are restored and the mismatched ones pointed
+    to the notes with the identifier embedded, in a single transaction. The
+    identifiers are embedded into the notes synced before they were, so
+    that their mappings can be restored as well.
+
+    The restored mappings have no fingerprint, hence their notes are pushed
+    to the SRS once more on the next sync. The notes exported into a TSV
+    file are linked to the imported notes regardless of rebuild.
+    """
+
+    with readonly_collection() as srs_queries:
+        embedded = srs_queries.embedded_identifiers()
+
+    notes = collections.defaultdict(set)
+    for knowledge_id, fact_id in embedded:
+        notes[knowledge_id].add(str(fact_id))
+
+    # Identifiers embedded in multiple notes (e.g. copied in the SRS) are
+    # left to be resolved manually
+    ambiguous = sorted(knowledge_id for knowledge_id, fact_ids in notes.items() if len(fact_ids) > 1)
+    resolved = {
+        knowledge_id: next(iter(fact_ids))
+        for knowledge_id, fact_ids in notes.items()
+        if len(fact_ids) == 1
+    }
+
+    mappings = k.backend.get_all()
+    missing = {
+        knowledge_id: fact_id
+        for knowledge_id, fact_id in resolved.items()
+        if knowledge_id not in mappings
+    }
+    mismatched = {
+        knowledge_id: fact_id
+        for knowledge_id, fact_id in resolved.items()
+        if knowledge_id in mappings and mappings[knowledge_id] != fact_id
+    }
+
+    # The exported notes keep the fingerprints of the exported content
+    imported = {
+        knowledge_id: fact_id
+        for knowledge_id, fact_id in mismatched.items()
+        if k.export.is_placeholder(mappings[knowledge_id])
+    }
+    for knowledge_id in imported:
+        del mismatched[knowledge_id]
+
+    with k.backend.transaction():
+        k.backend.set_fact_ids(imported)
+
+        if rebuild:
+            k.backend.assign_many([
+                (fact_id, knowledge_id, None)
+                for knowledge_id, fact_id in missing.items()
+            ])
+            k.backend.set_fact_ids(mismatched)
+
+    exported = [
+        knowledge_id
+        for knowledge_id, fact_id in mappings.items()
+        if k.export.is_placeholder(fact_id) and knowledge_id not in imported
+    ]
+
+    # The notes not in the SRS yet have nothing to embed the identifier into
+    unembedded = {
+        knowledge_id: fact_id
+        for knowledge_id, fact_id in mappings.items()
+        if knowledge_id not in notes
+        and not k.journal.is_placeholder(fact_id)
+        and not k.export.is_placeholder(fact_id)
+    }
+
+    backfilled = 0
+    if rebuild and unembedded:
+        with autodeleted_proxy() as srs_proxy:
+            backfilled = srs_proxy.embed_identifiers(unembedded)
+            srs_proxy.commit()
+
+    restored, fixed = ("restored", "fixed") if rebuild else ("missing", "mismatched")
+    print(f"Identifiers embedded in the SRS: {len(resolved)}")
+    print(f"Mappings {restored}: {len(missing)}")
+    print(f"Mappings {fixed}: {len(mismatched)}")
+    if rebuild:
+        print(f"Identifiers embedded: {backfilled}")
+    print(f"Mappings not embedded in the SRS: {len(unembedded) - backfilled}")
+    print(f"Exported notes linked: {len(imported)}")
+    print(f"Exported notes not imported yet: {len(exported)}")
+
+    if ambiguous:
+        print(f"Identifiers embedded in multiple notes: {', '.join(ambiguous)}")
+
+
+@k.errors.pretty_exception_handler
+def export_notes(path, *patterns):
+    """
+    Exports the notes of the whole wiki that are not present in the SRS yet
+    into the given .apkg or .tsv file, to be imported by Anki at once. The
+    exported files can be limited by the glob patterns relative to the wiki
+    root, the files with the extension of the current buffer are exported
+    by default.
+
+    The loaded buffers are exported in their current state, the other files
+    are read from the disk. The identifiers of the exported notes are placed
+    into the files. The notes exported into a TSV file are linked to the
+    imported notes by KnowledgeReconcile.
+    """
+
+    root = Path(os.path.expanduser(k.config.wiki_root or os.getcwd()))
+    extension = vim.eval('expand("%:e")')
+    patterns = patterns or (f'**/*.{extension}',)
+
+    paths = sorted(set(
+        file_path.resolve()
+        for pattern in patterns
+        for file_path in root.glob(pattern)
+        if file_path.is_file()
+    ))
+
+    buffers = {
+        os.path.realpath(buffer.name): buffer
+        for buffer in vim.buffers
+        if buffer.name
+    }
+
+    # The notes are exported using the note types of the collection, if
+    # there is one to read them from
+    try:
+        with readonly_collection() as srs_queries:
+            note_types = srs_queries.note_types()
+    except k.errors.KnowledgeException:
+        note_types = dict()
+
+    exporter = k.export.get_exporter(os.path.abspath(os.path.expanduser(path)), note_types)
+    modified = []
+
+    try:
+        with k.backend.transaction():
+            for file_path in paths:
+                buffer = buffers.get(str(file_path))
+                if buffer is None:
+                    buffer = file_path.read_text(encoding='utf-8').splitlines()
+
+                exporter.base_dir = str(file_path.parent)
+                buffer_proxy = BufferProxy(buffer, path=str(file_path))
+                buffer_proxy.obtain()
+
+                sync_buffer(buffer_proxy, exporter)
+
+                if buffer_proxy.modified != set():
+                    modified.append((file_path, buffer, buffer_proxy))
+
+            # The mappings are recorded only if the file was written
+            exporter.finish()
+            k.backend.set_fingerprints(exporter.take_fingerprints())
+    finally:
+        exporter.cleanup()
+
+    for file_path, buffer, buffer_proxy in modified:
+        buffer_proxy.push()
+
+        if isinstance(buffer, list):
+            file_path.write_text('\n'.join(buffer) + '\n', encoding='utf-8')
+        else:
+            save_buffer(buffer.number, force=True)
+
+        forget_checkpoints(buffer_proxy.path)
+
+    print(f"Exported {exporter.count} notes from {len(paths)} files into {path}")
+
+
 @k.errors.pretty_exception_handler
 def close_questions():
     """
@@ -1,9 +1,16 @@
 import abc
+import base64
+import hashlib
+import http.client
+import json
 import os
 import re
 import pathlib
+import socket
+import sqlite3
 import sys
 import time
+import urllib.parse
 
 from datetime import datetime
 
@@ -11,12 +18,91 @@ import pygments
 from pygments.lexers import PythonLexer
 from pygments.formatters import HtmlFormatter
 
-from knowledge.errors import KnowledgeException, FactNotFoundException
-from knowledge import config, utils, regexp, paths, vimutils
+from knowledge import errors
+from knowledge.errors import KnowledgeException, FactNotFoundException, SRSUnavailableException
+from knowledge.errors import PartialAddException
+from knowledge import config, daemon, utils, regexp, paths
+
+
+def get_proxy():
+    """
+    Opens the proxy of the configured SRS provider.
+    """
+
+    if config.SRS_DAEMON:
+        return DaemonProxy()
+    elif config.SRS_PROVIDER == 'Anki':
+        return AnkiProxy(config.SRS_DB)
+    elif config.SRS_PROVIDER == 'AnkiConnect':
+        return AnkiConnectProxy()
+    elif config.SRS_PROVIDER == 'Mnemosyne':
+        return MnemosyneProxy(os.path.dirname(config.SRS_DB))
+    elif config.SRS_PROVIDER == 'SQLite':
+        return SQLiteProxy(config.SRS_DB)
+    elif config.SRS_PROVIDER is None:
+        raise KnowledgeException(
+            "Variable knowledge_srs_provider has to have "
+            "one of the following values: Anki, AnkiConnect, Mnemosyne, SQLite"
+        )
+    else:
+        raise KnowledgeException(
+            "SRS provider '{0}' is not supported."
+            .format(config.SRS_PROVIDER)
+        )
+
+
+def cloze_ords(fields):
+    """
+    Returns the ords of the cards generated by a cloze note with the given
+    processed fields, one per cloze.
+    """
+
+    clozes = set(
+        int(number) - 1
+        for value in fields.values()
+        for number in re.findall(r'{{c(\d+)::', value or '')
+    )
+
+    return clozes or {0}
+
+
+def raise_partial(error, identifiers, count):
+    """
+    Re-raises the error that interrupted adding the given number of notes.
+    If some of the notes were added before, the error is turned into the
+    PartialAddException carrying their identifiers.
+    """
+
+    if not any(identifiers):
+        raise error
+
+    message = str(error)
+    if not isinstance(error, KnowledgeException):
+        message = f'{type(error).__name__}: {error}'
+
+    identifiers = identifiers + [None] * (count - len(identifiers))
+    raise PartialAddException(message, identifiers) from error
+
+
+# Prefix of the tags embedding the knowledge identifiers into the notes, for
+# the providers without a hidden field to store them in
+ID_TAG_PREFIX = 'knowledge::id::'
 
 
 class SRSProxy(object):
 
+    # Directory the relative media paths are resolved against, defaults to
+    # the directory of the file edited in vim
+    base_dir = None
+
+    # Fingerprints of the pushed notes not committed yet, keyed by their
+    # knowledge identifiers
+    pending_fingerprints = None
+
+    # Set if the SRS library changes the working directory of the process,
+    # which is shared with the editor
+    CHANGES_CWD = False
+
     @abc.abstractmethod
     def __init__(self, path=None):
         """
@@ -34,6 +120,47 @@ class SRSProxy(object):
 
         raise NotImplementedError
 
+    def add_notes(self, notes):
+        """
+        Adds the given notes, each described by a dict with the deck, model,
+        fields and tags keys, and the knowledge_id the note is going to be
+        known under. Returns the list of the identifiers.
+        """
+
+        notes = list(notes)
+        identifiers = []
+
+        try:
+            for note in notes:
+                identifiers.append(
+                    self.add_note(note['deck'], note['model'], note['fields'], note.get('tags'))
+                )
+        except Exception as e:
+            raise_partial(e, identifiers, len(notes))
+
+        return identifiers
+
+    @staticmethod
+    def embedded_tags(tags, knowledge_id=None, current=()):
+        """
+        Returns the given tags extended by the tag embedding the knowledge
+        identifier, keeping the identifier tags among the current tags.
+        """
+
+        tags = set(tags or set())
+        tags.update(tag for tag in current if tag.startswith(ID_TAG_PREFIX))
+
+        if knowledge_id:
+            tags.add(ID_TAG_PREFIX + knowledge_id)
+
+        return tags
+
+    def prepare_decks(self, decks):
+        """
+        Makes sure the given decks exist before the notes are written into
+        them. Providers without decks do not need to do anything.
+        """
+
     @abc.abstractmethod
     def add_media_file(self, filename):
         """
@@ -42,6 +169,29 @@ class SRSProxy(object):
 
         raise NotImplementedError
 
+    def absolute_path(self, filename):
+        """
+        Make sure the path is proper absolute filesystem path.
+        """
+
+        filename_expanded = os.path.expanduser(filename)
+        if os.path.isabs(filename_expanded):
+            return filename_expanded
+
+        return os.path.join(self.relative_base_dir(), filename_expanded)
+
+    def relative_base_dir(self):
+        """
+        Returns the directory the relative paths are resolved against.
+        """
+
+        if self.base_dir:
+            return self.base_dir
+
+        # Imported here, the proxies are used outside of vim by the daemon
+        from knowledge import vimutils
+        return os.path.dirname(vimutils.get_absolute_filepath())
+
     @abc.abstractmethod
     def get_identifiers(self):
         """
@@ -56,6 +206,53 @@ class SRSProxy(object):
         raises FactNotFoundException.
         """
 
+    def update_notes(self, notes):
+        """
+        Updates the given facts, each described by a dict with the identifier,
+        fields, deck, model and tags keys, and optionally the knowledge_id
+        key. If any of the facts could not be found, raises
+        FactNotFoundException.
+        """
+
+        for note in notes:
+            self.update_note(
+                note['identifier'],
+                note['fields'],
+                deck=note.get('deck'),
+                model=note.get('model'),
+                tags=note.get('tags'),
+            )
+
+    def embed_identifiers(self, identifiers):
+        """
+        Embeds the knowledge identifiers into the notes synced before the
+        identifiers were embedded, given as a dict mapping the knowledge
+        identifiers to the SRS identifiers. The notes missing in the SRS are
+        skipped. Returns the number of the notes embedded.
+        """
+
+        raise NotImplementedError
+
+    def defer_fingerprints(self, fingerprints):
+        """
+        Remembers the fingerprints of the pushed notes, which are to be
+        stored once the changes are committed.
+        """
+
+        if self.pending_fingerprints is None:
+            self.pending_fingerprints = dict()
+
+        self.pending_fingerprints.update(fingerprints)
+
+    def take_fingerprints(self):
+        """
+        Returns the fingerprints remembered since the last call.
+        """
+
+        fingerprints = self.pending_fingerprints or dict()
+        self.pending_fingerprints = None
+        return fingerprints
+
     @abc.abstractmethod
     def commit(self):
         """
@@ -348,6 +545,7 @@ class AnkiProxy(SRSProxy):
     DEFAULT_DECK = "Knowledge"
     DEFAULT_MODEL = "Basic"
     CLOSE_MODEL = "Cloze"
+    CHANGES_CWD = True
     SYMBOL_EQ_OPEN = "[$]"
     SYMBOL_EQ_CLOSE = "[/$]"
     SYMBOL_B_OPEN = "<b>"
@@ -370,9 +568,22 @@ class AnkiProxy(SRSProxy):
                 "Make sure 'anki' and 'ankirspy' libraries are installed."
             )
 
-        self.collection = anki.collection.Collection(path)
+        try:
+            self.collection = anki.collection.Collection(path)
+        except Exception as e:
+            # The collection is locked while Anki has it open
+            if 'locked' not in str(e):
+                raise
+            raise SRSUnavailableException(
+                "Anki is running. Please close it and reopen the file."
+            )
+
         self.Note = anki.notes.Note
 
+        # Models and deck ids looked up during the session, keyed by name
+        self.models = dict()
+        self.deck_ids = dict()
+
     @utils.preserve_cwd
     def cleanup(self):
         self.collection.close()
@@ -396,15 +607,7 @@ class AnkiProxy(SRSProxy):
         Adds a new media file to the media directory.
         """
 
-        # Make sure the path is proper absolute filesystem path
-        filename_expanded = os.path.expanduser(filename)
-        if os.path.isabs(filename_expanded):
-            filename_abs = filename_expanded
-        else:
-            filename_abs = os.path.join(
-                os.path.dirname(vimutils.get_absolute_filepath()),
-                filename_expanded
-            )
+        filename_abs = self.absolute_path(filename)
 
         return self.collection.media.addFile(filename_abs)
 
@@ -419,35 +622,102 @@ class AnkiProxy(SRSProxy):
             for identifier in self.collection.findNotes('tag:knowledge')
         ])
 
+    def _model_by_name(self, model_name):
+        """
+        Obtain the model of the given name, raise if it does not exist.
+        """
+
+        if model_name not in self.models:
+            model = self.collection.models.byName(model_name)
+
+            if model is None:
+                raise KnowledgeException("Model {0} not found".format(model_name))
+
+            self.models[model_name] = model
+
+        return self.models[model_name]
+
+    def _deck_id(self, deck_name):
+        """
+        Obtain the id of the deck of the given name, creating the deck if it
+        does not exist.
+        """
+
+        if deck_name not in self.deck_ids:
+            self.prepare_decks([deck_name])
+
+        return self.deck_ids[deck_name]
+
     @utils.preserve_cwd
+    def prepare_decks(self, decks):
+        """
+        Looks up the given decks, creating the missing ones.
+        """
+
+        names = set(deck.replace('.', '::') for deck in decks)
+        missing = []
+
+        for deck_name in names - set(self.deck_ids):
+            deck = self.collection.decks.byName(deck_name)
+
+            if deck is None:
+                missing.append(deck_name)
+            else:
+                self.deck_ids[deck_name] = deck['id']
+
+        if not missing:
+            return
+
+        for deck_name in missing:
+            self.collection.decks.id(deck_name)
+
+        # Creating the decks might have created their parents as well
+        self.deck_ids.clear()
+        for deck_name in names:
+            self.deck_ids[deck_name] = self.collection.decks.byName(deck_name)['id']
+
     def add_note(self, deck, model, fields, tags=None):
         """
         Adds a new note of the given model to the given deck.
         """
 
-        model_name = model
-        deck_name = deck.replace('.', '::')
+        return self.add_notes([dict(deck=deck, model=model, fields=fields, tags=tags)])[0]
 
-        model = self.collection.models.byName(model_name)
-        deck = self.collection.decks.byName(deck_name)
+    @utils.preserve_cwd
+    def add_notes(self, notes):
+        """
+        Adds the given notes. The notes are written when the collection
+        is saved.
+        """
 
-        # Pre-process data in fields
-        fields = self.process_all(fields)
+        identifiers = []
+        self.prepare_decks(data['deck'] for data in notes)
 
-        if model is None:
-            raise KnowledgeException("Model {0} not found".format(model_name))
+        try:
+            for data in notes:
+                identifiers.append(self._add_note(data))
+        except Exception as e:
+            raise_partial(e, identifiers, len(notes))
 
-        if deck is None:
-            self.collection.decks.id(deck_name)
-            deck = self.collection.decks.byName(deck_name)
+        return identifiers
+
+    def _add_note(self, data):
+        # Pre-process data in fields
+        fields = self.process_all(data['fields'])
+
+        model = self._model_by_name(data['model'])
 
         # Create a new Note
         note = self.Note(self.collection, model)
 
         # Set the deck and tags
-        note.model()['did'] = deck['id']
+        note.model()['did'] = self._deck_id(data['deck'].replace('.', '::'))
 
-        note.tags = set(tags) if tags else set()
+        note.tags = set(data['tags']) if data.get('tags') else set()
+
+        # The knowledge identifier is embedded as the note guid
+        if data.get('knowledge_id'):
+            note.guid = data['knowledge_id']
 
         # Fill in all the fields
         for key in fields:
@@ -464,56 +734,161 @@ class AnkiProxy(SRSProxy):
         self.collection.addNote(note)
         return str(note.id)
 
-    @utils.preserve_cwd
     def update_note(self, identifier, fields, deck=None, model=None, tags=None):
-        tags = tags or set()
+        self.update_notes([
+            dict(identifier=identifier, fields=fields, deck=deck, model=model, tags=tags)
+        ])
 
-        # Pre-process data in fields
-        fields = self.process_all(fields)
+    @utils.preserve_cwd
+    def update_notes(self, notes):
+        """
+        Updates the given notes. Changing the metadata of a header changes
+        the deck or tags of all the notes under it, without changing their
+        fields. Such notes are not written one by one: the cards moved to
+        another deck are moved using a single query per deck, and the notes
+        are retagged using a single query per tag set.
+        """
 
-        # Obtain the note object from Anki DB
-        note = self._note_by_id(identifier)
+        moved = dict()
+        retagged = dict()
+        self.prepare_decks(data['deck'] for data in notes)
 
-        # Generate current card data, deck and tags
-        cur_data = {
-            key: note[key]
-            for key in note.keys()
-            if key in fields
-        }
-        cur_deck = note.model()['did']
-        cur_tags = set(note.tags)
+        # Compare against the current state of all the notes at once, the
+        # Note objects are built only for the notes that need to be written
+        snapshot = self._prefetch(data['identifier'] for data in notes)
 
-        deck_name = deck.replace('.', '::')
-        deck = self.collection.decks.byName(deck_name)
-        if deck is None:
-            self.collection.decks.id(deck_name)
-            deck = self.collection.decks.byName(deck_name)
+        for data in notes:
+            identifier = data['identifier']
+            tags = data.get('tags') or set()
 
-        deck_id = deck['id']
+            # Pre-process data in fields
+            fields = self.process_all(data['fields'])
 
-        # Bail out if no change is proposed
-        if all([cur_deck == deck_id, cur_tags == tags, cur_data == fields]):
-            return
+            if int(identifier) not in snapshot:
+                raise FactNotFoundException("Fact with ID '{0}' could not be found"
+                                            .format(identifier))
 
-        # There are changes, so update the note
-        for key in fields:
-            note[key] = fields[key]
+            # Current card data, deck and tags
+            cur_fields, cur_tags, cur_deck = snapshot[int(identifier)]
+            cur_data = {
+                key: value
+                for key, value in cur_fields.items()
+                if key in fields
+            }
 
-        note.tags = list(tags)
+            deck_id = self._deck_id(data['deck'].replace('.', '::'))
 
-        if cur_deck != deck_id:
-            # Updating deck is done directly via DB, see Anki internals in
-            # browser.py::Browser._setDeck
-            card_ids = self.collection.db.list(f"SELECT id FROM cards WHERE nid = {identifier}")
-            result = self.collection.db.execute(
+            if cur_deck != deck_id:
+                moved.setdefault(deck_id, []).append(identifier)
+
+            if cur_data != fields:
+                # The content changed, so update the note
+                note = self._note_by_id(identifier)
+
+                for key in fields:
+                    note[key] = fields[key]
+
+                note.tags = list(tags)
+
+                if data.get('knowledge_id'):
+                    note.guid = data['knowledge_id']
+
+                # Push the changes, doesn't get saved without it
+                note.flush()
+            elif cur_tags != tags:
+                retagged.setdefault(frozenset(tags), []).append(identifier)
+
+        # Updating deck is done directly via DB, see Anki internals in
+        # browser.py::Browser._setDeck
+        for deck_id, identifiers in moved.items():
+            self.collection.db.execute(
                 f"UPDATE cards SET usn={self.collection.usn()}, "
                 f"mod={int(time.time())}, "
                 f"did={deck_id} "
-                f"WHERE id IN ({','.join(map(str, card_ids))})",
+                f"WHERE nid IN ({','.join(map(str, identifiers))})",
+            )
+
+        for tags, identifiers in retagged.items():
+            self._set_tags(identifiers, tags)
+
+    @utils.preserve_cwd
+    def embed_identifiers(self, identifiers):
+        """
+        Sets the knowledge identifiers as the guids of the given notes, using
+        a single query.
+        """
+
+        if not identifiers:
+            return 0
+
+        existing = set(self.collection.db.list(
+            f"SELECT id FROM notes "
+            f"WHERE id IN ({','.join(str(int(fact_id)) for fact_id in identifiers.values())})"
+        ))
+
+        self.collection.db.executemany(
+            f"UPDATE notes SET guid=?, usn={self.collection.usn()}, "
+            f"mod={int(time.time())} WHERE id=?",
+            [
+                (knowledge_id, int(fact_id))
+                for knowledge_id, fact_id in identifiers.items()
+                if int(fact_id) in existing
+            ]
+        )
+
+        return len(existing)
+
+    def _prefetch(self, identifiers):
+        """
+        Loads the fields, tags and the deck of each of the given notes using
+        a single query. Returns a dict mapping the note ids to the
+        (fields, tags, deck id) triples, the deck id is None for the notes
+        without cards.
+        """
+
+        identifiers = ','.join(str(int(identifier)) for identifier in identifiers)
+        if not identifiers:
+            return dict()
+
+        rows = self.collection.db.all(
+            "SELECT notes.id, notes.mid, notes.flds, notes.tags, min(cards.did) "
+            "FROM notes LEFT JOIN cards ON cards.nid = notes.id "
+            f"WHERE notes.id IN ({identifiers}) "
+            "GROUP BY notes.id"
+        )
+
+        field_names = dict()
+        snapshot = dict()
+
+        for identifier, model_id, fields, tags, deck_id in rows:
+            if model_id not in field_names:
+                model = self.collection.models.get(model_id)
+                field_names[model_id] = [field['name'] for field in model['flds']]
+
+            snapshot[identifier] = (
+                dict(zip(field_names[model_id], fields.split('\x1f'))),
+                set(self.collection.tags.split(tags)),
+                deck_id,
             )
 
-        # Push the changes, doesn't get saved without it
-        note.flush()
+        return snapshot
+
+    def _set_tags(self, identifiers, tags):
+        """
+        Replaces the tags of all the given notes by the given tags, the same
+        way Note.flush() stores them.
+        """
+
+        tags = self.collection.tags.canonify(list(tags))
+        self.collection.tags.register(tags)
+
+        self.collection.db.execute(
+            f"UPDATE notes SET usn={self.collection.usn()}, "
+            f"mod={int(time.time())}, "
+            f"tags=? "
+            f"WHERE id IN ({','.join(map(str, identifiers))})",
+            self.collection.tags.join(tags),
+        )
 
     @utils.preserve_cwd
     def commit(self):
@@ -564,143 +939,685 @@ class AnkiProxy(SRSProxy):
         }
 
 
-class MnemosyneProxy(SRSProxy):
+class AnkiConnectProxy(SRSProxy):
     """
-    An abstraction over Mnemosyne interface.
+    An abstraction over the AnkiConnect add-on. Talks to the running Anki
+    over HTTP instead of opening the collection, hence it does not compete
+    with Anki for the collection lock. The notes added or updated by a save
+    are sent using a few 'multi' requests over a single kept-alive
+    connection.
     """
 
-    CLOSE_MODEL = "5"
-    DEFAULT_DECK = None
-    DEFAULT_MODEL = "1"
-    SYMBOL_EQ_OPEN = "<$>"
-    SYMBOL_EQ_CLOSE = "</$>"
-    SYMBOL_B_OPEN = "<b>"
-    SYMBOL_B_CLOSE = "</b>"
-    SYMBOL_I_OPEN = "<i>"
-    SYMBOL_I_CLOSE = "</i>"
-    SYMBOL_IMG_OPEN = "<img src=\""
-    SYMBOL_IMG_CLOSE = "\">"
-    SYMBOL_CLOZE_OPEN = "["
-    SYMBOL_CLOZE_CLOSE = "]"
+    DEFAULT_DECK = AnkiProxy.DEFAULT_DECK
+    DEFAULT_MODEL = AnkiProxy.DEFAULT_MODEL
+    CLOSE_MODEL = AnkiProxy.CLOSE_MODEL
+    SYMBOL_EQ_OPEN = AnkiProxy.SYMBOL_EQ_OPEN
+    SYMBOL_EQ_CLOSE = AnkiProxy.SYMBOL_EQ_CLOSE
+    SYMBOL_B_OPEN = AnkiProxy.SYMBOL_B_OPEN
+    SYMBOL_B_CLOSE = AnkiProxy.SYMBOL_B_CLOSE
+    SYMBOL_I_OPEN = AnkiProxy.SYMBOL_I_OPEN
+    SYMBOL_I_CLOSE = AnkiProxy.SYMBOL_I_CLOSE
+    SYMBOL_IMG_OPEN = AnkiProxy.SYMBOL_IMG_OPEN
+    SYMBOL_IMG_CLOSE = AnkiProxy.SYMBOL_IMG_CLOSE
+    SYMBOL_CLOZE_OPEN = AnkiProxy.SYMBOL_CLOZE_OPEN
+    SYMBOL_CLOZE_CLOSE = AnkiProxy.SYMBOL_CLOZE_CLOSE
+    SYMBOL_NEWLINE = AnkiProxy.SYMBOL_NEWLINE
+
+    # Version of the AnkiConnect API being used
+    VERSION = 6
+
+    # Maximum number of the actions packed into a single request
+    MULTI_CHUNK_SIZE = 200
+
+    # Number of seconds to wait for Anki to process a request
+    TIMEOUT = 120
+
+    # Connection classes and default ports of the supported URL schemes
+    CONNECTIONS = {
+        'http': (http.client.HTTPConnection, 80),
+        'https': (http.client.HTTPSConnection, 443),
+    }
+
+    def __init__(self, url=None):
+        self.url = url or config.ANKICONNECT_URL
+
+        parsed = urllib.parse.urlsplit(self.url)
+
+        if parsed.scheme not in self.CONNECTIONS:
+            raise KnowledgeException(
+                f"AnkiConnect URL '{self.url}' has to use one of the following "
+                f"schemes: {', '.join(self.CONNECTIONS)}"
+            )
 
+        self.connection_class, default_port = self.CONNECTIONS[parsed.scheme]
+        self.host = parsed.hostname
+        self.port = parsed.port or default_port
+        self.path = parsed.path or '/'
+        self.connection = None
 
-    def __init__(self, path=None):
-        from mnemosyne.script import Mnemosyne
+        # Decks known to exist and media files stored during the session
+        self.decks = set()
+        self.media = dict()
 
-        try:
-            self.mnemo = Mnemosyne(path)
+    def cleanup(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
-            # Activate the Cloze plugin
-            # Note: The import needs to be here, since it relies on the
-            # presence of the translation engine, which is initialized with
-            # the mnemosyne object.
-            from mnemosyne.libmnemosyne.card_types.cloze import ClozePlugin
-            for plugin in self.mnemo.plugins():
-                if isinstance(plugin, ClozePlugin):
-                    plugin.activate()
-                    break
+    def _post(self, payload):
+        """
+        Posts the given payload and returns the decoded response. The
+        connection is kept open for the subsequent requests.
+        """
 
-        except SystemExit:
-            raise KnowledgeException(
-                "Mnemosyne is running. Please close it and reopen the file."
-            )
+        body = json.dumps(payload).encode('utf-8')
+
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = self.connection_class(
+                    self.host, self.port, timeout=self.TIMEOUT
+                )
+
+            try:
+                self.connection.request('POST', self.path, body, {'Content-Type': 'application/json'})
+                response = self.connection.getresponse()
+                data = response.read()
+            except (ConnectionResetError, BrokenPipeError):
+                # The server closed the kept-alive connection, reconnect once
+                self.cleanup()
+                if attempt:
+                    raise KnowledgeException(f"AnkiConnect at {self.url} closed the connection")
+                continue
+            except OSError as e:
+                self.cleanup()
+                raise SRSUnavailableException(
+                    f"Could not connect to AnkiConnect at {self.url} ({e}). "
+                    "Make sure Anki is running with the AnkiConnect add-on."
+                )
 
-    def cleanup(self):
-        try:
-            self.mnemo.finalise()
-        except Exception as e:
-            pass
+            if response.status != 200:
+                raise KnowledgeException(
+                    f"AnkiConnect at {self.url} responded with {response.status} {response.reason}"
+                )
 
-        del self.mnemo
+            return json.loads(data.decode('utf-8'))
 
-    def extract_data(self, fields, model):
+    @staticmethod
+    def _outcome(action, response):
         """
-        Extracts the data dict from the given fields, depending
-        on the model being used.
+        Returns the (result, error message) pair of the given response, the
+        error message is None unless the action failed.
         """
 
-        # Transform the fields data to mnemosyne format
-        if model == self.CLOSE_MODEL:
-            data = {'text': fields.get("Text")}
-        else:
-            data = {
-                'f': fields.get("Front"),
-                'b': fields.get("Back"),
-            }
+        if not isinstance(response, dict) or 'error' not in response:
+            raise KnowledgeException(f"Unexpected AnkiConnect response to '{action}': {response}")
 
-        return data
+        if response['error'] is not None:
+            return None, f"AnkiConnect action '{action}' failed: {response['error']}"
 
-    def add_media_file(self, filename):
+        return response.get('result'), None
+
+    @classmethod
+    def _result(cls, action, response):
         """
-        Adds a new media file to the media directory.
+        Returns the result of the given response, raises if the action failed.
         """
 
-        from mnemosyne.libmnemosyne.utils import copy_file_to_dir, contract_path
-        media_dir = self.mnemo.database().media_dir()
+        result, error = cls._outcome(action, response)
 
-        # Make sure the path is proper absolute filesystem path
-        filename_expanded = os.path.expanduser(filename)
-        if os.path.isabs(filename_expanded):
-            filename_abs = filename_expanded
-        else:
-            filename_abs = os.path.join(
-                os.path.dirname(vimutils.get_absolute_filepath()),
-                filename_expanded
-            )
+        if error is not None:
+            raise KnowledgeException(error)
 
-        copy_file_to_dir(filename_abs, media_dir)
-        return contract_path(filename_abs, media_dir)
+        return result
 
-    def add_note(self, deck, model, fields, tags=None):
+    def _action(self, action, **params):
+        payload = {'action': action, 'version': self.VERSION, 'params': params}
+
+        if config.ANKICONNECT_KEY:
+            payload['key'] = config.ANKICONNECT_KEY
+
+        return payload
+
+    def request(self, action, **params):
         """
-        Adds a new fact with specified fields, model name and tags.
-        Returns the ID of the fact.
+        Performs a single action, returns its result.
         """
 
-        # Pre-process data in fields
-        fields = self.process_all(fields)
-        data = self.extract_data(fields, model)
+        return self._result(action, self._post(self._action(action, **params)))
 
-        # Convert the deck name to the tag
-        tags = (tags or set())
-        if deck is not None:
-            tags.add(deck.replace('.', '::'))
+    def attempt(self, actions):
+        """
+        Performs the given (action, params) pairs, packed into as few
+        requests as possible. Returns the list of their (result, error
+        message) pairs. The requests stop after the first one with a failed
+        action, hence the pairs of the actions not performed are left out.
+        """
 
-        try:
-            card_type = self.mnemo.card_type_with_id(model)
-        except KeyError:
-            raise KnowledgeException("Model (card type) '{0}' does "
-                                     "not exist".format(model))
-        controller = self.mnemo.controller()
+        outcomes = []
 
-        try:
-            cards = controller.create_new_cards(
-                data,
-                card_type,
-                grade=-1,
-                tag_names=tags,
-                check_for_duplicates=False,
-                save=False,
+        for index in range(0, len(actions), self.MULTI_CHUNK_SIZE):
+            chunk = actions[index:index+self.MULTI_CHUNK_SIZE]
+
+            try:
+                responses = self.request('multi', actions=[
+                    self._action(action, **params)
+                    for action, params in chunk
+                ])
+            except KnowledgeException as e:
+                # Keep the outcomes of the requests performed already
+                if not outcomes:
+                    raise
+
+                outcomes.extend((None, str(e)) for action, params in chunk)
+                break
+
+            outcomes.extend(
+                self._outcome(action, response)
+                for (action, params), response in zip(chunk, responses)
             )
-        except AssertionError:
-            raise KnowledgeException("Fact '{0}' could not be added, it "
-                                     "most likely contains invalid "
-                                     "data".format(fields))
 
-        # We expect exactly one card created for regular cards,
-        # or at least one for closes
-        if model == self.DEFAULT_MODEL:
-            assert len(cards) == 1
-        elif model == self.CLOSE_MODEL:
-            assert len(cards) >= 1
+            if any(error is not None for result, error in outcomes):
+                break
 
-        # Return the fact ID
-        return cards[0].fact.id
+        return outcomes
+
+    def multi(self, actions):
+        """
+        Performs the given (action, params) pairs, packed into as few
+        requests as possible. Returns the list of their results, raises if
+        any of the actions failed.
+        """
+
+        results = []
+
+        for result, error in self.attempt(actions):
+            if error is not None:
+                raise KnowledgeException(error)
+
+            results.append(result)
+
+        return results
+
+    def prepare_decks(self, decks):
+        """
+        Creates the decks not known to exist yet, in a single request.
+        """
+
+        missing = sorted(set(
+            deck.replace('.', '::')
+            for deck in decks
+            if deck is not None
+        ) - self.decks)
+
+        self.multi([('createDeck', {'deck': deck}) for deck in missing])
+        self.decks.update(missing)
+
+    def add_media_file(self, filename):
+        """
+        Adds a new media file to the media directory.
+        """
+
+        filename_abs = self.absolute_path(filename)
+
+        if filename_abs not in self.media:
+            with open(filename_abs, 'rb') as f:
+                data = base64.b64encode(f.read()).decode('ascii')
+
+            basename = os.path.basename(filename_abs)
+            stored = self.request('storeMediaFile', filename=basename, data=data)
+            self.media[filename_abs] = stored or basename
+
+        return self.media[filename_abs]
+
+    def add_note(self, deck, model, fields, tags=None):
+        """
+        Adds a new note of the given model to the given deck.
+        """
+
+        return self.add_notes([dict(deck=deck, model=model, fields=fields, tags=tags)])[0]
+
+    def add_notes(self, notes):
+        """
+        Adds the given notes using a single batch of requests.
+        """
+
+        notes = list(notes)
+        self.prepare_decks(data['deck'] for data in notes)
+
+        outcomes = self.attempt([
+            ('addNote', {'note': {
+                'deckName': data['deck'].replace('.', '::'),
+                'modelName': data['model'],
+                'fields': self.process_all(data['fields']),
+                'tags': sorted(self.embedded_tags(data.get('tags'), data.get('knowledge_id'))),
+                'options': {'allowDuplicate': True},
+            }})
+            for data in notes
+        ])
+
+        identifiers = [
+            str(result) if error is None else None
+            for result, error in outcomes
+        ]
+
+        # The notes added besides the failed ones are kept by Anki
+        failures = [error for result, error in outcomes if error is not None]
+        if failures:
+            raise_partial(KnowledgeException(failures[0]), identifiers, len(notes))
+
+        return identifiers
+
+    def update_note(self, identifier, fields, deck=None, model=None, tags=None):
+        self.update_notes([
+            dict(identifier=identifier, fields=fields, deck=deck, model=model, tags=tags)
+        ])
+
+    def update_notes(self, notes):
+        """
+        Updates the given notes. The current state of all the notes is looked
+        up at once, only the actual changes are then sent, in a single batch
+        of requests. The cards moved to the same deck are moved together, as
+        are the notes gaining or losing the same tags.
+        """
+
+        notes = list(notes)
+        if not notes:
+            return
+
+        self.prepare_decks(data['deck'] for data in notes)
+
+        infos = self.request('notesInfo', notes=[int(data['identifier']) for data in notes])
+        card_ids = [card for info in infos for card in (info or {}).get('cards', [])]
+        decks = {
+            card['cardId']: card['deckName']
+            for card in self.request('cardsInfo', cards=card_ids)
+        }
+
+        actions = []
+        moved = dict()
+        retagged = dict()
+
+        for data, info in zip(notes, infos):
+            identifier = data['identifier']
+
+            if not info or 'noteId' not in info:
+                raise FactNotFoundException("Fact with ID '{0}' could not be found"
+                                            .format(identifier))
+
+            # Pre-process data in fields
+            fields = self.process_all(data['fields'])
+
+            cur_data = {
+                key: value['value']
+                for key, value in info['fields'].items()
+                if key in fields
+            }
+            cur_tags = set(info['tags'])
+            tags = self.embedded_tags(data.get('tags'), data.get('knowledge_id'), cur_tags)
+            deck = data['deck'].replace('.', '::')
+
+            if cur_data != fields:
+                actions.append(('updateNoteFields', {'note': {'id': info['noteId'], 'fields': fields}}))
+
+            for card in info['cards']:
+                if decks.get(card) != deck:
+                    moved.setdefault(deck, []).append(card)
+
+            if cur_tags - tags:
+                retagged.setdefault(('removeTags', ' '.join(sorted(cur_tags - tags))), []).append(info['noteId'])
+            if tags - cur_tags:
+                retagged.setdefault(('addTags', ' '.join(sorted(tags - cur_tags))), []).append(info['noteId'])
+
+        actions.extend(
+            ('changeDeck', {'cards': cards, 'deck': deck})
+            for deck, cards in moved.items()
+        )
+        actions.extend(
+            (action, {'notes': identifiers, 'tags': tags})
+            for (action, tags), identifiers in retagged.items()
+        )
+
+        self.multi(actions)
+
+    def embed_identifiers(self, identifiers):
+        """
+        Tags the given notes with their knowledge identifiers, using a single
+        request to find the notes and a single 'multi' request to tag them.
+        """
+
+        infos = self.request('notesInfo', notes=[int(fact_id) for fact_id in identifiers.values()])
+        existing = set(str(info['noteId']) for info in infos if info)
+
+        self.multi([
+            ('addTags', {'notes': [int(fact_id)], 'tags': ID_TAG_PREFIX + knowledge_id})
+            for knowledge_id, fact_id in identifiers.items()
+            if str(fact_id) in existing
+        ])
+
+        return len(existing)
+
+    def get_identifiers(self):
+        """
+        Returns a set of the SRS identifiers of all the knowledge-generated
+        cards.
+        """
+
+        return set(
+            str(identifier)
+            for identifier in self.request('findNotes', query='tag:knowledge')
+        )
+
+    def embedded_identifiers(self):
+        """
+        Returns the (knowledge identifier, note identifier) pairs of all the
+        notes with the knowledge identifier embedded, using two requests.
+        """
+
+        identifiers = self.request('findNotes', query=f'"tag:{ID_TAG_PREFIX}*"')
+
+        return [
+            (tag[len(ID_TAG_PREFIX):], str(info['noteId']))
+            for info in self.request('notesInfo', notes=identifiers)
+            for tag in info['tags']
+            if tag.startswith(ID_TAG_PREFIX)
+        ]
+
+    def cards_info(self, query):
+        """
+        Returns the info and the reviews of the cards matching the given
+        search query, using two requests.
+        """
+
+        card_ids = self.request('findCards', query=query)
+        if not card_ids:
+            return [], dict()
+
+        cards, reviews = self.multi([
+            ('cardsInfo', {'cards': card_ids}),
+            ('getReviewsOfCards', {'cards': card_ids}),
+        ])
+
+        return cards, reviews
+
+    @staticmethod
+    def card_due(card, reviews):
+        """
+        Returns the timestamp the given card is due at. AnkiConnect reports
+        the due day of the review cards relative to the collection creation,
+        hence it is computed from the last review and the interval instead.
+        """
+
+        if card['type'] not in (1, 2):
+            return None
+        elif card['queue'] in (2, 3):
+            if not reviews:
+                return None
+            return max(review['id'] for review in reviews) / 1000 + card['interval'] * 86400
+        else:
+            return card['due']
+
+    def commit(self):
+        # AnkiConnect saves the changes of each action
+        pass
+
+    def note_info(self, identifier):
+        """
+        Obtain information about the note.
+        """
+
+        cards, reviews = self.cards_info(f'nid:{int(identifier)}')
+        if not cards:
+            raise FactNotFoundException("Fact with ID '{0}' could not be found"
+                                        .format(identifier))
+
+        card = min(cards, key=lambda card: card['ord'])
+        card_reviews = reviews.get(str(card['cardId']), [])
+
+        first_review = min((review['id'] for review in card_reviews), default=None)
+        last_review = max((review['id'] for review in card_reviews), default=None)
+        num_revisions = len(card_reviews)
+        total_time = sum(review['time'] for review in card_reviews) // 1000
+        due = self.card_due(card, card_reviews)
+
+        return {
+            'added': datetime.fromtimestamp(card['cardId'] / 1000),
+            'first_review': datetime.fromtimestamp(first_review / 1000) if first_review else None,
+            'last_review': datetime.fromtimestamp(last_review / 1000) if last_review else None,
+            'ease': card['factor'] / 10.0,
+            'reviews': card['reps'],
+            'lapses': card['lapses'],
+            # AnkiConnect does not report the names of the templates
+            'card_type': f"Card {card['ord'] + 1}",
+            'note_type': card['modelName'],
+            'deck': card['deckName'],
+            'note_id': card['note'],
+            'card_id': card['cardId'],
+            'total_time': total_time if num_revisions else None,
+            'average_time': (total_time / num_revisions) if num_revisions else None,
+            'due': datetime.fromtimestamp(due) if due is not None else None,
+            'interval': card['interval'] * 86400 if card['queue'] == 2 else None
+        }
+
+
+class MnemosyneProxy(SRSProxy):
+    """
+    An abstraction over Mnemosyne interface.
+    """
+
+    CLOSE_MODEL = "5"
+    DEFAULT_DECK = None
+    DEFAULT_MODEL = "1"
+    SYMBOL_EQ_OPEN = "<$>"
+    SYMBOL_EQ_CLOSE = "</$>"
+    SYMBOL_B_OPEN = "<b>"
+    SYMBOL_B_CLOSE = "</b>"
+    SYMBOL_I_OPEN = "<i>"
+    SYMBOL_I_CLOSE = "</i>"
+    SYMBOL_IMG_OPEN = "<img src=\""
+    SYMBOL_IMG_CLOSE = "\">"
+    SYMBOL_CLOZE_OPEN = "["
+    SYMBOL_CLOZE_CLOSE = "]"
+
+
+    def __init__(self, path=None):
+        from mnemosyne.script import Mnemosyne
+
+        try:
+            self.mnemo = Mnemosyne(path)
+
+            # Activate the Cloze plugin
+            # Note: The import needs to be here, since it relies on the
+            # presence of the translation engine, which is initialized with
+            # the mnemosyne object.
+            from mnemosyne.libmnemosyne.card_types.cloze import ClozePlugin
+            for plugin in self.mnemo.plugins():
+                if isinstance(plugin, ClozePlugin):
+                    plugin.activate()
+                    break
+
+        except SystemExit:
+            raise SRSUnavailableException(
+                "Mnemosyne is running. Please close it and reopen the file."
+            )
+
+        # Tag objects looked up during the session, keyed by name
+        self.tags = dict()
+
+        # Modified cards written on commit, keyed by their internal ids, and
+        # the tags that might have become unused
+        self.pending_cards = dict()
+        self.old_tags = set()
+
+    def cleanup(self):
+        try:
+            # Leave the database in the same state as if the cards were
+            # written immediately
+            self._flush()
+            self.mnemo.finalise()
+        except Exception as e:
+            pass
+
+        del self.mnemo
+
+    def extract_data(self, fields, model):
+        """
+        Extracts the data dict from the given fields, depending
+        on the model being used.
+        """
+
+        # Transform the fields data to mnemosyne format
+        if model == self.CLOSE_MODEL:
+            data = {'text': fields.get("Text")}
+        else:
+            data = {
+                'f': fields.get("Front"),
+                'b': fields.get("Back"),
+            }
+
+        return data
+
+    def add_media_file(self, filename):
+        """
+        Adds a new media file to the media directory.
+        """
+
+        from mnemosyne.libmnemosyne.utils import copy_file_to_dir, contract_path
+        media_dir = self.mnemo.database().media_dir()
+
+        filename_abs = self.absolute_path(filename)
+
+        copy_file_to_dir(filename_abs, media_dir)
+        return contract_path(filename_abs, media_dir)
+
+    def add_note(self, deck, model, fields, tags=None):
+        """
+        Adds a new fact with specified fields, model name and tags.
+        Returns the ID of the fact.
+        """
+
+        return self.add_notes([dict(deck=deck, model=model, fields=fields, tags=tags)])[0]
+
+    def add_notes(self, notes):
+        """
+        Adds the given facts, looking up each of the involved card types only
+        once. The facts are written when the database is saved.
+        """
+
+        notes = list(notes)
+        controller = self.mnemo.controller()
+        card_types = dict()
+        identifiers = []
+
+        try:
+            for note in notes:
+                model = note['model']
+
+                # Pre-process data in fields
+                fields = self.process_all(note['fields'])
+                data = self.extract_data(fields, model)
+
+                # Convert the deck name to the tag
+                tags = self.embedded_tags(note.get('tags'), note.get('knowledge_id'))
+                if note['deck'] is not None:
+                    tags.add(note['deck'].replace('.', '::'))
+
+                if model not in card_types:
+                    try:
+                        card_types[model] = self.mnemo.card_type_with_id(model)
+                    except KeyError:
+                        raise KnowledgeException("Model (card type) '{0}' does "
+                                                 "not exist".format(model))
+
+                try:
+                    cards = controller.create_new_cards(
+                        data,
+                        card_types[model],
+                        grade=-1,
+                        tag_names=tags,
+                        check_for_duplicates=False,
+                        save=False,
+                    )
+                except AssertionError:
+                    raise KnowledgeException("Fact '{0}' could not be added, it "
+                                             "most likely contains invalid "
+                                             "data".format(fields))
+
+                # We expect exactly one card created for regular cards,
+                # or at least one for closes
+                if model == self.DEFAULT_MODEL:
+                    assert len(cards) == 1
+                elif model == self.CLOSE_MODEL:
+                    assert len(cards) >= 1
+
+                # Store the fact ID
+                identifiers.append(cards[0].fact.id)
+        except Exception as e:
+            raise_partial(e, identifiers, len(notes))
+
+        return identifiers
+
+    def update_note(self, identifier, fields, deck=None, model=None, tags=None):
+        self.update_notes([
+            dict(identifier=identifier, fields=fields, deck=deck, model=model, tags=tags)
+        ])
+
+    def update_notes(self, notes):
+        """
+        Updates the given facts. The facts that only changed their tags (as
+        a result of changing the metadata of their header) are retagged
+        together, one tag set at a time. The modified cards are written, and
+        the tags that are no longer used are removed, on commit.
+        """
+
+        db = self.mnemo.database()
+        retagged = dict()
+
+        # Fetch the current time
+        modification_time = int(time.time())
+
+        for note in notes:
+            self._update_fact(db, modification_time, retagged, **note)
+
+        for tags, cards in retagged.items():
+            self._set_tags(db, cards, tags, modification_time)
+
+    def embed_identifiers(self, identifiers):
+        """
+        Tags the cards of the given facts with their knowledge identifiers,
+        retagging the cards with the same tags at once.
+        """
 
-    def update_note(self, identifier, fields, deck=None, model=None, tags=None):
-        # Get the fact from Mnemosyne
         db = self.mnemo.database()
+        retagged = dict()
+
+        for knowledge_id, fact_id in identifiers.items():
+            try:
+                fact = db.fact(fact_id, is_id_internal=False)
+            except TypeError:
+                # Mnemosyne raises TypeError in case ID is not found
+                continue
+
+            cards = self._cards_from_fact(db, fact)
+            if not cards:
+                continue
+
+            current_tags = set([tag.name for tag in cards[0].tags])
+            tags = self.embedded_tags(current_tags, knowledge_id)
+            retagged.setdefault(frozenset(tags), []).append(cards)
+
+        modification_time = int(time.time())
+        for tags, facts in retagged.items():
+            self._set_tags(db, [card for cards in facts for card in cards], tags, modification_time)
 
+        return sum(len(facts) for facts in retagged.values())
+
+    def _update_fact(self, db, modification_time, retagged, identifier, fields, deck=None, model=None, tags=None, knowledge_id=None):
+        """
+        Updates the given fact. If only the tags of the fact changed, its
+        cards are added to the retagged dict under the new tag set instead.
+        """
+
+        # Get the fact from Mnemosyne
         try:
             fact = db.fact(identifier, is_id_internal=False)
         except TypeError:
@@ -708,7 +1625,7 @@ class MnemosyneProxy(SRSProxy):
             raise FactNotFoundException("Fact with ID '{0}' could not be found"
                                         .format(identifier))
 
-        cards = db.cards_from_fact(fact)
+        cards = self._cards_from_fact(db, fact)
         if not cards:
             raise FactNotFoundException("Fact with ID '{0}' does not have any"
                                         "cards assigned".format(identifier))
@@ -727,11 +1644,16 @@ class MnemosyneProxy(SRSProxy):
 
         current_data = fact.data
         current_tags = set([tag.name for tag in cards[0].tags])
+        tags = self.embedded_tags(tags, knowledge_id, current_tags)
 
         # Bail out if no modifications to be performed
         if current_tags == tags and current_data == data:
             return
 
+        if current_data == data:
+            retagged.setdefault(frozenset(tags), []).extend(cards)
+            return
+
         # Update the fact
         card_type = self.mnemo.card_type_with_id(model)
         new, edited, deleted = card_type.edit_fact(fact, data)
@@ -742,34 +1664,610 @@ class MnemosyneProxy(SRSProxy):
         # This mainly happens with card types that generate multiple cards, like
         # questions with multiple closes
         for card in deleted:
+            self.pending_cards.pop(card._id, None)
             db.delete_card(card)
 
         for card in new:
             db.add_card(card)
 
         for card in edited:
-            db.update_card(card)
+            self.pending_cards[card._id] = card
 
         # Refetch the list of cards
-        cards = db.cards_from_fact(fact)
+        cards = self._cards_from_fact(db, fact)
 
-        # Set new tags for each card
-        old_tag_objects = set()
-        new_tag_objects = db.get_or_create_tags_with_names(tags)
+        self._set_tags(db, cards, tags, modification_time)
 
-        # Fetch the current time
-        modification_time = int(time.time())
+    def _cards_from_fact(self, db, fact):
+        """
+        Returns the cards of the given fact, preferring the modified cards
+        not written yet.
+        """
+
+        return [
+            self.pending_cards.get(card._id, card)
+            for card in db.cards_from_fact(fact)
+        ]
+
+    def _set_tags(self, db, cards, tags, modification_time):
+        """
+        Sets the given tags for each of the given cards. The cards modified
+        otherwise are written on commit, the rest is retagged at once, the
+        same way update_card() stores the tags.
+        """
+
+        missing = [name for name in tags if name not in self.tags]
+        if missing:
+            for tag in db.get_or_create_tags_with_names(missing):
+                self.tags[tag.name] = tag
+
+        new_tag_objects = set(self.tags[name] for name in tags)
+        retagged = []
 
         for card in cards:
-            old_tag_objects |= card.tags
+            self.old_tags |= card.tags
             card.modification_time = modification_time
             card.tags = new_tag_objects
+
+            if card._id not in self.pending_cards:
+                retagged.append(card)
+
+        if not retagged:
+            return
+
+        identifiers = ','.join(str(card._id) for card in retagged)
+
+        db.con.execute(
+            f"UPDATE cards SET tags=?, modification_time=? WHERE _id IN ({identifiers})",
+            (retagged[0].tag_string(), modification_time)
+        )
+        db.con.execute(f"DELETE FROM tags_for_card WHERE _card_id IN ({identifiers})")
+        db.con.executemany(
+            "INSERT INTO tags_for_card (_card_id, _tag_id) VALUES (?, ?)",
+            [(card._id, tag._id) for card in retagged for tag in new_tag_objects]
+        )
+
+        # Recorded for the synchronization with the other devices
+        for card in retagged:
+            db.log().edited_card(card)
+
+    def _flush(self):
+        """
+        Writes the modified cards and removes the tags no longer used.
+        """
+
+        db = self.mnemo.database()
+
+        for card in self.pending_cards.values():
             db.update_card(card)
 
         # Remove redundant tags
-        for tag in old_tag_objects:
+        for tag in self.old_tags:
             db.delete_tag_if_unused(tag)
 
+        self.pending_cards.clear()
+        self.old_tags.clear()
+
+        # The unused tags might have been deleted
+        self.tags.clear()
+
     def commit(self):
+        self._flush()
+
         db = self.mnemo.database()
         db.save()
+
+
+class SQLiteProxy(SRSProxy):
+    """
+    A reference SRS storing the notes in a plain SQLite database, without
+    any scheduling application. Serves as a fast and deterministic target
+    for benchmarking the sync, and for the wikis that are only exported.
+    The fields are processed the same way as for Anki.
+
+    The changes are done in a single transaction, which is committed by
+    commit() and rolled back if the proxy is cleaned up without it.
+    """
+
+    DEFAULT_DECK = AnkiProxy.DEFAULT_DECK
+    DEFAULT_MODEL = AnkiProxy.DEFAULT_MODEL
+    CLOSE_MODEL = AnkiProxy.CLOSE_MODEL
+    SYMBOL_EQ_OPEN = AnkiProxy.SYMBOL_EQ_OPEN
+    SYMBOL_EQ_CLOSE = AnkiProxy.SYMBOL_EQ_CLOSE
+    SYMBOL_B_OPEN = AnkiProxy.SYMBOL_B_OPEN
+    SYMBOL_B_CLOSE = AnkiProxy.SYMBOL_B_CLOSE
+    SYMBOL_I_OPEN = AnkiProxy.SYMBOL_I_OPEN
+    SYMBOL_I_CLOSE = AnkiProxy.SYMBOL_I_CLOSE
+    SYMBOL_IMG_OPEN = AnkiProxy.SYMBOL_IMG_OPEN
+    SYMBOL_IMG_CLOSE = AnkiProxy.SYMBOL_IMG_CLOSE
+    SYMBOL_CLOZE_OPEN = AnkiProxy.SYMBOL_CLOZE_OPEN
+    SYMBOL_CLOZE_CLOSE = AnkiProxy.SYMBOL_CLOZE_CLOSE
+    SYMBOL_NEWLINE = AnkiProxy.SYMBOL_NEWLINE
+
+    # Maximum number of the notes looked up by a single query, SQLite limits
+    # the number of the query parameters
+    SNAPSHOT_CHUNK_SIZE = 500
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS decks (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS notes (
+            id INTEGER PRIMARY KEY,
+            model TEXT NOT NULL,
+            fields TEXT NOT NULL,
+            created INTEGER NOT NULL,
+            modified INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS cards (
+            id INTEGER PRIMARY KEY,
+            note_id INTEGER NOT NULL REFERENCES notes(id) ON DELETE CASCADE,
+            ord INTEGER NOT NULL,
+            deck_id INTEGER NOT NULL REFERENCES decks(id),
+            due INTEGER,
+            interval INTEGER NOT NULL DEFAULT 0,
+            ease INTEGER NOT NULL DEFAULT 0,
+            reps INTEGER NOT NULL DEFAULT 0,
+            lapses INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (note_id, ord)
+        );
+        CREATE INDEX IF NOT EXISTS cards_deck ON cards(deck_id);
+        CREATE TABLE IF NOT EXISTS tags (
+            note_id INTEGER NOT NULL REFERENCES notes(id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            PRIMARY KEY (note_id, name)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS tags_name ON tags(name);
+        CREATE TABLE IF NOT EXISTS media (
+            filename TEXT PRIMARY KEY,
+            checksum TEXT NOT NULL,
+            data BLOB NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        if not path:
+            raise KnowledgeException("Variable knowledge_srs_db has to be set")
+
+        # Transactions are managed explicitly
+        self.db = sqlite3.connect(os.path.expanduser(path), timeout=10, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA foreign_keys=ON')
+        self.db.executescript(self.SCHEMA)
+
+        # Deck ids looked up during the session, keyed by name
+        self.deck_ids = dict()
+
+    def cleanup(self):
+        if self.db.in_transaction:
+            self.db.execute('ROLLBACK')
+
+        self.db.close()
+        del self.db
+
+    def _begin(self):
+        if not self.db.in_transaction:
+            self.db.execute('BEGIN IMMEDIATE')
+
+    def commit(self):
+        if self.db.in_transaction:
+            self.db.execute('COMMIT')
+
+    def _ords(self, model, fields):
+        """
+        Returns the ords of the cards the note generates, one per cloze for
+        the cloze notes.
+        """
+
+        return cloze_ords(fields) if model == self.CLOSE_MODEL else {0}
+
+    def prepare_decks(self, decks):
+        """
+        Creates the decks not known to exist yet.
+        """
+
+        names = set(
+            deck.replace('.', '::')
+            for deck in decks
+            if deck is not None
+        ) - set(self.deck_ids)
+
+        if not names:
+            return
+
+        self._begin()
+        self.db.executemany(
+            "INSERT OR IGNORE INTO decks (name) VALUES (?)",
+            [(name,) for name in names]
+        )
+
+        placeholders = ','.join('?' * len(names))
+        self.deck_ids.update(self.db.execute(
+            f"SELECT name, id FROM decks WHERE name IN ({placeholders})",
+            list(names)
+        ))
+
+    def _deck_id(self, name):
+        name = name.replace('.', '::')
+
+        if name not in self.deck_ids:
+            self.prepare_decks([name])
+
+        return self.deck_ids[name]
+
+    def add_media_file(self, filename):
+        """
+        Stores the media file in the database. A different file with the
+        same name is stored under a name suffixed by its checksum.
+        """
+
+        filename_abs = self.absolute_path(filename)
+
+        with open(filename_abs, 'rb') as f:
+            data = f.read()
+
+        checksum = hashlib.sha1(data).hexdigest()
+        name = os.path.basename(filename_abs)
+
+        existing = self.db.execute(
+            "SELECT checksum FROM media WHERE filename=?", (name,)
+        ).fetchone()
+
+        if existing is not None and existing[0] != checksum:
+            stem, extension = os.path.splitext(name)
+            name = f'{stem}-{checksum[:8]}{extension}'
+
+        self._begin()
+        self.db.execute(
+            "INSERT OR IGNORE INTO media (filename, checksum, data) VALUES (?, ?, ?)",
+            (name, checksum, data)
+        )
+
+        return name
+
+    def add_note(self, deck, model, fields, tags=None):
+        """
+        Adds a new note of the given model to the given deck.
+        """
+
+        return self.add_notes([dict(deck=deck, model=model, fields=fields, tags=tags)])[0]
+
+    def add_notes(self, notes):
+        """
+        Adds the given notes, together with their cards and tags.
+        """
+
+        notes = list(notes)
+        self.prepare_decks(data['deck'] for data in notes)
+        self._begin()
+
+        now = int(time.time())
+        first_id = self.db.execute("SELECT coalesce(max(id), 0) + 1 FROM notes").fetchone()[0]
+
+        rows = []
+        cards = []
+        tags = []
+
+        for identifier, data in enumerate(notes, start=first_id):
+            fields = self.process_all(data['fields'])
+            deck_id = self._deck_id(data['deck'])
+
+            rows.append((identifier, data['model'], json.dumps(fields), now, now))
+            cards.extend(
+                (identifier, ord, deck_id)
+                for ord in sorted(self._ords(data['model'], fields))
+            )
+            tags.extend(
+                (identifier, tag)
+                for tag in self.embedded_tags(data.get('tags'), data.get('knowledge_id'))
+            )
+
+        self.db.executemany(
+            "INSERT INTO notes (id, model, fields, created, modified) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        self.db.executemany("INSERT INTO cards (note_id, ord, deck_id) VALUES (?, ?, ?)", cards)
+        self.db.executemany("INSERT INTO tags (note_id, name) VALUES (?, ?)", tags)
+
+        return [str(row[0]) for row in rows]
+
+    def update_note(self, identifier, fields, deck=None, model=None, tags=None):
+        self.update_notes([
+            dict(identifier=identifier, fields=fields, deck=deck, model=model, tags=tags)
+        ])
+
+    def _snapshot(self, identifiers):
+        """
+        Returns the current model, fields, tags, card ords and decks of the
+        given notes, keyed by their ids.
+        """
+
+        snapshot = dict()
+
+        for index in range(0, len(identifiers), self.SNAPSHOT_CHUNK_SIZE):
+            chunk = identifiers[index:index+self.SNAPSHOT_CHUNK_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+
+            for identifier, model, fields in self.db.execute(
+                    f"SELECT id, model, fields FROM notes WHERE id IN ({placeholders})",
+                    chunk):
+                snapshot[identifier] = dict(
+                    model=model, fields=json.loads(fields), tags=set(), ords=set(), decks=set()
+                )
+
+            for identifier, name in self.db.execute(
+                    f"SELECT note_id, name FROM tags WHERE note_id IN ({placeholders})",
+                    chunk):
+                snapshot[identifier]['tags'].add(name)
+
+            for identifier, ord, deck_id in self.db.execute(
+                    f"SELECT note_id, ord, deck_id FROM cards WHERE note_id IN ({placeholders})",
+                    chunk):
+                snapshot[identifier]['ords'].add(ord)
+                snapshot[identifier]['decks'].add(deck_id)
+
+        return snapshot
+
+    def update_notes(self, notes):
+        """
+        Updates the given notes, writing only the actual changes. The cards
+        of the removed clozes are deleted, the new clozes get new cards.
+        """
+
+        notes = list(notes)
+        if not notes:
+            return
+
+        self.prepare_decks(data['deck'] for data in notes)
+        self._begin()
+
+        snapshot = self._snapshot([int(data['identifier']) for data in notes])
+        now = int(time.time())
+
+        for data in notes:
+            identifier = int(data['identifier'])
+
+            if identifier not in snapshot:
+                raise FactNotFoundException("Fact with ID '{0}' could not be found"
+                                            .format(identifier))
+
+            current = snapshot[identifier]
+            model = data.get('model') or current['model']
+            fields = self.process_all(data['fields'])
+            tags = self.embedded_tags(data.get('tags'), data.get('knowledge_id'), current['tags'])
+            deck_id = self._deck_id(data['deck'])
+
+            if current['fields'] != fields or current['model'] != model:
+                self.db.execute(
+                    "UPDATE notes SET model=?, fields=?, modified=? WHERE id=?",
+                    (model, json.dumps(fields), now, identifier)
+                )
+
+                ords = self._ords(model, fields)
+                for ord in current['ords'] - ords:
+                    self.db.execute("DELETE FROM cards WHERE note_id=? AND ord=?", (identifier, ord))
+                for ord in ords - current['ords']:
+                    self.db.execute(
+                        "INSERT INTO cards (note_id, ord, deck_id) VALUES (?, ?, ?)",
+                        (identifier, ord, deck_id)
+                    )
+
+            if current['decks'] != {deck_id}:
+                self.db.execute("UPDATE cards SET deck_id=? WHERE note_id=?", (deck_id, identifier))
+
+            if current['tags'] != tags:
+                self.db.execute("DELETE FROM tags WHERE note_id=?", (identifier,))
+                self.db.executemany(
+                    "INSERT INTO tags (note_id, name) VALUES (?, ?)",
+                    [(identifier, tag) for tag in tags]
+                )
+
+    def embed_identifiers(self, identifiers):
+        """
+        Adds the tags embedding the knowledge identifiers to the given notes,
+        using a single statement.
+        """
+
+        self._begin()
+        cursor = self.db.executemany(
+            "INSERT OR IGNORE INTO tags (note_id, name) SELECT id, ? FROM notes WHERE id=?",
+            [
+                (ID_TAG_PREFIX + knowledge_id, int(fact_id))
+                for knowledge_id, fact_id in identifiers.items()
+            ]
+        )
+
+        return max(cursor.rowcount, 0)
+
+    def get_identifiers(self):
+        """
+        Returns a set of the SRS identifiers of all the knowledge-generated
+        cards.
+        """
+
+        return self.read_identifiers(self.db)
+
+    def note_info(self, identifier):
+        """
+        Obtain information about the note.
+        """
+
+        return self.read_note_info(self.db, identifier)
+
+    @staticmethod
+    def read_identifiers(db):
+        return set(
+            str(identifier)
+            for identifier, in db.execute("SELECT note_id FROM tags WHERE name='knowledge'")
+        )
+
+    @staticmethod
+    def read_embedded_identifiers(db):
+        return [
+            (name[len(ID_TAG_PREFIX):], str(identifier))
+            for name, identifier in db.execute(
+                "SELECT name, note_id FROM tags WHERE name GLOB ?",
+                (ID_TAG_PREFIX + '*',)
+            )
+        ]
+
+    @staticmethod
+    def read_note_info(db, identifier):
+        """
+        Reads the information about the note from the given database
+        connection, shared with the read-only queries.
+        """
+
+        card = db.execute(
+            "SELECT cards.id, cards.ord, cards.due, cards.interval, cards.ease, "
+            "cards.reps, cards.lapses, notes.created, notes.model, decks.name "
+            "FROM cards JOIN notes ON notes.id = cards.note_id "
+            "JOIN decks ON decks.id = cards.deck_id "
+            "WHERE cards.note_id=? ORDER BY cards.ord LIMIT 1",
+            (int(identifier),)
+        ).fetchone()
+
+        if card is None:
+            raise FactNotFoundException("Fact with ID '{0}' could not be found"
+                                        .format(identifier))
+
+        card_id, ord, due, interval, ease, reps, lapses, created, model, deck = card
+
+        return {
+            'added': datetime.fromtimestamp(created),
+            'first_review': None,
+            'last_review': None,
+            'ease': ease / 10.0,
+            'reviews': reps,
+            'lapses': lapses,
+            'card_type': f'Card {ord + 1}',
+            'note_type': model,
+            'deck': deck,
+            'note_id': int(identifier),
+            'card_id': card_id,
+            'total_time': None,
+            'average_time': None,
+            'due': datetime.fromtimestamp(due) if due is not None else None,
+            'interval': interval * 86400 if interval else None
+        }
+
+
+class DaemonProxy(SRSProxy):
+    """
+    Forwards the requests to the knowledge daemon, which owns the proxy of the
+    configured SRS provider, see knowledge/daemon.py. The daemon is started if
+    it is not running yet.
+    """
+
+    PROVIDERS = {
+        'Anki': AnkiProxy,
+        'AnkiConnect': AnkiConnectProxy,
+        'Mnemosyne': MnemosyneProxy,
+        'SQLite': SQLiteProxy,
+    }
+
+    def __init__(self, path=None):
+        provider = self.PROVIDERS.get(config.SRS_PROVIDER)
+
+        if provider is None:
+            raise KnowledgeException(
+                "Variable knowledge_srs_provider has to have "
+                "one of the following values: Anki, AnkiConnect, Mnemosyne, SQLite"
+            )
+
+        # The notes are created with the defaults of the actual provider
+        self.DEFAULT_DECK = provider.DEFAULT_DECK
+        self.DEFAULT_MODEL = provider.DEFAULT_MODEL
+        self.CLOSE_MODEL = provider.CLOSE_MODEL
+
+        self.path = path or daemon.socket_path()
+
+    def call(self, method, *args):
+        """
+        Sends the request to the daemon and returns the result, starting the
+        daemon if needed. Re-raises the exceptions raised by the daemon.
+        """
+
+        request = daemon.encode({
+            'method': method,
+            'args': args,
+            'base_dir': self.relative_base_dir(),
+        })
+
+        with self.connect() as connection:
+            connection.sendall(request)
+
+            with connection.makefile('rb') as stream:
+                line = stream.readline()
+
+        if not line:
+            raise KnowledgeException("The knowledge daemon closed the connection")
+
+        response = daemon.decode(line)
+
+        if 'identifiers' in response:
+            raise PartialAddException(response['message'], response['identifiers'])
+
+        if 'error' in response:
+            exception = getattr(errors, response['error'], None)
+            if not (isinstance(exception, type) and issubclass(exception, KnowledgeException)):
+                exception = KnowledgeException
+            raise exception(response['message'])
+
+        return response['result']
+
+    def connect(self):
+        """
+        Connects to the daemon, starting it if it is not running.
+        """
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            connection.connect(self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # The daemon is not running, or it just exited being idle
+            connection.close()
+            daemon.start(self.path)
+
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(self.path)
+
+        return connection
+
+    def add_note(self, deck, model, fields, tags=None):
+        return self.add_notes([dict(deck=deck, model=model, fields=fields, tags=tags)])[0]
+
+    def add_notes(self, notes):
+        return self.call('add_notes', notes)
+
+    def update_note(self, identifier, fields, deck=None, model=None, tags=None):
+        self.update_notes([
+            dict(identifier=identifier, fields=fields, deck=deck, model=model, tags=tags)
+        ])
+
+    def update_notes(self, notes):
+        self.call('update_notes', notes)
+
+    def embed_identifiers(self, identifiers):
+        return self.call('embed_identifiers', identifiers)
+
+    def prepare_decks(self, decks):
+        self.call('prepare_decks', list(decks))
+
+    def add_media_file(self, filename):
+        return self.call('add_media_file', str(filename))
+
+    def get_identifiers(self):
+        return set(self.call('get_identifiers'))
+
+    def note_info(self, identifier):
+        return self.call('note_info', identifier)
+
+    def commit(self):
+        self.call('commit')
+
+    def cleanup(self):
+        # Every request uses its own connection, nothing to close
+        pass
@@ -0,0 +1,604 @@
+"""
+Read-only access to the SRS collection, answering the lookups that do not
+modify anything (note_info, get_identifiers) with plain SQL. Unlike the
+proxies, this opens neither the Anki Collection nor the Mnemosyne instance,
+hence it is fast and works while the SRS application is running. With
+AnkiConnect, the lookups are answered by the running Anki instead.
+"""
+
+import json
+import os
+import pathlib
+import sqlite3
+import time
+
+from datetime import datetime
+
+from knowledge import config, constants
+from knowledge.errors import KnowledgeException, FactNotFoundException
+from knowledge.proxy import AnkiProxy, AnkiConnectProxy, MnemosyneProxy, SQLiteProxy, ID_TAG_PREFIX
+
+# Maximum number of the identifiers passed to a single query, SQLite limits
+# the number of the query parameters
+QUERY_CHUNK_SIZE = 500
+
+
+def connect(path):
+    """
+    Opens the given SQLite database in the read-only mode. If the database
+    is locked exclusively (as Anki does while running), the file is read as
+    it is on the disk, i.e. without the changes not yet checkpointed by the
+    SRS application.
+    """
+
+    path = os.path.expanduser(path)
+
+    if not os.path.isfile(path):
+        raise KnowledgeException(f"SRS database '{path}' does not exist")
+
+    uri = pathlib.Path(path).resolve().as_uri()
+
+    try:
+        db = sqlite3.connect(f'{uri}?mode=ro', uri=True, timeout=0)
+        # The lock is only acquired by the first read
+        db.execute('SELECT count() FROM sqlite_master').fetchone()
+    except sqlite3.OperationalError:
+        db = sqlite3.connect(f'{uri}?immutable=1', uri=True)
+
+    return db
+
+
+def protobuf_fields(blob):
+    """
+    Decodes the top-level fields of the given protobuf message, as stored in
+    the config columns of the newer Anki collections. Returns a dict mapping
+    the field numbers to their first values, the varints as integers and the
+    length-delimited values as bytes.
+    """
+
+    def varint(position):
+        value = shift = 0
+        while True:
+            byte = blob[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return value, position
+
+    fields = dict()
+    position = 0
+
+    while position < len(blob):
+        key, position = varint(position)
+        number, wire_type = key >> 3, key & 0x7
+
+        if wire_type == 0:
+            value, position = varint(position)
+        elif wire_type == 2:
+            length, position = varint(position)
+            value = bytes(blob[position:position+length])
+            position += length
+        elif wire_type in (1, 5):
+            size = 8 if wire_type == 1 else 4
+            value = bytes(blob[position:position+size])
+            position += size
+        else:
+            raise KnowledgeException(f"Unsupported protobuf wire type {wire_type}")
+
+        fields.setdefault(number, value)
+
+    return fields
+
+
+def get_queries():
+    """
+    Opens the read-only access to the collection of the configured SRS
+    provider.
+    """
+
+    if config.SRS_PROVIDER == 'Anki':
+        return AnkiQueries(config.SRS_DB)
+    elif config.SRS_PROVIDER == 'AnkiConnect':
+        return AnkiConnectQueries()
+    elif config.SRS_PROVIDER == 'Mnemosyne':
+        return MnemosyneQueries(config.SRS_DB)
+    elif config.SRS_PROVIDER == 'SQLite':
+        return SQLiteQueries(config.SRS_DB)
+    elif config.SRS_PROVIDER is None:
+        raise KnowledgeException(
+            "Variable knowledge_srs_provider has to have "
+            "one of the following values: Anki, AnkiConnect, Mnemosyne, SQLite"
+        )
+    else:
+        raise KnowledgeException(
+            "SRS provider '{0}' is not supported."
+            .format(config.SRS_PROVIDER)
+        )
+
+
+class SRSQueries(object):
+    """
+    Read-only lookups in the SRS database. Carries the defaults of the
+    corresponding proxy, so that the notes can be parsed with it.
+    """
+
+    provider = None
+
+    # Number of the query parameters bound per note by _cards_status
+    STATUS_PARAMETERS = 1
+
+    def __init__(self, path):
+        self.db = connect(path)
+
+        self.DEFAULT_DECK = self.provider.DEFAULT_DECK
+        self.DEFAULT_MODEL = self.provider.DEFAULT_MODEL
+        self.CLOSE_MODEL = self.provider.CLOSE_MODEL
+
+    def cleanup(self):
+        self.db.close()
+
+    def get_identifiers(self):
+        """
+        Returns a set of the SRS identifiers of all the knowledge-generated
+        cards.
+        """
+
+        raise NotImplementedError
+
+    def note_info(self, identifier):
+        """
+        Obtain information about the note, see SRSProxy.note_info.
+        """
+
+        raise NotImplementedError
+
+    def note_types(self):
+        """
+        Returns the note types of the collection in the legacy Anki format
+        (with the id, name, type, mod, flds and tmpls keys), keyed by name.
+        The SRS applications without the Anki note types have none.
+        """
+
+        return dict()
+
+    def embedded_identifiers(self):
+        """
+        Returns the list of the (knowledge identifier, SRS identifier) pairs
+        of all the notes with the knowledge identifier embedded, using a
+        single query.
+        """
+
+        raise NotImplementedError
+
+    def notes_status(self, identifiers):
+        """
+        Returns the review status of all the given notes, as a dict mapping
+        the identifiers to dicts with the due, ease, lapses, reviews and
+        last_review keys. Notes with multiple cards report the earliest due
+        date, the lowest ease and the most lapses of their cards. Notes not
+        found in the collection are omitted.
+        """
+
+        identifiers = list(set(str(identifier) for identifier in identifiers))
+        chunk_size = QUERY_CHUNK_SIZE // self.STATUS_PARAMETERS
+        result = dict()
+
+        for index in range(0, len(identifiers), chunk_size):
+            chunk = identifiers[index:index+chunk_size]
+
+            for identifier, due, ease, lapses, reviews, last_review in self._cards_status(chunk):
+                status = result.setdefault(str(identifier), {
+                    'due': None,
+                    'ease': None,
+                    'lapses': 0,
+                    'reviews': 0,
+                    'last_review': None,
+                })
+
+                if due is not None:
+                    status['due'] = min(filter(None, [status['due'], due]))
+                if ease:
+                    status['ease'] = min(filter(None, [status['ease'], ease]))
+                if last_review is not None:
+                    status['last_review'] = max(filter(None, [status['last_review'], last_review]))
+
+                status['lapses'] = max(status['lapses'], lapses)
+                status['reviews'] += reviews
+
+        return result
+
+    def _cards_status(self, identifiers):
+        """
+        Yields the (note identifier, due, ease, lapses, reviews, last review)
+        tuples for all the cards of the given notes, using a single query.
+        """
+
+        raise NotImplementedError
+
+
+class AnkiQueries(SRSQueries):
+
+    provider = AnkiProxy
+    STATUS_PARAMETERS = 2
+
+    def _has_table(self, name):
+        return self.db.execute(
+            "SELECT count() FROM sqlite_master WHERE type='table' AND name=?",
+            (name,)
+        ).fetchone()[0] > 0
+
+    def _names(self, model_id, template_ord, deck_id):
+        """
+        Returns the names of the card template, the model and the deck.
+        Newer collections store these in separate tables, older ones as JSON
+        in the col table.
+        """
+
+        if self._has_table('notetypes'):
+            model = self.db.execute(
+                "SELECT name FROM notetypes WHERE id=?", (model_id,)
+            ).fetchone()[0]
+            templates = dict(self.db.execute(
+                "SELECT ord, name FROM templates WHERE ntid=?", (model_id,)
+            ))
+            deck = self.db.execute(
+                "SELECT name FROM decks WHERE id=?", (deck_id,)
+            ).fetchone()[0].replace('\x1f', '::')
+        else:
+            models, decks = self.db.execute("SELECT models, decks FROM col").fetchone()
+            model = json.loads(models)[str(model_id)]
+            templates = {
+                template['ord']: template['name']
+                for template in model['tmpls']
+            }
+            model = model['name']
+            deck = json.loads(decks)[str(deck_id)]['name']
+
+        # Cloze cards share the first template
+        template = templates.get(template_ord, templates.get(0))
+
+        return template, model, deck
+
+    def note_types(self):
+        if not self._has_table('notetypes'):
+            models = json.loads(self.db.execute("SELECT models FROM col").fetchone()[0])
+            return {model['name']: model for model in models.values()}
+
+        note_types = dict()
+
+        # The newer collections keep the settings as protobuf messages, see
+        # Notetype.Config and Notetype.Template.Config of Anki
+        for model_id, name, modified, config in self.db.execute(
+            "SELECT id, name, mtime_secs, config FROM notetypes"
+        ):
+            config = protobuf_fields(config)
+            fields = self.db.execute(
+                "SELECT ord, name FROM fields WHERE ntid=? ORDER BY ord", (model_id,)
+            ).fetchall()
+            templates = self.db.execute(
+                "SELECT ord, name, config FROM templates WHERE ntid=? ORDER BY ord", (model_id,)
+            ).fetchall()
+
+            note_types[name] = {
+                'id': model_id,
+                'name': name,
+                'type': config.get(1, 0),
+                'mod': modified,
+                'sortf': config.get(2, 0),
+                'flds': [{'name': field, 'ord': ord} for ord, field in fields],
+                'tmpls': [
+                    {
+                        'name': template,
+                        'ord': ord,
+                        'qfmt': protobuf_fields(template_config).get(1, b'').decode('utf-8'),
+                        'afmt': protobuf_fields(template_config).get(2, b'').decode('utf-8'),
+                    }
+                    for ord, template, template_config in templates
+                ],
+            }
+
+            for key, number in (('css', 3), ('latexPre', 5), ('latexPost', 6)):
+                if number in config:
+                    note_types[name][key] = config[number].decode('utf-8')
+
+        return note_types
+
+    def get_identifiers(self):
+        return set(
+            str(identifier)
+            for identifier, in self.db.execute(
+                "SELECT id FROM notes "
+                "WHERE lower(tags) LIKE '% knowledge %' "
+                "OR lower(tags) LIKE '% knowledge::%'"
+            )
+        )
+
+    def embedded_identifiers(self):
+        # The knowledge identifiers are stored as the note guids, which Anki
+        # generates shorter and from a wider alphabet
+        return [
+            (guid, str(identifier))
+            for guid, identifier in self.db.execute(
+                "SELECT guid, id FROM notes WHERE length(guid) = ? "
+                "AND (lower(tags) LIKE '% knowledge %' "
+                "OR lower(tags) LIKE '% knowledge::%')",
+                (constants.IDENTIFIER_LENGTH,)
+            )
+            if all(char in constants.ALPHABET for char in guid)
+        ]
+
+    def note_info(self, identifier):
+        card = self.db.execute(
+            "SELECT cards.id, cards.nid, cards.did, cards.ord, cards.type, "
+            "cards.queue, cards.due, cards.ivl, cards.factor, cards.reps, "
+            "cards.lapses, notes.mid "
+            "FROM cards JOIN notes ON notes.id = cards.nid "
+            "WHERE cards.nid=? ORDER BY cards.ord, cards.id LIMIT 1",
+            (int(identifier),)
+        ).fetchone()
+
+        if card is None:
+            raise FactNotFoundException("Fact with ID '{0}' could not be found"
+                                        .format(identifier))
+
+        (card_id, note_id, deck_id, template_ord, card_type, queue,
+         due, interval, factor, reps, lapses, model_id) = card
+
+        first_review, last_review, num_revisions, total_time = self.db.execute(
+            "SELECT min(id), max(id), count(), sum(time)/1000 FROM revlog WHERE cid=?",
+            (card_id,)
+        ).fetchone()
+
+        if card_type in (1, 2):
+            if queue in (2, 3):
+                # Review cards are due in days since the collection creation
+                created = self.db.execute("SELECT crt FROM col").fetchone()[0]
+                today = int((time.time() - created) // 86400)
+                due = time.time() + (due - today) * 86400
+        else:
+            due = None
+
+        template, model, deck = self._names(model_id, template_ord, deck_id)
+
+        return {
+            'added': datetime.fromtimestamp(card_id / 1000),
+            'first_review': datetime.fromtimestamp(first_review / 1000) if first_review else None,
+            'last_review': datetime.fromtimestamp(last_review / 1000) if last_review else None,
+            'ease': factor / 10.0,
+            'reviews': reps,
+            'lapses': lapses,
+            'card_type': template,
+            'note_type': model,
+            'deck': deck,
+            'note_id': note_id,
+            'card_id': card_id,
+            'total_time': total_time,
+            'average_time': (total_time / num_revisions) if num_revisions else None,
+            'due': datetime.fromtimestamp(due) if due is not None else None,
+            'interval': interval * 86400 if queue == 2 else None
+        }
+
+    def _cards_status(self, identifiers):
+        created = self.db.execute("SELECT crt FROM col").fetchone()[0]
+        today = int((time.time() - created) // 86400)
+        placeholders = ','.join('?' * len(identifiers))
+
+        rows = self.db.execute(
+            "SELECT cards.nid, cards.type, cards.queue, cards.due, cards.factor, "
+            "cards.lapses, coalesce(revlog.reviews, 0), revlog.last_review "
+            "FROM cards LEFT JOIN ("
+            "  SELECT cid, count() AS reviews, max(id) AS last_review FROM revlog "
+            f"  WHERE cid IN (SELECT id FROM cards WHERE nid IN ({placeholders})) "
+            "  GROUP BY cid"
+            ") AS revlog ON revlog.cid = cards.id "
+            f"WHERE cards.nid IN ({placeholders})",
+            [int(identifier) for identifier in identifiers] * 2
+        )
+
+        for note_id, card_type, queue, due, factor, lapses, reviews, last_review in rows:
+            if card_type not in (1, 2):
+                due = None
+            elif queue in (2, 3):
+                due = time.time() + (due - today) * 86400
+
+            yield (
+                note_id,
+                datetime.fromtimestamp(due) if due is not None else None,
+                factor / 10.0,
+                lapses,
+                reviews,
+                datetime.fromtimestamp(last_review / 1000) if last_review else None,
+            )
+
+
+class AnkiConnectQueries(SRSQueries):
+    """
+    Lookups answered by the running Anki through AnkiConnect, as there is no
+    collection file to read.
+    """
+
+    provider = AnkiConnectProxy
+
+    def __init__(self, url=None):
+        self.proxy = AnkiConnectProxy(url)
+
+        self.DEFAULT_DECK = self.provider.DEFAULT_DECK
+        self.DEFAULT_MODEL = self.provider.DEFAULT_MODEL
+        self.CLOSE_MODEL = self.provider.CLOSE_MODEL
+
+    def cleanup(self):
+        self.proxy.cleanup()
+
+    def get_identifiers(self):
+        return self.proxy.get_identifiers()
+
+    def embedded_identifiers(self):
+        return self.proxy.embedded_identifiers()
+
+    def note_types(self):
+        names = self.proxy.request('modelNames')
+        return {
+            model['name']: model
+            for model in self.proxy.request('findModelsByName', modelNames=names)
+        }
+
+    def note_info(self, identifier):
+        return self.proxy.note_info(identifier)
+
+    def _cards_status(self, identifiers):
+        query = 'nid:' + ','.join(str(int(identifier)) for identifier in identifiers)
+        cards, reviews = self.proxy.cards_info(query)
+
+        for card in cards:
+            card_reviews = reviews.get(str(card['cardId']), [])
+            due = self.proxy.card_due(card, card_reviews)
+            last_review = max((review['id'] for review in card_reviews), default=None)
+
+            yield (
+                card['note'],
+                datetime.fromtimestamp(due) if due is not None else None,
+                card['factor'] / 10.0,
+                card['lapses'],
+                len(card_reviews),
+                datetime.fromtimestamp(last_review / 1000) if last_review else None,
+            )
+
+
+class MnemosyneQueries(SRSQueries):
+
+    provider = MnemosyneProxy
+    STATUS_PARAMETERS = 2
+
+    # Type of the log events recording the repetitions, see
+    # mnemosyne.libmnemosyne.logger.EventTypes
+    REPETITION = 9
+
+    def get_identifiers(self):
+        return set(
+            identifier
+            for identifier, in self.db.execute(
+                "SELECT DISTINCT facts.id FROM facts "
+                "JOIN cards ON cards._fact_id = facts._id "
+                "JOIN tags_for_card ON tags_for_card._card_id = cards._id "
+                "JOIN tags ON tags._id = tags_for_card._tag_id "
+                "WHERE tags.name = 'knowledge'"
+            )
+        )
+
+    def embedded_identifiers(self):
+        return [
+            (name[len(ID_TAG_PREFIX):], identifier)
+            for name, identifier in self.db.execute(
+                "SELECT DISTINCT tags.name, facts.id FROM tags "
+                "JOIN tags_for_card ON tags_for_card._tag_id = tags._id "
+                "JOIN cards ON cards._id = tags_for_card._card_id "
+                "JOIN facts ON facts._id = cards._fact_id "
+                "WHERE tags.name GLOB ?",
+                (ID_TAG_PREFIX + '*',)
+            )
+        ]
+
+    def note_info(self, identifier):
+        card = self.db.execute(
+            "SELECT cards.id, cards.card_type_id, cards.fact_view_id, "
+            "cards.creation_time, cards.next_rep, cards.last_rep, "
+            "cards.easiness, cards.acq_reps + cards.ret_reps, cards.lapses "
+            "FROM cards JOIN facts ON facts._id = cards._fact_id "
+            "WHERE facts.id=? ORDER BY cards._id LIMIT 1",
+            (identifier,)
+        ).fetchone()
+
+        if card is None:
+            raise FactNotFoundException("Fact with ID '{0}' could not be found"
+                                        .format(identifier))
+
+        (card_id, card_type, fact_view, created, next_rep, last_rep,
+         easiness, reps, lapses) = card
+
+        first_review, last_review, num_revisions, total_time = self.db.execute(
+            "SELECT min(timestamp), max(timestamp), count(), sum(thinking_time) "
+            "FROM log WHERE event_type=? AND object_id=?",
+            (self.REPETITION, card_id)
+        ).fetchone()
+
+        return {
+            'added': datetime.fromtimestamp(created),
+            'first_review': datetime.fromtimestamp(first_review) if first_review else None,
+            'last_review': datetime.fromtimestamp(last_review) if last_review else None,
+            'ease': easiness * 100,
+            'reviews': reps,
+            'lapses': lapses,
+            'card_type': fact_view,
+            'note_type': card_type,
+            # Mnemosyne stores the decks as tags
+            'deck': None,
+            'note_id': identifier,
+            'card_id': card_id,
+            'total_time': total_time,
+            'average_time': (total_time / num_revisions) if num_revisions else None,
+            'due': datetime.fromtimestamp(next_rep) if next_rep > 0 else None,
+            'interval': (next_rep - last_rep) if last_rep > 0 else None
+        }
+
+    def _cards_status(self, identifiers):
+        placeholders = ','.join('?' * len(identifiers))
+
+        # The repetitions are aggregated only for the cards of the given facts
+        rows = self.db.execute(
+            "SELECT facts.id, cards.next_rep, cards.easiness, cards.lapses, "
+            "coalesce(log.reviews, 0), log.last_review "
+            "FROM cards JOIN facts ON facts._id = cards._fact_id "
+            "LEFT JOIN ("
+            "  SELECT object_id, count() AS reviews, max(timestamp) AS last_review FROM log "
+            "  WHERE event_type=? AND object_id IN ("
+            "    SELECT cards.id FROM cards JOIN facts ON facts._id = cards._fact_id "
+            f"    WHERE facts.id IN ({placeholders})"
+            "  ) GROUP BY object_id"
+            ") AS log ON log.object_id = cards.id "
+            f"WHERE facts.id IN ({placeholders})",
+            [self.REPETITION] + identifiers + identifiers
+        )
+
+        for fact_id, next_rep, easiness, lapses, reviews, last_review in rows:
+            yield (
+                fact_id,
+                datetime.fromtimestamp(next_rep) if next_rep > 0 else None,
+                easiness * 100,
+                lapses,
+                reviews,
+                datetime.fromtimestamp(last_review) if last_review else None,
+            )
+
+
+class SQLiteQueries(SRSQueries):
+
+    provider = SQLiteProxy
+
+    def get_identifiers(self):
+        return SQLiteProxy.read_identifiers(self.db)
+
+    def embedded_identifiers(self):
+        return SQLiteProxy.read_embedded_identifiers(self.db)
+
+    def note_info(self, identifier):
+        return SQLiteProxy.read_note_info(self.db, identifier)
+
+    def _cards_status(self, identifiers):
+        placeholders = ','.join('?' * len(identifiers))
+
+        rows = self.db.execute(
+            "SELECT note_id, due, ease, lapses, reps FROM cards "
+            f"WHERE note_id IN ({placeholders})",
+            [int(identifier) for identifier in identifiers]
+        )
+
+        for note_id, due, ease, lapses, reps in rows:
+            yield (
+                note_id,
+                datetime.fromtimestamp(due) if due is not None else None,
+                ease / 10.0,
+                lapses,
+                reps,
+                None,
+            )
@@ -24,6 +24,9 @@ QUESTION = re.compile(
 CLOSE_MARK = re.compile(r'(^(?!    ).*\s\{[^\{]+)|(^\{[^\{]+)', re.MULTILINE)
 CLOSE_IDENTIFIER = re.compile(r'\s@(?P<identifier>[A-Za-z0-9]{11})\s*$', re.MULTILINE)
 
+# Any identifier placed into the text, regardless of its position
+IDENTIFIER_MARK = re.compile(r' @(?P<identifier>[A-Za-z0-9]{11})(?![A-Za-z0-9])')
+
 NOTE_HEADLINE = {
     'default': re.compile(
         r'^'                       # Starts at the begging of the line
@@ -50,3 +53,15 @@ EXTENSION = re.compile(r'\.[^/]+$')
 IMAGE = re.compile(r'!(?P<size>[LMS])?\[(?P<label>.+)\]\(media:(?P<filename>[^\)]+)\)(\{(?P<format>[^\}]+)\})?')
 RAW_IMAGE = re.compile(r'!\[(?P<label>.+)\]\((?P<filepath>[^\)]+)\)(\{(?P<format>[^\}]+)\})?')
 SIMPLE_URL = re.compile(r'(?P<proto>http(s)?://)(?P<domain>[^\s/]+)(?P<resource>[^\s]*)')
+
+# Cheap pre-filter of the lines that can contain a note or a header. Lines that
+# do not match cannot match QUESTION, CLOSE_MARK, NUMLIST_MARK, IMAGE nor
+# NOTE_HEADLINE.
+CANDIDATE = re.compile(
+    r'\{{'                                  # Cloze mark
+    r'|!'                                   # Image
+    r'|^\d'                                 # Enumeration item
+    r'|^[=#]'                               # Header
+    r'|^({prefixes})'                       # Question prefix
+    .format(prefixes='|'.join(config.QUESTION_PREFIXES))
+)
@@ -0,0 +1,63 @@
+"""
+Keeps a single SRS proxy open between the syncs, so that the collection does
+not need to be opened on every save. The proxy is closed once it was not used
+for the configured idle period, so that the SRS application can access the
+collection again.
+"""
+
+import vim
+
+# The proxy kept open between the syncs, if any
+PROXY = None
+
+# Identifier of the vim timer closing the idle proxy, if running
+TIMER = None
+
+
+def acquire(factory):
+    """
+    Returns the open proxy, creating it using the given factory if there is
+    none. The proxy is not closed until it is released again.
+    """
+
+    global PROXY
+
+    stop_timer()
+
+    if PROXY is None:
+        PROXY = factory()
+
+    return PROXY
+
+
+def release(idle_ms):
+    """
+    Schedules the closing of the proxy after the given idle period.
+    """
+
+    global TIMER
+
+    stop_timer()
+    TIMER = vim.eval(f"timer_start({idle_ms}, 'KnowledgeProxyIdle')")
+
+
+def stop_timer():
+    global TIMER
+
+    if TIMER is not None:
+        vim.command(f'call timer_stop({TIMER})')
+        TIMER = None
+
+
+def close():
+    """
+    Closes the open proxy, if any.
+    """
+
+    global PROXY
+
+    stop_timer()
+
+    if PROXY is not None:
+        proxy, PROXY = PROXY, None
+        proxy.cleanup()
@@ -0,0 +1,199 @@
+"""
+Splits the buffer into typed blocks relevant for the note creation.
+"""
+
+import dataclasses
+
+import knowledge as k
+import knowledge.paths
+import knowledge.regexp
+
+# Kinds of the blocks
+HEADER = 'header'
+BASIC = 'basic'
+CLOZE = 'cloze'
+CLOZE_LIST_ITEM = 'cloze list item'
+NUMLIST_ITEM = 'numlist item'
+OCCLUSION = 'occlusion'
+PLAIN = 'plain'
+
+NOTE_KINDS = (BASIC, CLOZE, CLOZE_LIST_ITEM, NUMLIST_ITEM, OCCLUSION)
+
+
+@dataclasses.dataclass
+class Block:
+    kind: str
+    line: int
+    size: int = 1
+    match: object = None
+
+    @property
+    def is_note(self):
+        return self.kind in NOTE_KINDS
+
+
+def classify(line):
+    """
+    Determines the kind of the block the given line starts, together with the
+    relevant regex match. Cloze list items are reported as regular clozes, as
+    telling them apart requires the context of the preceding lines.
+    """
+
+    # Most of the lines are plain text, rule them out as fast as possible
+    if not k.regexp.CANDIDATE.search(line):
+        return PLAIN, None
+
+    basic_question = k.regexp.QUESTION.search(line)
+    close_mark_present = k.regexp.CLOSE_MARK.search(line)
+    numlist_item = k.regexp.NUMLIST_MARK.match(line)
+    occluded_image = k.regexp.IMAGE.search(line)
+
+    # Image line generates a note only if an occlusion exists
+    if occluded_image:
+        path = k.paths.OCCLUSIONS_DIR / occluded_image.group('filename')
+        if not path.exists():
+            basic_question = close_mark_present = numlist_item = occluded_image = None
+
+    if close_mark_present:
+        return CLOZE, close_mark_present
+    elif numlist_item:
+        return NUMLIST_ITEM, numlist_item
+    elif basic_question:
+        return BASIC, basic_question
+    elif occluded_image:
+        return OCCLUSION, occluded_image
+
+    header = k.regexp.NOTE_HEADLINE[k.config.MARKUP_SYNTAX].search(line)
+    if header:
+        return HEADER, header
+
+    return PLAIN, None
+
+
+def tokenize(buffer_proxy, start=0, end=None):
+    """
+    Classifies the lines of the buffer (or of its [start, end) range) in
+    a single pass and generates the stream of the blocks. Consecutive plain
+    lines are merged into a single block.
+
+    The buffer is read lazily, hence the lines modified by the consumer of the
+    already generated blocks are classified in their modified form.
+    """
+
+    in_list = buffer_proxy.boundaries.in_list
+    plain_start = None
+
+    if end is None:
+        end = len(buffer_proxy)
+
+    for number in range(start, end):
+        kind, match = classify(buffer_proxy[number])
+
+        if kind == PLAIN:
+            if plain_start is None:
+                plain_start = number
+            continue
+
+        if plain_start is not None:
+            yield Block(PLAIN, plain_start, number - plain_start)
+            plain_start = None
+
+        if kind == CLOZE and in_list[number]:
+            kind = CLOZE_LIST_ITEM
+
+        yield Block(kind, number, match=match)
+
+    if plain_start is not None:
+        yield Block(PLAIN, plain_start, end - plain_start)
+
+
+class BoundaryIndex(object):
+    """
+    Precomputed paragraph and list item boundaries for every line of the
+    buffer, so that the note parsers can determine the extent of a note
+    without rescanning the buffer.
+
+    The index only depends on whether the lines are empty and on their list
+    item prefixes, see shape().
+    """
+
+    def __init__(self, lines):
+        size = len(lines)
+
+        # First and last non-empty line of the paragraph
+        self.paragraph_start = [0] * size
+        self.paragraph_end = [0] * size
+
+        # First and last line of the list, including its title, i.e. the
+        # lines delimited by the empty lines that are not indented. Notes do
+        # not span over the list boundaries.
+        self.list_start = [0] * size
+        self.list_end = [0] * size
+
+        # Line starting the list item the line belongs to, if any
+        self.item_start = [None] * size
+        self.in_list = [False] * size
+
+        # Last line of the consecutive indented lines following the line
+        self.continuation_end = [0] * size
+
+        paragraph_start = list_start = 0
+        item_start = None
+
+        for number, line in enumerate(lines):
+            empty, item, indented = self.shape(line)
+
+            if empty:
+                paragraph_start = number + 1
+                item_start = None
+                if not indented:
+                    list_start = number + 1
+            elif item:
+                item_start = number
+            elif not indented:
+                item_start = None
+
+            self.paragraph_start[number] = paragraph_start
+            self.list_start[number] = list_start
+            self.item_start[number] = item_start
+            self.in_list[number] = item_start is not None
+
+        paragraph_end = list_end = continuation_end = size - 1
+
+        for number in reversed(range(size)):
+            empty, item, indented = self.shape(lines[number])
+
+            if empty:
+                paragraph_end = number - 1
+                if not indented:
+                    list_end = number - 1
+
+            self.paragraph_end[number] = paragraph_end
+            self.list_end[number] = list_end
+            self.continuation_end[number] = continuation_end
+
+            if not indented:
+                continuation_end = number - 1
+
+    @staticmethod
+    def shape(line):
+        """
+        Returns the properties of the line the index depends on.
+        """
+
+        return not line.strip(), line.startswith('* '), line.startswith('  ')
+
+    @classmethod
+    def preserved(cls, old, new):
+        """
+        Determines whether replacing the old line (or list of lines) by the
+        new one keeps the index valid.
+        """
+
+        if isinstance(old, str) or isinstance(new, str):
+            return isinstance(old, str) and isinstance(new, str) and cls.shape(old) == cls.shape(new)
+
+        return len(old) == len(new) and all(
+            cls.shape(old_line) == cls.shape(new_line)
+            for old_line, new_line in zip(old, new)
+        )
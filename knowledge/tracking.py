@@ -0,0 +1,233 @@
+"""
+Tracks the lines of the buffers modified since their last sync, using the
+change notifications of the editor (listener_add() in Vim, nvim_buf_attach()
+in Neovim), so that the unmodified notes do not need to be parsed again.
+"""
+
+import bisect
+
+import vim
+
+import knowledge as k
+import knowledge.tokenizer
+from knowledge import vimutils
+
+# Change trackers of the buffers, keyed by buffer number
+TRACKERS = dict()
+
+# Collects the changes reported by Neovim until they are drained
+NEOVIM_LISTENER = """
+local buffer = ...
+knowledge_changes = knowledge_changes or {}
+knowledge_changes[buffer] = {}
+
+vim.api.nvim_buf_attach(buffer, false, {
+  on_lines = function(_, buffer, _, first, last, new_last)
+    table.insert(knowledge_changes[buffer], {first, last, new_last - last})
+  end,
+  on_reload = function(_, buffer)
+    table.insert(knowledge_changes[buffer], {-1, -1, 0})
+  end,
+  on_detach = function(_, buffer)
+    table.insert(knowledge_changes[buffer], {-1, -1, 0})
+  end,
+})
+"""
+
+NEOVIM_DRAIN = """
+local buffer = ...
+local changes = knowledge_changes[buffer]
+knowledge_changes[buffer] = {}
+return changes
+"""
+
+
+def supported():
+    """
+    Determines whether the editor reports the buffer changes.
+    """
+
+    if vimutils.NEOVIM:
+        return vim.eval('has("nvim-0.4")') == '1'
+
+    return vim.eval('exists("*listener_add")') == '1'
+
+
+def attach(buffer_number):
+    """
+    Starts tracking the changes of the given buffer, if supported.
+    """
+
+    if buffer_number in TRACKERS or not supported():
+        return
+
+    if vimutils.NEOVIM:
+        vim.exec_lua(NEOVIM_LISTENER, buffer_number)
+    else:
+        vim.command(f"call setbufvar({buffer_number}, 'knowledge_changes', [])")
+        vim.command(f"call listener_add('KnowledgeTrackChanges', {buffer_number})")
+
+    TRACKERS[buffer_number] = ChangeTracker(buffer_number)
+
+
+class ChangeTracker(object):
+    """
+    Keeps the set of the line intervals modified since the last sync of the
+    buffer, together with the header lines seen by that sync. The positions
+    are kept up to date as lines are added or removed.
+
+    The tracker is not valid until the first sync is completed, or after the
+    changes could not be tracked reliably.
+    """
+
+    def __init__(self, buffer_number):
+        self.buffer_number = buffer_number
+        self.valid = False
+
+        # Sorted disjoint [start, end) intervals of the modified lines
+        self.intervals = []
+
+        # Sorted (line, text) pairs of the headers pushed by the last sync,
+        # the text is None if the header line was modified
+        self.headers = []
+
+    def drain(self):
+        """
+        Returns the changes reported by the editor since the last drain, as
+        (start, end, added) triples of the 0-based replaced line range and
+        the number of lines added. Returns None if the buffer is no longer
+        tracked.
+        """
+
+        if vimutils.NEOVIM:
+            changes = vim.exec_lua(NEOVIM_DRAIN, self.buffer_number)
+        else:
+            vim.command(f"call listener_flush({self.buffer_number})")
+            changes = vim.eval(f"getbufvar({self.buffer_number}, 'knowledge_changes', 0)")
+            vim.command(f"call setbufvar({self.buffer_number}, 'knowledge_changes', [])")
+
+        if not isinstance(changes, list):
+            return None
+
+        return [tuple(int(value) for value in change) for change in changes]
+
+    def update(self):
+        """
+        Applies the changes reported by the editor since the last update.
+        """
+
+        changes = self.drain()
+
+        if changes is None:
+            self.valid = False
+            return
+
+        for start, end, added in changes:
+            self.change(start, end, added)
+
+    def change(self, start, end, added):
+        """
+        Records the replacement of the lines in the [start, end) range by
+        end - start + added lines.
+        """
+
+        # The buffer was reloaded, the changes are unknown
+        if start < 0:
+            self.valid = False
+            return
+
+        # Removed lines join their neighbours, consider both modified
+        new_start, new_end = start, end + added
+        if new_end <= new_start:
+            new_start, new_end = max(start - 1, 0), start + 1
+
+        intervals = []
+        for interval_start, interval_end in self.intervals:
+            if interval_end < start:
+                intervals.append((interval_start, interval_end))
+            elif interval_start > end:
+                intervals.append((interval_start + added, interval_end + added))
+            else:
+                new_start = min(new_start, interval_start)
+                new_end = max(new_end, max(interval_end, end) + added)
+
+        bisect.insort(intervals, (new_start, new_end))
+        self.intervals = intervals
+
+        headers = []
+        for line, text in self.headers:
+            if line < start:
+                headers.append((line, text))
+            elif line >= end:
+                headers.append((line + added, text))
+            else:
+                headers.append((start, None))
+
+        self.headers = headers
+
+    def clean(self, buffer_proxy, line):
+        """
+        Determines whether the list containing the given line is unmodified
+        since the last sync. Notes do not span over the list boundaries, but
+        modifying the boundary lines themselves might merge or split lists.
+        """
+
+        boundaries = buffer_proxy.boundaries
+        start = boundaries.list_start[line] - 1
+        end = boundaries.list_end[line] + 2
+
+        index = bisect.bisect_right(self.intervals, (end, end))
+        return index == 0 or self.intervals[index - 1][1] <= start
+
+    def usable(self, buffer_proxy):
+        """
+        Determines whether the unmodified lists can be skipped by the sync.
+        That requires the headers to be the same as at the last sync, so that
+        the metadata of the notes does not change.
+        """
+
+        if not self.valid or len(buffer_proxy) == 0:
+            return False
+
+        # The headers pushed by the last sync must stay untouched
+        for line, text in self.headers:
+            if line >= len(buffer_proxy) or buffer_proxy[line] != text:
+                return False
+            if not self.clean(buffer_proxy, line):
+                return False
+
+        # No new headers can appear in the modified lists
+        boundaries = buffer_proxy.boundaries
+        for start, end in self.intervals:
+            start = boundaries.list_start[min(max(start - 1, 0), len(buffer_proxy) - 1)]
+            end = boundaries.list_end[min(end, len(buffer_proxy) - 1)] + 1
+
+            for line in buffer_proxy[start:end]:
+                kind, match = k.tokenizer.classify(line)
+                if kind == k.tokenizer.HEADER:
+                    return False
+
+        return True
+
+    def reset(self, headers):
+        """
+        Marks the buffer as synchronized, with the given (line, text) header
+        pairs. The lines modified by the sync itself (placed identifiers) are
+        considered modified, as they are a part of the notes.
+        """
+
+        self.valid = True
+        self.intervals = []
+        self.headers = list(headers)
+        self.update()
+
+    def invalidate(self):
+        """
+        Marks the buffer as not synchronized, hence the next sync needs to
+        process the whole buffer.
+        """
+
+        self.drain()
+        self.valid = False
+        self.intervals = []
+        self.headers = []
@@ -82,34 +82,12 @@ def args_to_kwargs(args):
     return output
 
 def is_list_item(buffer_proxy, number):
-    def is_list_indented_line(line):
-        """
-        Returns True, if it is sure that the current line belongs to a list
-        item.
-        Returns False, if it is sure that the current line does not belong to
-        a list item.
-        Returns None, if it cannot be determined from the information given
-        on this line
-        """
-        if line.startswith('* '):
-            return True
-        elif line.startswith('  '):
-            return None
-        else:
-            return False
-
-    for line in reversed(buffer_proxy[:number+1]):
-        # If we stumbled upon an empty line, and have not yet decided that this
-        # indeed is a list item, then it is not
-        if not line.strip():
-            return False
+    """
+    Returns True if the given line belongs to a list item, i.e. it either
+    starts with '* ' or is an indented continuation of such line.
+    """
 
-        if is_list_indented_line(line) is None:
-            # None means we couldn't tell from this line, let's continue
-            continue
-        else:
-            # If we could tell from this line, pass it up
-            return is_list_indented_line(line)
+    return buffer_proxy.boundaries.in_list[number]
 
 
 def run(args):
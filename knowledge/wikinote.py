@@ -2,8 +2,9 @@ import re
 
 import knowledge as k
 import knowledge.paths
+import knowledge.tokenizer
 
-MARKUP_SYNTAX = k.vimutils.get_var('knowledge_syntax', 'default')
+MARKUP_SYNTAX = k.config.MARKUP_SYNTAX
 
 
 class Header(object):
@@ -18,6 +19,10 @@ class Header(object):
         if not match:
             return None, 1
 
+        return cls.from_match(match), 1
+
+    @classmethod
+    def from_match(cls, match):
         self = cls()
         self.data.update({
             'header_start': match.group('header_start'),
@@ -28,7 +33,7 @@ class Header(object):
         metadata = match.group('metadata').strip()
         self.data.update(k.utils.string_to_kwargs(metadata))
 
-        return self, 1
+        return self
 
 
 class WikiNote(object):
@@ -52,49 +57,53 @@ class WikiNote(object):
         - Occluded images
         """
 
-        basic_question = re.search(k.regexp.QUESTION, buffer_proxy[number])
-        close_mark_present = re.search(k.regexp.CLOSE_MARK, buffer_proxy[number])
-        numlist_item = re.match(k.regexp.NUMLIST_MARK, buffer_proxy[number])
-        occluded_image = re.search(k.regexp.IMAGE, buffer_proxy[number])
+        kind, match = k.tokenizer.classify(buffer_proxy[number])
 
-        if not any([basic_question, close_mark_present, numlist_item, occluded_image]):
-            return None, 1
+        if kind == k.tokenizer.CLOZE and k.utils.is_list_item(buffer_proxy, number):
+            kind = k.tokenizer.CLOZE_LIST_ITEM
 
-        # Image line generates a note only if an occlusion exists
-        if occluded_image:
-            path = k.paths.OCCLUSIONS_DIR / occluded_image.group('filename')
-            if not path.exists():
-                return None, 1
+        block = k.tokenizer.Block(kind, number, match=match)
+        return cls.from_block(buffer_proxy, block, proxy, heading, tags, model, deck)
+
+    @classmethod
+    def from_block(cls, buffer_proxy, block, proxy, heading=None, tags=None, model=None, deck=None):
+        """
+        Parses the note data out of the block produced by the tokenizer.
+        Returns the note (None if the block does not contain a note) and the
+        number of lines processed.
+        """
+
+        if not block.is_note:
+            return None, 1
 
         self = cls(buffer_proxy, proxy)
 
         tags = tags or []
         deck = deck or proxy.DEFAULT_DECK
 
-        if close_mark_present:
+        if block.kind in (k.tokenizer.CLOZE, k.tokenizer.CLOZE_LIST_ITEM):
             model = model or proxy.CLOSE_MODEL
         else:
             model = model or proxy.DEFAULT_MODEL
 
         self.data.update({
-            'line': number,
+            'line': block.line,
             'tags': set(tags) | set(['knowledge']),
             'model': model,
             'deck': deck,
             'heading': heading,
         })
 
-        if close_mark_present:
-            if k.utils.is_list_item(buffer_proxy, number):
-                line_shift = self.parse_close_list_item()
-            else:
-                line_shift = self.parse_close()
-        elif numlist_item:
+        if block.kind == k.tokenizer.CLOZE_LIST_ITEM:
+            line_shift = self.parse_close_list_item()
+        elif block.kind == k.tokenizer.CLOZE:
+            line_shift = self.parse_close()
+        elif block.kind == k.tokenizer.NUMLIST_ITEM:
             line_shift = self.parse_numlist_item()
-        elif basic_question:
-            line_shift = self.parse_basic(basic_question)
-        elif occluded_image:
-            line_shift = self.parse_occlusion(occluded_image)
+        elif block.kind == k.tokenizer.BASIC:
+            line_shift = self.parse_basic(block.match)
+        elif block.kind == k.tokenizer.OCCLUSION:
+            line_shift = self.parse_occlusion(block.match)
 
         return self, line_shift
 
@@ -114,12 +123,11 @@ class WikiNote(object):
         answerlines = []
         parsing_question = True
 
-        for line in self.buffer_proxy[(self.data['line']+1):]:
-            candidate = line.strip()
+        # The question spans until the end of the paragraph
+        paragraph_end = self.buffer_proxy.boundaries.paragraph_end[self.data['line']]
 
-            # Empty line finishes the parsing
-            if not candidate:
-                break
+        for line in self.buffer_proxy[(self.data['line']+1):(paragraph_end+1)]:
+            candidate = line.strip()
 
             # First line starting with '- ' denotes start of the answer
             if candidate.startswith('- '):
@@ -144,37 +152,21 @@ class WikiNote(object):
         return question_size
 
     def parse_close(self):
-        lines = []
-
-        # First, let's add upper part of the paragraph
-        lines_included_upwards = 0
-
-        for line in reversed(self.buffer_proxy[:(self.data['line'])]):
-            candidate = line.strip()
-
-            # Empty line finishes the parsing
-            if not candidate:
-                break
-            else:
-                lines_included_upwards += 1
-                lines.insert(0, line)
+        position = self.data['line']
+        boundaries = self.buffer_proxy.boundaries
 
-        # Now the lower part of the paragraph
-        lines_inspected_forward = 0
+        # The cloze spans over the whole paragraph
+        paragraph_start = boundaries.paragraph_start[position]
+        paragraph_end = boundaries.paragraph_end[position]
+        lines = self.buffer_proxy[paragraph_start:(paragraph_end+1)]
 
-        for line in self.buffer_proxy[(self.data['line']):]:
-            lines_inspected_forward += 1
-            candidate = line.strip()
+        lines_included_upwards = position - paragraph_start
 
-            # Empty line finishes the parsing
-            if not candidate:
-                break
-            else:
-                lines.append(line)
+        # The empty line finishing the paragraph is inspected as well
+        lines_inspected_forward = min(paragraph_end + 2, len(self.buffer_proxy)) - position
 
         # If anything was in the upper part of the paragraph, shift the
         # marked line for this note
-        position = self.data['line']
         self.data['line'] = position - lines_included_upwards
         self.data['last_line'] = position + lines_inspected_forward - 1
 
@@ -197,55 +189,30 @@ class WikiNote(object):
         return lines_inspected_forward
 
     def parse_close_list_item(self):
-        lines = []
+        position = self.data['line']
+        boundaries = self.buffer_proxy.boundaries
 
-        # First, let's add upper part of the paragraph, including the
-        # current line
-        lines_included_upwards = -1
+        item_start = boundaries.item_start[position]
+        item_end = boundaries.continuation_end[position]
 
-        list_item_parsed_upwards = False
-        for line in reversed(self.buffer_proxy[:(self.data['line']+1)]):
-            if not list_item_parsed_upwards:
-                # We know that each line starts with either '* ' or '  '
-                if line.startswith('* '):
-                    list_item_parsed_upwards = True
+        # Include any non-item parts of the list above the current item, such
+        # as the title of the list. We do not count these lines as included
+        # upwards, as that number is used to place the identifier and we want
+        # that to be placed at the beginning of the item.
+        lines = [
+            line
+            for line in self.buffer_proxy[boundaries.list_start[item_start]:item_start]
+            if not (line.startswith('* ') or line.startswith('  '))
+        ]
 
-                lines_included_upwards += 1
-                lines.insert(0, line)
-            else:
-                # If the current item has been parsed, let's go all the way
-                # up and include any non-item parts
-                if line.startswith('* ') or line.startswith('  '):
-                    continue
-                elif not line.strip():
-                    # Empty line means end of parsing
-                    break
-                else:
-                    # Non-empty, non-intended line
-                    # We do not count these lines as included upwards,
-                    # as that number is used to place the identifier
-                    # and we want that to be placed at the beginning
-                    # of the item
-                    lines.insert(0, line)
-
-        # Now the lower part of the paragraph
-        lines_inspected_forward = 1
-
-        for line in self.buffer_proxy[(self.data['line']+1):]:
-            if line.startswith('* '):
-                # Start of the new item, let's terminate here
-                break
-            elif line.startswith('  '):
-                # Continuation of the current item, let's add
-                lines_inspected_forward += 1
-                lines.append(line)
-            else:
-                # Anything else terminates the list
-                break
+        # Now the current item itself, including its indented continuation
+        lines.extend(self.buffer_proxy[item_start:(item_end+1)])
+
+        lines_included_upwards = position - item_start
+        lines_inspected_forward = item_end - position + 1
 
         # If anything was in the upper part of the paragraph, shift the
         # marked line for this note
-        position = self.data['line']
         self.data['line'] = position - lines_included_upwards
         self.data['last_line'] = position + lines_inspected_forward - 1
 
@@ -271,41 +238,22 @@ class WikiNote(object):
         return repr(self.fields)
 
     def parse_numlist_item(self):
-        questionlines = []
-        answerlines = []
-
-        # First, let's add upper part of the paragraph, not including the
-        # current line
-
-        for line in reversed(self.buffer_proxy[:(self.data['line'])]):
-            # If the current item has been parsed, let's go all the way
-            # up and include everything until the line break comes
+        position = self.data['line']
+        boundaries = self.buffer_proxy.boundaries
 
-            if not line.strip():
-                break
-            else:
-                questionlines.insert(0, line)
+        # The upper part of the paragraph, not including the current line,
+        # makes up the question
+        questionlines = self.buffer_proxy[boundaries.paragraph_start[position]:position]
 
         # Add a hint about the item number to the question
-        current_line = self.buffer_proxy[(self.data['line'])]
+        current_line = self.buffer_proxy[position]
         numlist_mark = re.match(k.regexp.NUMLIST_MARK, current_line).group()
         questionlines.append(numlist_mark)
 
-        # Now the lower part of the paragraph
-        answerlines.append(current_line)
-        lines_inspected_forward = 1
-
-        for line in self.buffer_proxy[(self.data['line']+1):]:
-            if re.match(k.regexp.NUMLIST_MARK, line):
-                # Start of the new item, let's terminate here
-                break
-            elif line.startswith('  '):
-                # Continuation of the current item, let's add
-                lines_inspected_forward += 1
-                answerlines.append(line)
-            else:
-                # Anything else terminates the list
-                break
+        # The item itself, including its indented continuation
+        item_end = boundaries.continuation_end[position]
+        answerlines = self.buffer_proxy[position:(item_end+1)]
+        lines_inspected_forward = item_end - position + 1
 
         # Mark the last line of this item
         self.data['last_line'] = self.data['line'] + lines_inspected_forward - 1
@@ -369,6 +317,22 @@ class WikiNote(object):
 
         return 1
 
+    def block(self, number):
+        """
+        Returns the (offset, size) span of the lines that determine this note,
+        relative to the given line that triggered the note. The span covers
+        the whole paragraph, including the lines delimiting it.
+        """
+
+        boundaries = self.buffer_proxy.boundaries
+        start = boundaries.paragraph_start[number]
+        end = boundaries.paragraph_end[number]
+
+        start = max(min(start, self.data['line']) - 1, 0)
+        end = min(max(end, self.data['last_line']) + 1, len(self.buffer_proxy) - 1)
+
+        return number - start, end - start + 1
+
     @property
     def created(self):
         if not self.knowledge_id_assigned:
@@ -391,35 +355,183 @@ class WikiNote(object):
 
         return k.backend.get(self.data['id'])
 
+    @property
+    def fingerprint(self):
+        """
+        Return the fingerprint of the data that is pushed to the SRS.
+        """
+
+        return k.backend.fingerprint(
+            self.fields,
+            self.data['deck'],
+            self.data['model'],
+            self.data['tags'],
+        )
+
     def save(self):
-        if self.created:
-            self._update()
+        self.save_all([self])
+
+    @staticmethod
+    def save_all(notes):
+        """
+        Saves the given notes, sending all the new notes to the SRS in a single
+        batch, as well as all the modified ones. The identifier mappings are
+        looked up and stored in a single transaction each.
+        """
+
+        if not notes:
             return
 
-        obtained_id = self.proxy.add_note(
-            fields=self.fields,
-            deck=self.data['deck'],
-            model=self.data['model'],
-            tags=self.data['tags'],
+        proxy = notes[0].proxy
+        mappings = k.backend.get_many(
+            note.data['id'] for note in notes if note.knowledge_id_assigned
         )
 
-        if obtained_id:
-            if self.knowledge_id_assigned:
-                k.backend.assign(obtained_id, self.data.get('id'))
+        added = []
+        updated = []
+        remaining = []
+        seen = set()
+
+        for note in notes:
+            identifier = note.data.get('id')
+
+            # Notes sharing the identifier depend on each other being saved
+            if identifier in seen:
+                remaining.append(note)
+                continue
+
+            if identifier is not None:
+                seen.add(identifier)
+
+            if identifier in mappings:
+                updated.append((note, note.fingerprint))
             else:
-                self.data['id'] = k.backend.put(obtained_id)
-                self.update_identifier()
-
-    def _update(self):
-        self.proxy.update_note(
-            identifier=self.proxy_id,
-            fields=self.fields,
-            deck=self.data['deck'],
-            model=self.data['model'],
-            tags=self.data['tags']
-        )
+                added.append((note, note.fingerprint))
+
+        # Do not bother the SRS if nothing changed since the last push,
+        # including the pushes not committed yet. The exported notes are
+        # pushed once linked to the imported ones.
+        pending = proxy.pending_fingerprints or dict()
+        changed = [
+            (note, fingerprint)
+            for note, fingerprint in updated
+            if pending.get(note.data['id'], mappings[note.data['id']][1]) != fingerprint
+            and not k.export.is_placeholder(mappings[note.data['id']][0])
+        ]
+
+        # Notes saved by an interrupted checkpointed sync, or added before
+        # a failure, only need their identifiers placed
+        checkpoint = bool(k.config.CHECKPOINT_NOTES or k.config.CHECKPOINT_MS)
+        unassigned = [fingerprint for note, fingerprint in added if not note.knowledge_id_assigned]
+        path = notes[0].buffer_proxy.path
+        resumed = []
+
+        if unassigned:
+            checkpoints = k.backend.resume_checkpoints(unassigned, path)
+
+            unresumed = []
+            for note, fingerprint in added:
+                if not note.knowledge_id_assigned and checkpoints.get(fingerprint):
+                    note.data['id'] = checkpoints[fingerprint].pop()
+                    resumed.append(note)
+                else:
+                    unresumed.append((note, fingerprint))
+
+            added = unresumed
+
+        # Create all the decks the notes need in one step
+        proxy.prepare_decks(set(
+            note.data['deck']
+            for note, fingerprint in changed + added
+            if note.data['deck'] is not None
+        ))
+
+        proxy.update_notes([
+            dict(
+                identifier=mappings[note.data['id']][0],
+                fields=note.fields,
+                deck=note.data['deck'],
+                model=note.data['model'],
+                tags=note.data['tags'],
+                knowledge_id=note.data['id'],
+            )
+            for note, fingerprint in changed
+        ])
+
+        # Stored once the changes are committed
+        proxy.defer_fingerprints({
+            note.data['id']: fingerprint
+            for note, fingerprint in changed
+        })
+
         # This is just for reformatting purposes
-        self.update_identifier()
+        for note, fingerprint in updated:
+            note.update_identifier()
+
+        # The identifiers of the new notes are known upfront, so that the
+        # proxies can embed them
+        knowledge_ids = [
+            note.data['id'] if note.knowledge_id_assigned else k.backend.generate_id()
+            for note, fingerprint in added
+        ]
+
+        failure = None
+
+        try:
+            obtained_ids = proxy.add_notes([
+                dict(
+                    fields=note.fields,
+                    deck=note.data['deck'],
+                    model=note.data['model'],
+                    tags=note.data['tags'],
+                    knowledge_id=knowledge_id,
+                )
+                for (note, fingerprint), knowledge_id in zip(added, knowledge_ids)
+            ])
+        except k.errors.PartialAddException as e:
+            # The SRS keeps the notes added before the failure, hence their
+            # mappings are recorded too, and their identifiers placed by the
+            # next sync if they do not make it into the buffer
+            obtained_ids = e.identifiers
+            failure = e
+
+        entries = []
+        generated = []
+
+        for (note, fingerprint), knowledge_id, obtained_id in zip(added, knowledge_ids, obtained_ids):
+            if not obtained_id:
+                continue
+
+            entries.append((obtained_id, knowledge_id, fingerprint))
+
+            if not note.knowledge_id_assigned:
+                note.data['id'] = knowledge_id
+                generated.append(note)
+
+        # The fingerprints are stored once the notes are committed
+        k.backend.assign_many([
+            (obtained_id, knowledge_id, None)
+            for obtained_id, knowledge_id, fingerprint in entries
+        ])
+        proxy.defer_fingerprints({
+            knowledge_id: fingerprint
+            for obtained_id, knowledge_id, fingerprint in entries
+        })
+
+        if checkpoint or failure is not None:
+            k.backend.record_checkpoints({
+                knowledge_id: fingerprint
+                for obtained_id, knowledge_id, fingerprint in entries
+            }, path)
+
+        for note in generated + resumed:
+            note.update_identifier()
+
+        if failure is not None:
+            raise failure
+
+        for note in remaining:
+            note.save_all([note])
 
     def update_identifier(self):
         """
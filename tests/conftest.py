@@ -1,5 +1,15 @@
+import os
+import tempfile
+
 import pytest
 
+# The tests using the mapping store outside of vim must not touch the one
+# of the user, the store is opened once imported
+os.environ.setdefault(
+    'KNOWLEDGE_DB_FILE',
+    os.path.join(tempfile.mkdtemp(dir='/tmp/'), 'knowledge.db')
+)
+
 
 @pytest.hookimpl(hookwrapper=True, tryfirst=True)
 def pytest_runtest_makereport(item, call):
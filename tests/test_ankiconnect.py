@@ -0,0 +1,265 @@
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from knowledge.errors import FactNotFoundException, KnowledgeException, PartialAddException
+from knowledge.proxy import AnkiConnectProxy
+
+
+class FakeAnki(object):
+    """
+    A stand-in for Anki with the AnkiConnect add-on, keeping the notes in
+    memory and recording the received requests.
+    """
+
+    def __init__(self):
+        self.notes = dict()
+        self.cards = dict()
+        self.decks = set(['Default'])
+        self.requests = []
+        self.clients = set()
+
+        # Number of the requests answered before the server starts failing
+        self.failing = None
+
+    def perform(self, action, params):
+        if action == 'multi':
+            return [
+                self.respond(request['action'], request.get('params', {}))
+                for request in params['actions']
+            ]
+        elif action == 'createDeck':
+            self.decks.add(params['deck'])
+        elif action == 'addNote':
+            note = params['note']
+            if note['deckName'] not in self.decks:
+                raise ValueError('deck was not found')
+            if not note['fields']['Front']:
+                raise ValueError('cannot create note because it is empty')
+
+            identifier = 1000 + len(self.notes)
+            self.notes[identifier] = dict(
+                fields=dict(note['fields']),
+                tags=set(note['tags']),
+                model=note['modelName'],
+            )
+            self.cards[identifier * 10] = dict(note=identifier, deck=note['deckName'])
+            return identifier
+        elif action == 'notesInfo':
+            return [
+                {
+                    'noteId': identifier,
+                    'modelName': self.notes[identifier]['model'],
+                    'tags': sorted(self.notes[identifier]['tags']),
+                    'fields': {
+                        key: {'value': value, 'order': order}
+                        for order, (key, value) in enumerate(self.notes[identifier]['fields'].items())
+                    },
+                    'cards': [card for card, data in self.cards.items() if data['note'] == identifier],
+                } if identifier in self.notes else {}
+                for identifier in params['notes']
+            ]
+        elif action == 'cardsInfo':
+            return [
+                {'cardId': card, 'note': self.cards[card]['note'], 'deckName': self.cards[card]['deck']}
+                for card in params['cards']
+            ]
+        elif action == 'updateNoteFields':
+            self.notes[params['note']['id']]['fields'].update(params['note']['fields'])
+        elif action == 'changeDeck':
+            for card in params['cards']:
+                self.cards[card]['deck'] = params['deck']
+        elif action == 'addTags':
+            for identifier in params['notes']:
+                self.notes[identifier]['tags'] |= set(params['tags'].split())
+        elif action == 'removeTags':
+            for identifier in params['notes']:
+                self.notes[identifier]['tags'] -= set(params['tags'].split())
+        elif action == 'findNotes':
+            return sorted(self.notes)
+        else:
+            raise ValueError(f'unsupported action {action}')
+
+    def respond(self, action, params):
+        try:
+            return {'result': self.perform(action, params), 'error': None}
+        except Exception as e:
+            return {'result': None, 'error': str(e)}
+
+
+@pytest.fixture
+def anki():
+    fake = FakeAnki()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            fake.requests.append(request)
+            fake.clients.add(self.client_address)
+
+            if fake.failing is not None and len(fake.requests) > fake.failing:
+                self.send_response(500)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            body = json.dumps(fake.respond(request['action'], request.get('params', {}))).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    fake.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield fake
+
+    server.shutdown()
+    server.server_close()
+
+
+def note(front, back, deck='Knowledge', tags=None):
+    return dict(
+        deck=deck,
+        model='Basic',
+        fields={'Front': front, 'Back': back},
+        tags=set(tags or ['knowledge']),
+    )
+
+
+def test_add_notes_in_batch(anki):
+    proxy = AnkiConnectProxy(anki.url)
+    identifiers = proxy.add_notes([note(f'Question {i}', 'Answer') for i in range(5)])
+    proxy.cleanup()
+
+    assert len(set(identifiers)) == 5
+    assert anki.notes[int(identifiers[0])]['fields'] == {'Front': 'Question 0', 'Back': 'Answer'}
+
+    # The deck is created once, the notes are added using a single request
+    # over a single connection
+    assert [request['action'] for request in anki.requests] == ['multi', 'multi']
+    assert len(anki.requests[1]['params']['actions']) == 5
+    assert len(anki.clients) == 1
+
+
+def test_update_notes_sends_only_changes(anki):
+    proxy = AnkiConnectProxy(anki.url)
+    identifiers = proxy.add_notes([note('Question 1', 'Answer'), note('Question 2', 'Answer')])
+    anki.requests.clear()
+
+    proxy.update_notes([
+        dict(identifier=identifiers[0], model='Basic', deck='Knowledge.Sub',
+             fields={'Front': 'Question 1', 'Back': 'Answer'}, tags={'knowledge', 'new'}),
+        dict(identifier=identifiers[1], model='Basic', deck='Knowledge',
+             fields={'Front': 'Question 2', 'Back': 'Updated answer'}, tags={'knowledge'}),
+    ])
+    proxy.cleanup()
+
+    first, second = (anki.notes[int(identifier)] for identifier in identifiers)
+    assert first['tags'] == {'knowledge', 'new'}
+    assert anki.cards[int(identifiers[0]) * 10]['deck'] == 'Knowledge::Sub'
+    assert second['fields']['Back'] == 'Updated answer'
+
+    # Deck creation, state lookup of the notes and their cards, and the
+    # changes themselves
+    writes = anki.requests[-1]['params']['actions']
+    assert len(anki.requests) == 4
+    assert sorted(action['action'] for action in writes) == ['addTags', 'changeDeck', 'updateNoteFields']
+
+
+def test_embedded_identifiers(anki):
+    proxy = AnkiConnectProxy(anki.url)
+    identifier, other = proxy.add_notes([
+        dict(note('Question', 'Answer'), knowledge_id='a0000000001'),
+        note('Other', 'Answer'),
+    ])
+
+    # The identifier tag is kept by the updates
+    proxy.update_notes([
+        dict(identifier=identifier, model='Basic', deck='Knowledge',
+             fields={'Front': 'Question', 'Back': 'Answer'}, tags={'new'}),
+    ])
+
+    assert proxy.embedded_identifiers() == [('a0000000001', identifier)]
+    proxy.cleanup()
+
+
+def test_embed_identifiers(anki):
+    proxy = AnkiConnectProxy(anki.url)
+    identifier, = proxy.add_notes([note('Question', 'Answer')])
+
+    # The note synced before gets its identifier, the deleted one is skipped
+    assert proxy.embed_identifiers({'a0000000001': identifier, 'a0000000002': '42'}) == 1
+    assert proxy.embedded_identifiers() == [('a0000000001', identifier)]
+    proxy.cleanup()
+
+
+def test_update_missing_note(anki):
+    proxy = AnkiConnectProxy(anki.url)
+
+    with pytest.raises(FactNotFoundException):
+        proxy.update_note('42', {'Front': 'Question', 'Back': 'Answer'}, deck='Knowledge', model='Basic')
+
+
+def test_action_error(anki):
+    proxy = AnkiConnectProxy(anki.url)
+
+    with pytest.raises(KnowledgeException, match='unsupported action'):
+        proxy.request('guiBrowse', query='')
+
+
+def test_connection_refused():
+    proxy = AnkiConnectProxy('http://127.0.0.1:1')
+
+    with pytest.raises(KnowledgeException, match='Could not connect to AnkiConnect'):
+        proxy.get_identifiers()
+
+
+def test_add_notes_partially(anki):
+    proxy = AnkiConnectProxy(anki.url)
+    proxy.MULTI_CHUNK_SIZE = 2
+
+    # The notes of the request with the failed one are still added, the
+    # following requests are not sent
+    with pytest.raises(PartialAddException, match='empty') as error:
+        proxy.add_notes([note('', 'Answer')] + [note(f'Question {i}', 'Answer') for i in range(3)])
+
+    proxy.cleanup()
+
+    assert error.value.identifiers == [None, '1000', None, None]
+    assert len(anki.notes) == 1
+
+
+def test_add_notes_with_failed_request(anki):
+    proxy = AnkiConnectProxy(anki.url)
+    proxy.MULTI_CHUNK_SIZE = 2
+    proxy.prepare_decks(['Knowledge'])
+
+    # The notes added by the requests before the failed one are kept
+    anki.failing = len(anki.requests) + 1
+    with pytest.raises(PartialAddException, match='500') as error:
+        proxy.add_notes([note(f'Question {i}', 'Answer') for i in range(4)])
+
+    proxy.cleanup()
+
+    assert error.value.identifiers == ['1000', '1001', None, None]
+    assert len(anki.notes) == 2
+
+
+def test_https_url():
+    proxy = AnkiConnectProxy('https://anki.example.com/connect')
+    assert (proxy.port, proxy.path) == (443, '/connect')
+
+    with pytest.raises(KnowledgeException, match='schemes'):
+        AnkiConnectProxy('ftp://127.0.0.1:8765')
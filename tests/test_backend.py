@@ -0,0 +1,38 @@
+import time
+
+from knowledge import backend
+
+
+def test_checkpoints_resumed_for_their_file():
+    fingerprint = backend.generate_id()
+    first, second = backend.generate_id(), backend.generate_id()
+    backend.record_checkpoints({first: fingerprint, second: fingerprint}, '/wiki/first.txt')
+
+    # Notes of another file do not take the identifiers
+    assert backend.resume_checkpoints([fingerprint], '/wiki/second.txt') == {}
+
+    # Each note with the fingerprint takes a single identifier, which is
+    # not handed out again
+    resumed = backend.resume_checkpoints([fingerprint], '/wiki/first.txt')
+    assert len(resumed[fingerprint]) == 1
+
+    remaining = backend.resume_checkpoints([fingerprint, fingerprint], '/wiki/first.txt')
+    assert sorted(resumed[fingerprint] + remaining[fingerprint]) == sorted([first, second])
+
+
+def test_checkpoints_cleared():
+    fingerprint = backend.generate_id()
+    backend.record_checkpoints({backend.generate_id(): fingerprint}, '/wiki/first.txt')
+
+    backend.clear_checkpoints('/wiki/first.txt')
+    assert backend.resume_checkpoints([fingerprint], '/wiki/first.txt') == {}
+
+
+def test_checkpoints_expire(monkeypatch):
+    fingerprint = backend.generate_id()
+    backend.record_checkpoints({backend.generate_id(): fingerprint}, '/wiki/first.txt')
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + backend.CHECKPOINT_TTL + 1)
+
+    assert backend.resume_checkpoints([fingerprint], '/wiki/first.txt') == {}
@@ -261,8 +261,12 @@ class IntegrationTest(object):
                     if 'deck' in expected_fact:
                         tags.append(expected_fact['deck'])
 
-                    # Assert that correct tags were assigned
-                    assert set(tags) == set([tag.name for tag in cards[0].tags])
+                    # Assert that correct tags were assigned, besides the
+                    # one embedding the knowledge identifier
+                    assert set(tags) == set([
+                        tag.name for tag in cards[0].tags
+                        if not tag.name.startswith('knowledge::id::')
+                    ])
 
                 # Assert that all facts have been tested
                 assert len(facts) == len(self.notes)
@@ -0,0 +1,158 @@
+import json
+import os
+import sqlite3
+import tempfile
+import zipfile
+
+import pytest
+
+from knowledge import export
+from knowledge.errors import KnowledgeException
+from knowledge.queries import AnkiQueries
+
+
+@pytest.fixture
+def directory():
+    yield tempfile.mkdtemp(dir='/tmp/')
+
+
+def note(front, back, knowledge_id, model='Basic'):
+    return dict(
+        deck='Knowledge',
+        model=model,
+        fields={'Front': front, 'Back': back} if model == 'Basic' else {'Text': front},
+        tags={'knowledge'},
+        knowledge_id=knowledge_id,
+    )
+
+
+def legacy_collection(path, models):
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE col (models text not null, decks text not null)")
+    db.execute("INSERT INTO col VALUES (?, '{}')", (json.dumps(models),))
+    db.commit()
+    db.close()
+
+
+def package(path):
+    """
+    Returns the models and the (guid, mid, flds) rows of the notes of the
+    given package, and the number of the cards of each note.
+    """
+
+    directory = tempfile.mkdtemp(dir='/tmp/')
+    with zipfile.ZipFile(path) as archive:
+        archive.extract('collection.anki2', directory)
+
+    db = sqlite3.connect(os.path.join(directory, 'collection.anki2'))
+    models = json.loads(db.execute("SELECT models FROM col").fetchone()[0])
+    notes = db.execute("SELECT guid, mid, flds FROM notes ORDER BY id").fetchall()
+    cards = dict(db.execute("SELECT notes.guid, count() FROM cards JOIN notes ON notes.id = cards.nid GROUP BY nid"))
+    db.close()
+
+    return models, notes, cards
+
+
+def test_tsv_export(directory):
+    path = os.path.join(directory, 'export.tsv')
+    exporter = export.TsvExporter(path)
+
+    # The notes are mapped to placeholders until they are imported
+    identifiers = exporter.add_notes([note('Question', 'Answer', 'a0000000001')])
+    assert identifiers == ['export:a0000000001']
+    assert export.is_placeholder(identifiers[0])
+    assert not export.is_placeholder('1600000000000')
+
+    exporter.finish()
+    exporter.cleanup()
+
+    with open(path) as exported:
+        rows = [line.rstrip('\n').split('\t') for line in exported if not line.startswith('#')]
+
+    assert rows == [['Basic', 'Knowledge', 'knowledge', 'a0000000001', 'Question', 'Answer']]
+
+
+def test_apkg_export_reuses_note_types(directory):
+    collection = os.path.join(directory, 'collection.anki2')
+    legacy_collection(collection, {'1600000000001': {
+        'id': 1600000000001,
+        'name': 'Basic',
+        'type': 0,
+        'mod': 5,
+        'css': '.card { color: black; }',
+        'flds': [{'name': 'Front', 'ord': 0}, {'name': 'Back', 'ord': 1}],
+        'tmpls': [
+            {'name': 'Card 1', 'ord': 0, 'qfmt': '{{Front}}', 'afmt': '{{Back}}'},
+            {'name': 'Card 2', 'ord': 1, 'qfmt': '{{Back}}', 'afmt': '{{Front}}'},
+        ],
+    }})
+
+    queries = AnkiQueries(collection)
+    note_types = queries.note_types()
+    queries.cleanup()
+
+    path = os.path.join(directory, 'export.apkg')
+    exporter = export.get_exporter(path, note_types)
+    exporter.add_notes([
+        note('Question', 'Answer', 'a0000000001'),
+        note('Contains {a} and {b}', None, 'a0000000002', model='Cloze'),
+    ])
+    exporter.finish()
+    exporter.cleanup()
+
+    models, notes, cards = package(path)
+
+    # The note type of the collection is kept as it is, the missing one is
+    # generated
+    assert notes[0] == ('a0000000001', 1600000000001, 'Question\x1fAnswer')
+    assert models['1600000000001']['mod'] == 5
+    assert models['1600000000001']['css'] == '.card { color: black; }'
+    assert [template['qfmt'] for template in models['1600000000001']['tmpls']] == ['{{Front}}', '{{Back}}']
+    assert models[str(notes[1][1])]['name'] == 'Cloze'
+
+    # Every template of the note type gets a card, every cloze too
+    assert cards == {'a0000000001': 2, 'a0000000002': 2}
+
+
+def test_apkg_export_with_unknown_field(directory):
+    exporter = export.ApkgExporter(os.path.join(directory, 'export.apkg'), {'Basic': {
+        'id': 1600000000001,
+        'name': 'Basic',
+        'flds': [{'name': 'Front', 'ord': 0}],
+        'tmpls': [{'name': 'Card 1', 'ord': 0, 'qfmt': '{{Front}}', 'afmt': '{{Front}}'}],
+    }})
+
+    with pytest.raises(KnowledgeException):
+        exporter.add_notes([note('Question', 'Answer', 'a0000000001')])
+
+    exporter.cleanup()
+
+
+def test_note_types_of_newer_collections(directory):
+    collection = os.path.join(directory, 'collection.anki2')
+    db = sqlite3.connect(collection)
+    db.executescript("""
+        CREATE TABLE notetypes (id integer, name text, mtime_secs integer, config blob);
+        CREATE TABLE fields (ntid integer, ord integer, name text);
+        CREATE TABLE templates (ntid integer, ord integer, name text, config blob);
+    """)
+
+    # Cloze kind and the styling, the question and the answer formats
+    db.execute("INSERT INTO notetypes VALUES (7, 'Cloze', 5, ?)", (b'\x08\x01\x1a\x04.css',))
+    db.execute("INSERT INTO fields VALUES (7, 1, 'Extra'), (7, 0, 'Text')")
+    db.execute("INSERT INTO templates VALUES (7, 0, 'Cloze', ?)", (b'\x0a\x02{q\x12\x02{a',))
+    db.commit()
+    db.close()
+
+    queries = AnkiQueries(collection)
+    assert queries.note_types() == {'Cloze': {
+        'id': 7,
+        'name': 'Cloze',
+        'type': 1,
+        'mod': 5,
+        'sortf': 0,
+        'css': '.css',
+        'flds': [{'name': 'Text', 'ord': 0}, {'name': 'Extra', 'ord': 1}],
+        'tmpls': [{'name': 'Cloze', 'ord': 0, 'qfmt': '{q', 'afmt': '{a'}],
+    }}
+    queries.cleanup()
@@ -1,3 +1,7 @@
+from time import sleep
+
+import pytest
+
 from tests.test_base import IntegrationTest
 
 
@@ -41,3 +45,697 @@ class TestWriteInTaskwikiFile(IntegrationTest):
 
     def execute(self):
         self.command("w", regex="written$", lines=1)
+
+
+class TestWriteAddedAndUpdatedNotes(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+
+    Q: This is another question
+    - And this is another answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the updated answer
+
+    Q: This is another question {identifier}
+    - And this is another answer
+
+    Q: This is a new question {identifier}
+    - And this is a new answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the updated answer',
+        ),
+        dict(
+            front='This is another question',
+            back='And this is another answer',
+        ),
+        dict(
+            front='This is a new question',
+            back='And this is a new answer',
+        ),
+    ]
+
+    def execute(self):
+        self.command("w", regex="written$", lines=1)
+
+        # Both the new and the modified note are submitted in the same batch
+        self.command("2s/the answer/the updated answer/")
+        self.command("call append('$', ['', 'Q: This is a new question', '- And this is a new answer'])")
+        self.command("w", regex="written$", lines=1)
+
+
+class TestWriteInBackground(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        )
+    ]
+
+    def configure_global_variables(self, proxy):
+        super().configure_global_variables(proxy)
+        self.command('let g:knowledge_async_sync=1')
+
+    def execute(self):
+        cwd = self.command('echo getcwd()', silent=False)
+        self.command("w", regex="written$", lines=1)
+
+        # The identifier is placed once the background sync finishes
+        for i in range(20):
+            sleep(0.5)
+            if '@' in self.read_buffer()[0]:
+                break
+
+        assert self.command('echo &modified', silent=False) == '0'
+
+        # The SRS did not change the working directory of vim
+        assert self.command('echo getcwd()', silent=False) == cwd
+
+
+class TestWriteDebounced(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        )
+    ]
+
+    def configure_global_variables(self, proxy):
+        super().configure_global_variables(proxy)
+        self.command('let g:knowledge_sync_debounce_ms=300')
+
+    def execute(self):
+        # Rapid successive saves result in a single sync
+        self.command("w", regex="written$", lines=1)
+        self.command("w", regex="written$", lines=1)
+
+        # The sync is postponed until the saves stop
+        assert '@' not in self.read_buffer()[0]
+        assert self.command('py3 print(len(k.background.SCHEDULED))', silent=False) == '1'
+
+        for i in range(20):
+            sleep(0.5)
+            if '@' in self.read_buffer()[0]:
+                break
+
+        assert self.command('echo &modified', silent=False) == '0'
+        assert self.command('py3 print(len(k.background.SCHEDULED))', silent=False) == '0'
+
+
+class TestWriteWithWarmProxy(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the updated answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the updated answer',
+        )
+    ]
+
+    def configure_global_variables(self, proxy):
+        super().configure_global_variables(proxy)
+        self.command('let g:knowledge_proxy_idle_ms=200')
+
+    def execute(self):
+        # The second save reuses the proxy opened by the first one
+        self.command("w", regex="written$", lines=1)
+        self.command("2s/the answer/the updated answer/")
+        self.command("w", regex="written$", lines=1)
+
+        # The proxy is closed once idle, releasing the collection
+        sleep(1)
+        assert self.command('py3 print(k.session.PROXY)', silent=False) == 'None'
+
+
+class TestWriteThroughDaemon(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        )
+    ]
+
+    def configure_global_variables(self, proxy):
+        super().configure_global_variables(proxy)
+        self.command('let g:knowledge_srs_daemon=1')
+        self.command('let g:knowledge_daemon_idle_ms=500')
+
+    def execute(self):
+        self.command("w", regex="written$", lines=1)
+
+        # The daemon commits the changes and exits once idle
+        sleep(3)
+        assert self.command('py3 print(k.daemon.running(k.daemon.socket_path()))', silent=False) == 'False'
+
+
+class TestWriteWithTrackedChanges(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+
+    Q: This is another question {identifier}
+    - And this is another answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        ),
+        dict(
+            front='This is another question',
+            back='And this is another answer',
+        ),
+    ]
+
+    def configure_global_variables(self, proxy):
+        super().configure_global_variables(proxy)
+        self.command('let g:knowledge_track_changes=1')
+
+    def execute(self):
+        self.command("w", regex="written$", lines=1)
+
+        # Only the added lines are synced by the second write
+        self.write_buffer([
+            "",
+            "Q: This is another question",
+            "- And this is another answer",
+        ], position=2)
+
+        self.command("w", regex="written$", lines=1)
+
+
+class TestBufferStatus(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        )
+    ]
+
+    def execute(self):
+        self.command("w", regex="written$", lines=1)
+        self.command("KnowledgeBufferStatus", regex="1 notes: 0 due, 0 leeches, 1 new", lines=1)
+
+        # The note was not reviewed yet
+        sign = self.command("echo sign_getplaced('', {'group': 'knowledge'})[0]['signs'][0]['name']", silent=False)
+        assert sign == 'KnowledgeNew'
+
+
+class TestWriteIncrementally(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+
+    Q: This is another question
+    - And this is another answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+
+    Q: This is another question {identifier}
+    - And this is the updated answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        ),
+        dict(
+            front='This is another question',
+            back='And this is the updated answer',
+        ),
+    ]
+
+    def configure_global_variables(self, proxy):
+        super().configure_global_variables(proxy)
+        self.command('let g:knowledge_incremental_sync=1')
+
+    def execute(self):
+        # The blocks with the placed identifiers are cached by the second write
+        self.command("w", regex="written$", lines=1)
+        self.command("w", regex="written$", lines=1)
+
+        # Record the lines of the parsed notes
+        self.command("py3 PARSED = []; ORIGINAL = WikiNote.from_block")
+        self.command(
+            "py3 WikiNote.from_block = classmethod(lambda cls, buffer_proxy, block, *args, **kwargs: "
+            "PARSED.append(block.line) or ORIGINAL(buffer_proxy, block, *args, **kwargs))"
+        )
+
+        # Only the edited note is parsed again
+        self.command("5s/another answer/the updated answer/")
+        self.command("w", regex="written$", lines=1)
+        self.command("py3 WikiNote.from_block = ORIGINAL")
+
+        assert self.command('py3 print(PARSED)', silent=False) == '[3]'
+
+
+class TestWriteDebouncedWithFailure(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        )
+    ]
+
+    def configure_global_variables(self, proxy):
+        super().configure_global_variables(proxy)
+        self.command('let g:knowledge_sync_debounce_ms=300')
+
+    def execute(self):
+        # Another buffer saved in the same batch fails to sync
+        self.command(f"split {self.dir}/other.txt")
+        self.command("call setline(1, ['Q: This is a failing question', '- And this is its answer'])")
+        self.command(
+            'py3 SYNC = BufferSync.sync; FAILING = vim.current.buffer.number; '
+            'exec("def failing_sync(self, *args, **kwargs):\\n'
+            '    if self.number == FAILING:\\n'
+            '        raise k.errors.KnowledgeException(\'Sync failed\')\\n'
+            '    return SYNC(self, *args, **kwargs)")'
+        )
+        self.command("py3 BufferSync.sync = failing_sync")
+
+        self.command("w", regex="written$", lines=1)
+        self.command("wincmd p")
+        self.command("w", regex="written$", lines=1)
+
+        # The buffer synced before the failure gets its identifier
+        for i in range(20):
+            sleep(0.5)
+            if '@' in self.read_buffer()[0]:
+                break
+
+        # Its notes are not added again by another flush
+        sleep(1)
+        self.command("py3 BufferSync.sync = SYNC")
+
+        assert self.command('echo &modified', silent=False) == '0'
+        assert self.command('py3 print(len(k.background.SCHEDULED))', silent=False) == '0'
+
+
+class TestResumeInterruptedSync(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+
+    Q: This is another question
+    - And this is another answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+
+    Q: This is another question {identifier}
+    - And this is another answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        ),
+        dict(
+            front='This is another question',
+            back='And this is another answer',
+        ),
+    ]
+
+    def configure_global_variables(self, proxy):
+        super().configure_global_variables(proxy)
+        self.command('let g:knowledge_checkpoint_notes=1')
+
+    def execute(self):
+        # The sync is interrupted after the checkpoint of the first note
+        self.command(
+            'py3 PROVIDER = k.proxy.DaemonProxy.PROVIDERS[k.config.SRS_PROVIDER]; '
+            'ADD_NOTES = PROVIDER.add_notes; '
+            'exec("def failing_add_notes(self, notes):\\n'
+            '    if any(\'another\' in str(data[\'fields\']) for data in notes):\\n'
+            '        raise k.errors.KnowledgeException(\'Sync failed\')\\n'
+            '    return ADD_NOTES(self, notes)")'
+        )
+        self.command("py3 PROVIDER.add_notes = failing_add_notes")
+        self.command("w", silent=None)
+        self.command("py3 PROVIDER.add_notes = ADD_NOTES")
+
+        assert '@' not in self.read_buffer()[0]
+
+        # The next sync only places the identifier of the checkpointed note,
+        # without adding it again
+        self.command("w", regex="written$", lines=1)
+
+
+class TestExportTsvAndReconcile(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the updated answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the updated answer',
+        )
+    ]
+
+    # The exported files are imported by Anki only
+    @pytest.mark.parametrize("proxy", ["Anki"])
+    def test_execute(self, request, proxy):
+        super().test_execute(request, proxy)
+
+    def execute(self):
+        # Record the exported notes, to be imported as Anki would
+        self.command("py3 EXPORTED = []; EXPORT = k.export.TsvExporter.add_notes")
+        self.command("py3 k.export.TsvExporter.add_notes = lambda self, notes: EXPORTED.extend(notes) or EXPORT(self, notes)")
+        self.command(f"KnowledgeExport {self.dir}/knowledge.tsv", regex="Exported 1 notes", lines=1)
+        self.command("py3 k.export.TsvExporter.add_notes = EXPORT")
+
+        # The identifier is placed, the save does not add the note again
+        assert '@' in self.read_buffer()[0]
+        self.command("w", regex="written$", lines=1)
+
+        # The imported note carries the embedded identifier
+        self.command('py3 exec("with autodeleted_proxy() as proxy:\\n    proxy.add_notes(EXPORTED)\\n    proxy.commit()")')
+        self.command("KnowledgeReconcile", regex="Exported notes linked: 1")
+
+        # The changes are pushed to the imported note
+        self.command("2s/the answer/the updated answer/")
+        self.command("w", regex="written$", lines=1)
+
+
+class TestReconcileLostMappings(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the updated answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the updated answer',
+        )
+    ]
+
+    def execute(self):
+        # The note is synced without its identifier embedded, as before
+        self.command(
+            'py3 PROVIDER = k.proxy.DaemonProxy.PROVIDERS[k.config.SRS_PROVIDER]; '
+            'ADD_NOTES = PROVIDER.add_notes'
+        )
+        self.command("py3 PROVIDER.add_notes = lambda self, notes: ADD_NOTES(self, [dict(data, knowledge_id=None) for data in notes])")
+        self.command("w", regex="written$", lines=1)
+        self.command("py3 PROVIDER.add_notes = ADD_NOTES")
+
+        # The identifier is embedded into the existing note
+        self.command("KnowledgeReconcile!", regex="Identifiers embedded: 1")
+
+        # The lost mappings are restored from the SRS
+        self.command("py3 k.backend.set_fact_ids({knowledge_id: None for knowledge_id in k.backend.get_all()})")
+        self.command("KnowledgeReconcile!", regex="Mappings restored: 1")
+
+        # The changes are pushed to the same note
+        self.command("2s/the answer/the updated answer/")
+        self.command("w", regex="written$", lines=1)
+
+
+class TestWriteWithBudget(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+
+    Q: This is another question
+    - And this is another answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+
+    Q: This is another question {identifier}
+    - And this is another answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        ),
+        dict(
+            front='This is another question',
+            back='And this is another answer',
+        ),
+    ]
+
+    def configure_global_variables(self, proxy):
+        super().configure_global_variables(proxy)
+        self.command('let g:knowledge_sync_budget_ms=1')
+
+    def execute(self):
+        # Saving a note takes longer than the budget
+        self.command(
+            'py3 PROVIDER = k.proxy.DaemonProxy.PROVIDERS[k.config.SRS_PROVIDER]; '
+            'ADD_NOTES = PROVIDER.add_notes; '
+            'exec("def slow_add_notes(self, notes):\\n'
+            '    time.sleep(0.05)\\n'
+            '    return ADD_NOTES(self, notes)")'
+        )
+        self.command("py3 PROVIDER.add_notes = slow_add_notes")
+        self.command("1")
+        self.command("w", regex="written$", lines=1)
+        self.command("py3 PROVIDER.add_notes = ADD_NOTES")
+
+        # Only the note at the cursor is synced, the other one is pending
+        assert '@' in self.read_buffer()[0]
+        assert '@' not in self.read_buffer()[3]
+        assert self.command('py3 print(k.cache.PENDING_NOTES.get(vim.current.buffer.number, 0))', silent=False) == '1'
+
+        # The pending note is picked up once the user is idle
+        self.command("py3 resume_notes()")
+        assert self.command('py3 print(k.cache.PENDING_NOTES.get(vim.current.buffer.number, 0))', silent=False) == '0'
+        assert self.command('echo &modified', silent=False) == '0'
+
+
+class TestBufferProxyPushesModifiedRanges(IntegrationTest):
+
+    def execute(self):
+        # Record the ranges written into the buffer
+        self.command(
+            'py3 WRITES = []; '
+            'exec("class RecordingBuffer(list):\\n'
+            '    def __setitem__(self, index, lines):\\n'
+            '        WRITES.append((index.start, index.stop))\\n'
+            '        list.__setitem__(self, index, lines)")'
+        )
+        self.command("py3 PROXY = BufferProxy(RecordingBuffer(['a', 'b', 'c', 'd', 'e']), path='test.txt'); PROXY.obtain()")
+
+        # Adjacent modified lines are written at once, unchanged ones not at all
+        self.command("py3 PROXY[0] = 'a'; PROXY[1] = 'B'; PROXY[2:4] = ['C', 'D']; PROXY.push()")
+        assert self.command('py3 print(WRITES)', silent=False) == '[(1, 4)]'
+
+        # Nothing is written if nothing changed
+        self.command("py3 PROXY[4] = 'e'; PROXY.push()")
+        assert self.command('py3 print(WRITES)', silent=False) == '[(1, 4)]'
+
+        # Changing the number of lines replaces all of them
+        self.command("py3 PROXY[3:5] = ['x']; PROXY.push()")
+        assert self.command('py3 print(WRITES)', silent=False) == '[(1, 4), (None, None)]'
+        assert self.command('py3 print(PROXY.object)', silent=False) == "['a', 'B', 'C', 'x']"
+
+
+class TestAnkiLookupsCached(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+
+    Q: This is another question
+    - And this is another answer
+
+    Q: This is yet another question
+    - And this is yet another answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+
+    Q: This is another question {identifier}
+    - And this is another answer
+
+    Q: This is yet another question {identifier}
+    - And this is yet another answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        ),
+        dict(
+            front='This is another question',
+            back='And this is another answer',
+        ),
+        dict(
+            front='This is yet another question',
+            back='And this is yet another answer',
+        ),
+    ]
+
+    # The model and deck lookups are specific to Anki
+    @pytest.mark.parametrize("proxy", ["Anki"])
+    def test_execute(self, request, proxy):
+        super().test_execute(request, proxy)
+
+    def execute(self):
+        # Record the lookups of the models and decks by name
+        self.command(
+            "py3 import anki.models, anki.decks; LOOKUPS = []; "
+            "MODEL_BY_NAME = anki.models.ModelManager.byName; "
+            "DECK_BY_NAME = anki.decks.DeckManager.byName"
+        )
+        self.command("py3 anki.models.ModelManager.byName = lambda self, name: LOOKUPS.append('model') or MODEL_BY_NAME(self, name)")
+        self.command("py3 anki.decks.DeckManager.byName = lambda self, name: LOOKUPS.append('deck') or DECK_BY_NAME(self, name)")
+
+        self.command("w", regex="written$", lines=1)
+
+        self.command("py3 anki.models.ModelManager.byName = MODEL_BY_NAME")
+        self.command("py3 anki.decks.DeckManager.byName = DECK_BY_NAME")
+
+        # Looked up once for all the notes of the batch
+        assert self.command("py3 print(sorted(LOOKUPS))", silent=False) == "['deck', 'model']"
+
+
+class TestNoteInfoWithoutProxy(IntegrationTest):
+
+    viminput = """
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    Q: This is a question {identifier}
+    - And this is the answer
+    """
+
+    notes = [
+        dict(
+            front='This is a question',
+            back='And this is the answer',
+        )
+    ]
+
+    def execute(self):
+        self.command("w", regex="written$", lines=1)
+
+        # The lookups must not open the SRS proxy
+        self.command(
+            'py3 PROVIDER = k.proxy.DaemonProxy.PROVIDERS[k.config.SRS_PROVIDER]; '
+            'INIT = PROVIDER.__init__; '
+            'exec("def failing_init(self, *args, **kwargs):\\n'
+            '    raise k.errors.KnowledgeException(\'The proxy was opened\')")'
+        )
+        self.command("py3 PROVIDER.__init__ = failing_init")
+
+        self.command("1")
+        self.command("KnowledgeNoteInfo", regex="Note ID:")
+        self.command("KnowledgeDiag", regex="IDs detected in srs: 1")
+
+        self.command("py3 PROVIDER.__init__ = INIT")
@@ -1,3 +1,5 @@
+import pytest
+
 from tests.test_base import IntegrationTest
 
 
@@ -209,3 +211,343 @@ class TestHeaderStacking(IntegrationTest):
 
     def execute(self):
         self.command("w", regex="written$", lines=1)
+
+
+class TestSaveRangeUnderHeader(IntegrationTest):
+
+    viminput = """
+    == Math formulas @ Math +formulas ==
+
+    Q: This is another question
+    - And this is another answer
+
+    === Life questions @ Math.Goniometric ===
+
+    Q: This is a question
+    - And this is the answer
+    """
+
+    vimoutput = """
+    == Math formulas @ Math +formulas ==
+
+    Q: This is another question
+    - And this is another answer
+
+    === Life questions @ Math.Goniometric ===
+
+    Q: This is a question {identifier}
+    - And this is the answer
+    """
+
+    notes = [
+        dict(
+            mnemosyne_front='Life questions\n\nThis is a question',
+            anki_front='Life questions<br><br>This is a question',
+            back='And this is the answer',
+            tags=['formulas'],
+            deck='Math::Goniometric',
+        )
+    ]
+
+    def execute(self):
+        self.command("8,9KnowledgeBufferSave")
+
+
+class TestSaveHeaderSubtree(IntegrationTest):
+
+    viminput = """
+    == Math formulas @ Math +formulas ==
+
+    === Life questions @ Math.Goniometric ===
+
+    Q: This is a question
+    - And this is the answer
+
+    == Other formulas @ Other ==
+
+    Q: This is another question
+    - And this is another answer
+    """
+
+    vimoutput = """
+    == Math formulas @ Math +formulas ==
+
+    === Life questions @ Math.Goniometric ===
+
+    Q: This is a question {identifier}
+    - And this is the answer
+
+    == Other formulas @ Other ==
+
+    Q: This is another question
+    - And this is another answer
+    """
+
+    notes = [
+        dict(
+            mnemosyne_front='Life questions\n\nThis is a question',
+            anki_front='Life questions<br><br>This is a question',
+            back='And this is the answer',
+            tags=['formulas'],
+            deck='Math::Goniometric',
+        )
+    ]
+
+    def execute(self):
+        self.command("3")
+        self.command("KnowledgeSubtreeSave")
+
+
+class TestChangeHeaderMetadata(IntegrationTest):
+
+    viminput = """
+    == Math formulas @ Math +formulas ==
+
+    Q: This is a question
+    - And this is the answer
+
+    Q: This is another question
+    - And this is another answer
+    """
+
+    vimoutput = """
+    == Math formulas @ Physics +equations ==
+
+    Q: This is a question {identifier}
+    - And this is the answer
+
+    Q: This is another question {identifier}
+    - And this is another answer
+    """
+
+    notes = [
+        dict(
+            mnemosyne_front='Math formulas\n\nThis is a question',
+            anki_front='Math formulas<br><br>This is a question',
+            back='And this is the answer',
+            tags=['equations'],
+            deck='Physics',
+        ),
+        dict(
+            mnemosyne_front='Math formulas\n\nThis is another question',
+            anki_front='Math formulas<br><br>This is another question',
+            back='And this is another answer',
+            tags=['equations'],
+            deck='Physics',
+        ),
+    ]
+
+    def execute(self):
+        self.command("w", regex="written$", lines=1)
+
+        # All the notes under the header are moved and retagged together
+        self.command("1s/Math +formulas/Physics +equations/")
+        self.command("w", regex="written$", lines=1)
+
+
+class TestSkipUnchangedNotes(IntegrationTest):
+
+    viminput = """
+    == Math formulas @ Math +formulas ==
+
+    Q: This is a question
+    - And this is the answer
+
+    Q: This is another question
+    - And this is another answer
+    """
+
+    vimoutput = """
+    == Math formulas @ Physics +equations ==
+
+    Q: This is a question {identifier}
+    - And this is the answer
+
+    Q: This is another question {identifier}
+    - And this is another answer
+    """
+
+    notes = [
+        dict(
+            mnemosyne_front='Math formulas\n\nThis is a question',
+            anki_front='Math formulas<br><br>This is a question',
+            back='And this is the answer',
+            tags=['equations'],
+            deck='Physics',
+        ),
+        dict(
+            mnemosyne_front='Math formulas\n\nThis is another question',
+            anki_front='Math formulas<br><br>This is another question',
+            back='And this is another answer',
+            tags=['equations'],
+            deck='Physics',
+        ),
+    ]
+
+    def updated(self):
+        return self.command('py3 print(UPDATED)', silent=False)
+
+    def execute(self):
+        self.command("w", regex="written$", lines=1)
+
+        # Record the number of the notes sent to the SRS as updates
+        self.command(
+            "py3 PROVIDER = k.proxy.DaemonProxy.PROVIDERS[k.config.SRS_PROVIDER]; "
+            "UPDATE_NOTES = PROVIDER.update_notes; UPDATED = []"
+        )
+        self.command(
+            "py3 PROVIDER.update_notes = lambda self, notes: "
+            "UPDATED.append(len(notes)) or UPDATE_NOTES(self, notes)"
+        )
+
+        # The notes pushed by the last sync are not sent again
+        self.command("w", regex="written$", lines=1)
+        assert self.updated() == '[0]'
+
+        # Changing the tags or the deck of the notes updates them
+        self.command("1s/+formulas/+equations/")
+        self.command("w", regex="written$", lines=1)
+        assert self.updated() == '[0, 2]'
+
+        self.command("1s/@ Math/@ Physics/")
+        self.command("w", regex="written$", lines=1)
+        assert self.updated() == '[0, 2, 2]'
+
+        self.command("py3 PROVIDER.update_notes = UPDATE_NOTES")
+
+
+class TestChangeHeaderMetadataPrefetched(IntegrationTest):
+
+    viminput = """
+    == Math formulas @ Math +formulas ==
+
+    Q: This is a question
+    - And this is the answer
+
+    Q: This is another question
+    - And this is another answer
+    """
+
+    vimoutput = """
+    == Math formulas @ Physics +equations ==
+
+    Q: This is a question {identifier}
+    - And this is the updated answer
+
+    Q: This is another question {identifier}
+    - And this is another answer
+    """
+
+    notes = [
+        dict(
+            anki_front='Math formulas<br><br>This is a question',
+            back='And this is the updated answer',
+            tags=['equations'],
+            deck='Physics',
+        ),
+        dict(
+            anki_front='Math formulas<br><br>This is another question',
+            back='And this is another answer',
+            tags=['equations'],
+            deck='Physics',
+        ),
+    ]
+
+    # The notes are prefetched from the Anki collection
+    @pytest.mark.parametrize("proxy", ["Anki"])
+    def test_execute(self, request, proxy):
+        super().test_execute(request, proxy)
+
+    def loaded(self):
+        return self.command('py3 print(LOADED)', silent=False)
+
+    def execute(self):
+        self.command("w", regex="written$", lines=1)
+
+        # Record the notes loaded one by one
+        self.command(
+            "py3 PROVIDER = k.proxy.DaemonProxy.PROVIDERS[k.config.SRS_PROVIDER]; "
+            "NOTE_BY_ID = PROVIDER._note_by_id; LOADED = []"
+        )
+        self.command(
+            "py3 PROVIDER._note_by_id = lambda self, identifier: "
+            "LOADED.append(identifier) or NOTE_BY_ID(self, identifier)"
+        )
+
+        # Moving and retagging the notes does not load them
+        self.command("1s/Math +formulas/Physics +equations/")
+        self.command("w", regex="written$", lines=1)
+        assert self.loaded() == '[]'
+
+        # Only the note with the changed fields is loaded
+        self.command("4s/the answer/the updated answer/")
+        self.command("w", regex="written$", lines=1)
+        assert self.command('py3 print(len(LOADED))', silent=False) == '1'
+
+        self.command("py3 PROVIDER._note_by_id = NOTE_BY_ID")
+
+
+class TestMnemosyneCardsWrittenOnCommit(IntegrationTest):
+
+    viminput = """
+    == Math formulas @ Math +formulas ==
+
+    Q: This is a question
+    - And this is the answer
+
+    Q: This is another question
+    - And this is another answer
+    """
+
+    vimoutput = """
+    == Math formulas @ Math +equations ==
+
+    Q: This is a question {identifier}
+    - And this is the updated answer
+
+    Q: This is another question {identifier}
+    - And this is another updated answer
+    """
+
+    notes = [
+        dict(
+            mnemosyne_front='Math formulas\n\nThis is a question',
+            back='And this is the updated answer',
+            tags=['equations'],
+            deck='Math',
+        ),
+        dict(
+            mnemosyne_front='Math formulas\n\nThis is another question',
+            back='And this is another updated answer',
+            tags=['equations'],
+            deck='Math',
+        ),
+    ]
+
+    # The card writes are deferred by the Mnemosyne proxy
+    @pytest.mark.parametrize("proxy", ["Mnemosyne"])
+    def test_execute(self, request, proxy):
+        super().test_execute(request, proxy)
+
+    def execute(self):
+        self.command("w", regex="written$", lines=1)
+
+        # Record the number of the cards waiting for the commit
+        self.command(
+            "py3 PROVIDER = k.proxy.DaemonProxy.PROVIDERS[k.config.SRS_PROVIDER]; "
+            "COMMIT = PROVIDER.commit; PENDING = []"
+        )
+        self.command(
+            "py3 PROVIDER.commit = lambda self: "
+            "PENDING.append(len(self.pending_cards)) or COMMIT(self)"
+        )
+
+        self.command("1s/+formulas/+equations/")
+        self.command("4s/the answer/the updated answer/")
+        self.command("7s/another answer/another updated answer/")
+        self.command("w", regex="written$", lines=1)
+
+        self.command("py3 PROVIDER.commit = COMMIT")
+
+        # Both edited cards are written at once, with their new tags
+        assert self.command('py3 print(PENDING)', silent=False) == '[2]'
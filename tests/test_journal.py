@@ -0,0 +1,194 @@
+import json
+import os
+import tempfile
+import threading
+
+import pytest
+
+import knowledge
+from knowledge import backend, journal
+from knowledge.errors import SRSUnavailableException
+from knowledge.proxy import SQLiteProxy
+
+
+@pytest.fixture
+def directory(monkeypatch):
+    monkeypatch.setattr(knowledge.config, 'SRS_PROVIDER', 'SQLite')
+    yield tempfile.mkdtemp(dir='/tmp/')
+
+
+def note(front, back):
+    return dict(
+        deck='Knowledge',
+        model='Basic',
+        fields={'Front': front, 'Back': back},
+        tags={'knowledge'},
+    )
+
+
+def journaled(path, added=(), updated=()):
+    """
+    Journals the given (knowledge_id, note) additions and (identifier, note)
+    updates, returns the placeholder fact ids of the added notes.
+    """
+
+    proxy = journal.JournalProxy(path)
+    proxy.base_dir = os.path.dirname(path)
+
+    placeholders = proxy.add_notes([
+        dict(data, knowledge_id=knowledge_id)
+        for knowledge_id, data in added
+    ])
+    proxy.update_notes([
+        dict(data, identifier=identifier)
+        for identifier, data in updated
+    ])
+
+    proxy.commit()
+    return placeholders
+
+
+def back(proxy, identifier):
+    fields, = proxy.db.execute("SELECT fields FROM notes WHERE id=?", (int(identifier),)).fetchone()
+    return json.loads(fields)['Back']
+
+
+def test_load_collapses_entries(directory):
+    path = os.path.join(directory, 'journal')
+    placeholder, = journaled(path, added=[('a0000000001', note('Question', 'Answer'))],
+                             updated=[('42', note('Other', 'Answer'))])
+
+    # The updates of a journaled note are folded into its addition
+    journaled(path, updated=[
+        (placeholder, note('Question', 'Updated answer')),
+        ('42', note('Other', 'Updated answer')),
+    ])
+
+    # A partially written entry is ignored
+    with open(path, 'a') as journal_file:
+        journal_file.write('{"operation": "upd')
+
+    assert [
+        (entry['operation'], entry['key'], entry['fields']['Back'])
+        for entry in journal.load(path)
+    ] == [
+        ('add', 'a0000000001', 'Updated answer'),
+        ('update', '42', 'Updated answer'),
+    ]
+
+
+def test_replay(directory):
+    path = os.path.join(directory, 'journal')
+    proxy = SQLiteProxy(os.path.join(directory, 'srs.db'))
+    identifier, = proxy.add_notes([note('Other', 'Answer')])
+    proxy.commit()
+
+    knowledge_id = backend.generate_id()
+    placeholder, = journaled(path, added=[(knowledge_id, note('Question', 'Answer'))],
+                             updated=[(identifier, note('Other', 'Updated answer'))])
+    backend.assign_many([(placeholder, knowledge_id, None)])
+
+    assert journal.replay(proxy, path) == 2
+
+    # The placeholder mapping points to the added note
+    fact_id = backend.get(knowledge_id)
+    assert proxy.get_identifiers() == {identifier, fact_id}
+    assert back(proxy, identifier) == 'Updated answer'
+    assert not os.path.exists(path)
+
+    proxy.cleanup()
+
+
+def test_replay_quarantines_rejected_entries(directory):
+    path = os.path.join(directory, 'journal')
+    proxy = SQLiteProxy(os.path.join(directory, 'srs.db'))
+    identifier, = proxy.add_notes([note('Other', 'Answer')])
+    proxy.commit()
+
+    journaled(path, updated=[
+        ('42', note('Deleted', 'Answer')),
+        (identifier, note('Other', 'Updated answer')),
+    ])
+
+    # The update of the deleted note is moved aside, the other one applied
+    assert journal.replay(proxy, path) == 1
+    assert back(proxy, identifier) == 'Updated answer'
+    assert not os.path.exists(path)
+
+    with open(path + '.failed') as failed:
+        entry, = [json.loads(line) for line in failed]
+
+    assert entry['key'] == '42'
+    assert 'could not be found' in entry['error']
+
+    proxy.cleanup()
+
+
+class UnavailableProxy(SQLiteProxy):
+    """
+    Becomes unavailable once the updates are submitted.
+    """
+
+    def add_notes(self, notes):
+        raise SRSUnavailableException("The SRS is not available")
+
+
+def test_interrupted_replay(directory):
+    path = os.path.join(directory, 'journal')
+    proxy = UnavailableProxy(os.path.join(directory, 'srs.db'))
+    identifier, = SQLiteProxy.add_notes(proxy, [note('Other', 'Answer')])
+    proxy.commit()
+
+    knowledge_id = backend.generate_id()
+    placeholder, = journaled(path, added=[(knowledge_id, note('Question', 'Answer'))],
+                             updated=[(identifier, note('Other', 'Updated answer'))])
+    backend.assign_many([(placeholder, knowledge_id, None)])
+
+    with pytest.raises(SRSUnavailableException):
+        journal.replay(proxy, path)
+
+    proxy.cleanup()
+
+    # The submitted update is committed, only the addition stays journaled
+    proxy = SQLiteProxy(os.path.join(directory, 'srs.db'))
+    assert back(proxy, identifier) == 'Updated answer'
+    assert [(entry['operation'], entry['key']) for entry in journal.load(path)] == [('add', knowledge_id)]
+    assert backend.get(knowledge_id) == placeholder
+
+    proxy.cleanup()
+
+
+class AppendingProxy(SQLiteProxy):
+    """
+    Another editor journals a change while the journal is being replayed.
+    """
+
+    def update_notes(self, notes):
+        super().update_notes(notes)
+
+        self.appending = threading.Thread(
+            target=journaled,
+            args=(self.journal,),
+            kwargs=dict(updated=[('42', note('Other', 'Later answer'))]),
+        )
+        self.appending.start()
+
+        # The change is journaled once the replay is finished
+        self.appending.join(0.2)
+        assert self.appending.is_alive()
+
+
+def test_changes_journaled_during_replay(directory):
+    path = os.path.join(directory, 'journal')
+    proxy = AppendingProxy(os.path.join(directory, 'srs.db'))
+    proxy.journal = path
+    identifier, = proxy.add_notes([note('Other', 'Answer')])
+    proxy.commit()
+
+    journaled(path, updated=[(identifier, note('Other', 'Updated answer'))])
+
+    assert journal.replay(proxy, path) == 1
+    proxy.appending.join()
+    proxy.cleanup()
+
+    assert [(entry['operation'], entry['key']) for entry in journal.load(path)] == [('update', '42')]
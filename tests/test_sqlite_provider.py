@@ -0,0 +1,148 @@
+import os
+import sqlite3
+import tempfile
+
+import pytest
+
+from knowledge.errors import FactNotFoundException
+from knowledge.proxy import SQLiteProxy
+from knowledge.queries import SQLiteQueries
+
+
+@pytest.fixture
+def path():
+    directory = tempfile.mkdtemp(dir='/tmp/')
+    yield os.path.join(directory, 'srs.db')
+
+
+def note(front, back, deck='Knowledge', tags=None, model='Basic'):
+    return dict(
+        deck=deck,
+        model=model,
+        fields={'Front': front, 'Back': back} if model == 'Basic' else {'Text': front},
+        tags=set(tags or ['knowledge']),
+    )
+
+
+def test_add_and_update_notes(path):
+    proxy = SQLiteProxy(path)
+    first, second = proxy.add_notes([
+        note('Question', 'Answer'),
+        note('Contains {a} and {b}', None, model='Cloze'),
+    ])
+    proxy.commit()
+
+    assert proxy.get_identifiers() == {first, second}
+
+    # Each cloze gets its own card
+    assert proxy.db.execute("SELECT count() FROM cards WHERE note_id=?", (int(second),)).fetchone() == (2,)
+
+    proxy.update_notes([
+        dict(identifier=first, model='Basic', deck='Knowledge.Sub',
+             fields={'Front': 'Question', 'Back': 'New answer'}, tags={'knowledge', 'new'}),
+        dict(identifier=second, model='Cloze', deck='Knowledge',
+             fields={'Text': 'Contains {a}'}, tags={'knowledge'}),
+    ])
+    proxy.commit()
+    proxy.cleanup()
+
+    db = sqlite3.connect(path)
+    assert db.execute(
+        "SELECT decks.name FROM cards JOIN decks ON decks.id = cards.deck_id WHERE note_id=?",
+        (int(first),)
+    ).fetchall() == [('Knowledge::Sub',)]
+    assert set(db.execute("SELECT name FROM tags WHERE note_id=?", (int(first),))) == {('knowledge',), ('new',)}
+
+    # The card of the removed cloze is deleted
+    assert db.execute("SELECT count() FROM cards WHERE note_id=?", (int(second),)).fetchone() == (1,)
+
+
+def test_uncommitted_changes_are_rolled_back(path):
+    proxy = SQLiteProxy(path)
+    proxy.add_note('Knowledge', 'Basic', {'Front': 'Question', 'Back': 'Answer'}, {'knowledge'})
+    proxy.cleanup()
+
+    proxy = SQLiteProxy(path)
+    assert proxy.get_identifiers() == set()
+    proxy.cleanup()
+
+
+def test_update_missing_note(path):
+    proxy = SQLiteProxy(path)
+
+    with pytest.raises(FactNotFoundException):
+        proxy.update_note('42', {'Front': 'Question', 'Back': 'Answer'}, deck='Knowledge', model='Basic')
+
+    proxy.cleanup()
+
+
+def test_read_only_queries(path):
+    proxy = SQLiteProxy(path)
+    identifier, = proxy.add_notes([note('Question', 'Answer')])
+    proxy.commit()
+
+    # The queries do not wait for the open proxy
+    queries = SQLiteQueries(path)
+    assert queries.get_identifiers() == {identifier}
+    assert queries.note_info(identifier)['deck'] == 'Knowledge'
+    assert queries.notes_status([identifier])[identifier]['reviews'] == 0
+    queries.cleanup()
+
+    proxy.cleanup()
+
+
+def test_embedded_identifiers(path):
+    proxy = SQLiteProxy(path)
+    first, second = proxy.add_notes([
+        dict(note('Question', 'Answer'), knowledge_id='a0000000001'),
+        note('Other', 'Answer'),
+    ])
+    proxy.commit()
+
+    # The identifier tag survives the updates without the knowledge_id
+    proxy.update_notes([
+        dict(identifier=first, model='Basic', deck='Knowledge',
+             fields={'Front': 'Question', 'Back': 'Answer'}, tags={'new'}),
+        dict(identifier=second, model='Basic', deck='Knowledge', knowledge_id='a0000000002',
+             fields={'Front': 'Other', 'Back': 'Answer'}, tags={'knowledge'}),
+    ])
+    proxy.commit()
+    proxy.cleanup()
+
+    queries = SQLiteQueries(path)
+    assert sorted(queries.embedded_identifiers()) == [('a0000000001', first), ('a0000000002', second)]
+    queries.cleanup()
+
+
+def test_embed_identifiers(path):
+    proxy = SQLiteProxy(path)
+    first, second = proxy.add_notes([note('Question', 'Answer'), note('Other', 'Answer')])
+    proxy.commit()
+
+    # The notes synced before get their identifiers, the deleted ones are skipped
+    assert proxy.embed_identifiers({'a0000000001': first, 'a0000000002': '42'}) == 1
+    assert proxy.embed_identifiers({'a0000000001': first}) == 0
+    proxy.commit()
+    proxy.cleanup()
+
+    queries = SQLiteQueries(path)
+    assert queries.embedded_identifiers() == [('a0000000001', first)]
+    queries.cleanup()
+
+
+def test_update_notes_in_chunks(path):
+    proxy = SQLiteProxy(path)
+    proxy.SNAPSHOT_CHUNK_SIZE = 2
+    identifiers = proxy.add_notes([note(f'Question {i}', 'Answer') for i in range(5)])
+    proxy.commit()
+
+    # The current state of the notes is looked up in multiple queries
+    proxy.update_notes([
+        dict(identifier=identifier, model='Basic', deck='Knowledge',
+             fields={'Front': f'Question {i}', 'Back': 'Answer'}, tags={'knowledge', 'new'})
+        for i, identifier in enumerate(identifiers)
+    ])
+    proxy.commit()
+
+    assert proxy.db.execute("SELECT count() FROM tags WHERE name='new'").fetchone() == (5,)
+    proxy.cleanup()
@@ -0,0 +1,77 @@
+import sys
+import types
+
+import pytest
+
+import knowledge
+
+
+class FakeNeovim(object):
+    """
+    A stand-in for the legacy vim module of Neovim, which returns the
+    evaluated expressions as strings and runs the Lua chunks.
+    """
+
+    def __init__(self):
+        self.changes = dict()
+        self.attached = []
+
+    def eval(self, expression):
+        return {
+            'has("nvim")': '1',
+            'has("nvim-0.4")': '1',
+        }.get(expression, '0')
+
+    def exec_lua(self, code, buffer_number):
+        if 'nvim_buf_attach' in code:
+            self.attached.append(buffer_number)
+            self.changes[buffer_number] = []
+        else:
+            changes, self.changes[buffer_number] = self.changes[buffer_number], []
+            return changes
+
+    def command(self, command):
+        raise AssertionError(f"Vim command run under Neovim: {command}")
+
+
+@pytest.fixture
+def neovim(monkeypatch):
+    fake = FakeNeovim()
+    module = types.ModuleType('vim')
+    for name in ('eval', 'exec_lua', 'command'):
+        setattr(module, name, getattr(fake, name))
+
+    # The tracking modules are imported against the fake editor
+    monkeypatch.setitem(sys.modules, 'vim', module)
+    for name in ('knowledge.vimutils', 'knowledge.tracking'):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+
+    import knowledge.tracking
+    yield fake, knowledge.tracking
+
+    for name in ('knowledge.vimutils', 'knowledge.tracking'):
+        sys.modules.pop(name, None)
+
+
+def test_neovim_tracking(neovim):
+    fake, tracking = neovim
+
+    assert tracking.supported()
+    tracking.attach(3)
+    assert fake.attached == [3]
+
+    tracker = tracking.TRACKERS[3]
+    tracker.reset([])
+
+    # Lines 2-3 replaced by three lines, line 10 removed
+    fake.changes[3].extend([[2, 4, 1], [10, 11, -1]])
+    tracker.update()
+
+    assert tracker.valid
+    assert tracker.intervals == [(2, 5), (9, 11)]
+
+    # A reload makes the changes unknown
+    fake.changes[3].append([-1, -1, 0])
+    tracker.update()
+
+    assert not tracker.valid